@@ -32,7 +32,8 @@ setup(
 	],
 	extras_require={
 		'fuse': fuse_reqs,
-		'all': fuse_reqs,
+		'numpy': ['numpy'],
+		'all': fuse_reqs + ['numpy'],
 	},
 	python_requires='>=2.7, !=3.0.*, !=3.1.*, !=3.2.*, !=3.3.*, !=3.4.*',
 
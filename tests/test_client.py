@@ -0,0 +1,30 @@
+import pytest
+
+from wellpapp.client import Client, WellpappError
+from wellpapp import testserver
+
+def test_interrupted_iteration():
+	with testserver.TestServer() as srv:
+		testserver.make_db(srv, posts=100, tags=20)
+		client = Client(srv.client_config())
+		posts = client.iter_search_post()
+		assert posts.props["result_count"] == 100
+		next(posts)
+		tags = client.find_tags("EAI", "")
+		assert tags
+		with pytest.raises(WellpappError):
+			next(posts)
+		# The client is still usable, and so is a new search.
+		assert len(list(client.iter_search_post())) == 100
+		client.close()
+
+def test_drained_iteration_ends():
+	with testserver.TestServer() as srv:
+		testserver.make_db(srv, posts=100, tags=20)
+		client = Client(srv.client_config())
+		posts = client.iter_search_post()
+		next(posts)
+		posts.drain()
+		assert list(posts) == []
+		assert len(client.find_tags("EAI", "")) > 0
+		client.close()
@@ -0,0 +1,30 @@
+import os
+
+from wellpapp.client import Client
+from wellpapp.replica import Replica
+from wellpapp import testserver
+
+def test_sync_from_other_replica(tmp_path):
+	path = str(tmp_path / "replica.sqlite")
+	with testserver.TestServer() as srv:
+		testserver.make_db(srv, posts=200, tags=30)
+		cfg = srv.client_config(str(tmp_path))
+		client = Client(cfg)
+		tag = [t for t in client.find_tags("EAI", "") if not t.valuetype][0]
+		first = Replica(path, cfg)
+		first.sync(client)
+		# Build the bitmaps, so there is something stale to keep.
+		before = [p.md5 for p in first.search_post(guids=[tag.guid])]
+		md5 = "%032x" % (1,)
+		client.add_post(md5, width=1, height=1, ext="jpg")
+		client.tag_post(md5, [tag.guid])
+		other = Replica(path, cfg)
+		other.sync(client, full=True)
+		other.close()
+		after = [p.md5 for p in first.search_post(guids=[tag.guid])]
+		assert md5 not in before
+		assert sorted(after) == sorted(before + [md5])
+		assert after == [p.md5 for p in client.search_post(guids=[tag.guid])]
+		assert first.find_tags("EN", tag.name)[0].posts == tag.posts + 1
+		first.close()
+	assert not os.path.exists(srv.path)
@@ -8,11 +8,12 @@ def main():
 	arg0 = os.path.basename(sys.argv[0])
 	argv = sys.argv[1:]
 	def usage(fh):
-		print("Usage:", arg0, "command [args]", file=fh)
+		print("Usage:", arg0, "[--stats] command [args]", file=fh)
 		print(file=fh)
 		print("Available commands:", file=fh)
 		commands = dict(
 			add='add posts',
+			bench='benchmark client internals',
 			findtag='search for tags',
 			fsck='check db',
 			fusefs='mount filesystem',
@@ -23,6 +24,8 @@ def main():
 			modtag='modify tag',
 			order='order tag',
 			replace='replace file',
+			replica='local copy of the database',
+			replay='replay a protocol trace',
 			rmalias='delete alias',
 			rmpost='delete post',
 			rotate='rotate post',
@@ -38,6 +41,11 @@ def main():
 		tmpl = '    %%-%ds  %%s' % (max(len(cmd) for cmd in commands),)
 		for cmd, desc in sorted(commands.items()):
 			print(tmpl % (cmd, desc,), file=fh)
+	if argv and argv[0] == '--stats':
+		# Summary of the server commands (on stderr) at exit
+		from wellpapp import stats
+		stats.enable()
+		argv = argv[1:]
 	if len(argv) < 1:
 		usage(sys.stderr)
 		return 1
@@ -1,8 +1,10 @@
 from base64 import b64encode, b64decode
+from collections import OrderedDict
 from functools import partial
+from time import time
 import sys
 
-__all__ = ("_uni", "_uniw", "_enc", "_dec", "_strenc", "_strdec")
+__all__ = ("_uni", "_uniw", "_enc", "_dec", "_strenc", "_strdec", "_LRU")
 
 if sys.version_info[0] > 2:
 	unicode = str
@@ -70,3 +72,40 @@ def _strdec(s):
 			res.append(u"\\")
 			res.append(part)
 	return u"".join(res)
+
+class _LRU:
+	"""Cache of at most max_size items, dropping the least recently used.
+	With a ttl items also expire that many seconds after they were set.
+	"""
+
+	def __init__(self, max_size, ttl=None):
+		assert max_size > 0
+		self.max_size = max_size
+		self.ttl = ttl
+		self._data = OrderedDict()
+
+	def get(self, key, default=None):
+		try:
+			expires, value = self._data.pop(key)
+		except KeyError:
+			return default
+		if expires is not None and expires < time():
+			return default
+		self._data[key] = (expires, value)
+		return value
+
+	def __setitem__(self, key, value):
+		expires = None if self.ttl is None else time() + self.ttl
+		self._data.pop(key, None)
+		self._data[key] = (expires, value)
+		while len(self._data) > self.max_size:
+			self._data.popitem(last=False)
+
+	def __delitem__(self, key):
+		del self._data[key]
+
+	def __len__(self):
+		return len(self._data)
+
+	def clear(self):
+		self._data.clear()
@@ -0,0 +1,155 @@
+"""asyncio version of the read side of Client (plus tag_post).
+
+Python 3 only, so this is not imported by the wellpapp package itself:
+	from wellpapp.asyncclient import AsyncClient
+"""
+
+import asyncio
+
+from wellpapp.client import Client, WellpappError, ResponseError
+from wellpapp._util import _uniw
+
+__all__ = ("AsyncClient",)
+
+class AsyncClient(Client):
+	"""Like Client, but the following methods are coroutines:
+	search_post, get_post, find_tags, tag_post, post_rels and tag_implies.
+	(Connecting and closing are too: connect() and aclose().)
+
+	Other methods that talk to the server are not available. Methods
+	that don't (thumb_path and so on) work as on Client.
+
+	Commands are sent one at a time, so concurrent calls on the same
+	AsyncClient wait for each other. Use several for parallel queries.
+	"""
+
+	# Lines with many tags can be long, don't let asyncio refuse them.
+	_stream_limit = 1 << 24
+
+	def __init__(self, cfg=None, intern_tags=False, stats=None, trace=None):
+		Client.__init__(self, cfg, intern_tags, stats=stats, trace=trace)
+		self._reader = self._writer = None
+		self._lock = None
+
+	def _reconnect(self):
+		raise WellpappError("Only the coroutine methods work on AsyncClient")
+
+	# These would call the coroutine find_tags without awaiting it.
+	def _find_tag(self, *a):
+		self._reconnect()
+
+	def parse_tag(self, *a, **kw):
+		self._reconnect()
+
+	async def connect(self):
+		if self.is_connected: return
+		if isinstance(self.server, tuple):
+			host, port = self.server
+			conn = asyncio.open_connection(host, port, limit=self._stream_limit)
+		else:
+			conn = asyncio.open_unix_connection(self.server, limit=self._stream_limit)
+		self._reader, self._writer = await conn
+		self.is_connected = True
+
+	def close(self):
+		if self._stats_tracker:
+			self._stats_tracker.reset()
+		if self.is_connected:
+			self.is_connected = False
+			self._writer.close()
+			self._reader = self._writer = None
+
+	async def aclose(self):
+		if self.is_connected:
+			writer = self._writer
+			self.close()
+			await writer.wait_closed()
+
+	async def __aenter__(self):
+		return self
+
+	async def __aexit__(self, exc_type, exc_value, traceback):
+		await self.aclose()
+
+	async def _exchange(self, cmd, parse, raw=False):
+		"""Send cmd and feed the response lines to parse until it returns True.
+		The lines are decoded unless raw.
+		"""
+		assert u"\n" not in cmd
+		if self._lock is None:
+			self._lock = asyncio.Lock()
+		async with self._lock:
+			await self.connect()
+			line = None
+			try:
+				data = cmd.encode("utf-8") + b"\n"
+				self._writer.write(data)
+				await self._writer.drain()
+				tracker = self._stats_tracker
+				if tracker:
+					tracker.sent(data)
+				trace = self._trace
+				if trace:
+					trace.sent(data)
+				while True:
+					line = await self._reader.readline()
+					if tracker:
+						tracker.received(line)
+					if trace:
+						trace.received(line)
+					if not line:
+						raise WellpappError("Connection closed by server")
+					line = line[:-1]
+					if parse(line if raw else line.decode("utf-8")):
+						break
+			except BaseException:
+				# An error line ends the response, otherwise (cancelled,
+				# or parse failed) the rest of it would be read as the
+				# response to the next command.
+				if line is None or line[:2] != b"RE":
+					self.close()
+				raise
+
+	async def _acmd(self, cmd):
+		def parse(res):
+			if res != u"OK": raise ResponseError(res)
+			return True
+		await self._exchange(cmd, parse)
+
+	async def _asearch_post(self, search, wanted=None, props=None, compact=False):
+		posts = []
+		intern = self._new_intern()
+		await self._exchange(search, lambda line: self._parse_search(line, posts, wanted, props, compact, intern), True)
+		return posts
+
+	async def get_post(self, md5, separate_implied=False, wanted=None, compact=False):
+		search, wanted = self._get_post_search(md5, separate_implied, wanted)
+		posts = await self._asearch_post(search, wanted, compact=compact)
+		return self._get_post_result(md5, posts)
+
+	async def search_post(self, wanted=None, props=None, compact=False, **kw):
+		search = u"SP" + self._build_search(wanted=wanted, **kw)
+		return await self._asearch_post(search, wanted, props, compact)
+
+	async def find_tags(self, matchtype, name, range=None, order=None, flags=None, **kw):
+		cmd = self._find_tags_cmd(matchtype, name, range, order, flags, **kw)
+		tags = []
+		await self._exchange(cmd, lambda line: not self._parse_tagres(line, tags))
+		return tags
+
+	async def tag_post(self, md5, full_tags=None, weak_tags=None, remove_tags=None):
+		for cmd in self._tag_post_cmds(md5, full_tags, weak_tags, remove_tags):
+			await self._acmd(cmd)
+
+	async def post_rels(self, md5):
+		rels = {}
+		await self._exchange(u"RS" + _uniw(md5), lambda line: self._parse_rels(line, rels))
+		if not md5 in rels: return None
+		return rels[md5]
+
+	async def tag_implies(self, tag, reverse=False):
+		tag = _uniw(tag)
+		cmd = u"IR" if reverse else u"IS"
+		data = {}
+		await self._exchange(cmd + tag, lambda line: not self._parse_implies(line, data))
+		return self._implies_result(tag, data, reverse)
@@ -0,0 +1,413 @@
+"""Benchmarks for the client side hot paths.
+
+Run as "wp bench" or "python -m wellpapp.bench" (-h for options).
+Doesn't need a server, all input is synthetic and the same every run.
+
+Each benchmark times only the work itself (best of several runs) and
+measures the peak memory allocated while doing it. Results can be
+saved as JSON and later runs compared against them:
+
+	wp bench -o baseline.json
+	(change things)
+	wp bench -b baseline.json
+
+which exits with status 1 if anything got slower (or uses more memory)
+than the tolerance allows.
+"""
+
+from __future__ import print_function
+
+import json
+import sys
+from io import BytesIO
+from random import Random
+from struct import pack
+from time import time
+
+from wellpapp.client import Client, Tag, vtparse, _vtparse
+from wellpapp.util import DotDict, ExifWrapper, MakeTIFF
+from wellpapp.vt import VTdatetime, VTgps, valuetypes
+from wellpapp._util import _enc, _dec, _strenc, _strdec
+
+try:
+	import tracemalloc
+except ImportError:
+	tracemalloc = None
+
+__all__ = ("synthetic_search_lines", "synthetic_exif", "benchmarks", "run", "compare", "main",)
+
+_guidchars = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"
+
+def _guid(rnd):
+	return "-".join("".join(rnd.choice(_guidchars) for _ in range(6)) for _ in range(4))
+
+def _md5(rnd):
+	return "%032x" % (rnd.getrandbits(128),)
+
+def synthetic_search_lines(count, tags_per_post=12, tag_count=2000, seed=1):
+	"""Search result lines (as bytes, without newline) like the server
+	sends for "SP Ftagname Ftagguid Ftagdata Fimplied Fext Fwidth
+	Fheight Fcreated", ending with the final OK.
+	"""
+	rnd = Random(seed)
+	types = ["unspecified", "character", "camera", "lens", "place"]
+	tags = []
+	for ix in range(tag_count):
+		tag = " G%s Ntag_%d_%s T%s" % (_guid(rnd), ix, _guid(rnd)[:rnd.randint(2, 12)], rnd.choice(types))
+		if ix % 10 == 0:
+			tag += " Vint=%d" % (rnd.randint(-100, 1000),)
+		elif ix % 17 == 0:
+			tag += " Vdatetime=20%02d-%02d-%02dT12:00:00Z" % (rnd.randint(0, 20), rnd.randint(1, 12), rnd.randint(1, 28))
+		tags.append(tag)
+	ext = " Gaaaaaa-aaaacr-faketg-FLekst Next Tunspecified Vword="
+	lines = []
+	for _ in range(count):
+		w, h = rnd.randint(100, 6000), rnd.randint(100, 6000)
+		created = "2%03d-%02d-%02dT%02d:%02d:%02dZ" % (rnd.randint(0, 20), rnd.randint(1, 12), rnd.randint(1, 28), rnd.randint(0, 23), rnd.randint(0, 59), rnd.randint(0, 59))
+		f = rnd.choice(("jpeg", "png", "pef", "gif"))
+		line = ["RP", _md5(rnd), " Fext=", f, " Fwidth=%x Fheight=%x Fcreated=" % (w, h), created]
+		for tag in rnd.sample(tags, tags_per_post):
+			line.append(" :" + rnd.choice(("", "", "", "~", "I", "I~")))
+			line.append(tag)
+		line += [" :D", ext, f, " :"]
+		lines.append("".join(line).encode("utf-8"))
+	lines.append(b"OK")
+	return lines
+
+def _synthetic_implies_lines(count, seed=1):
+	rnd = Random(seed)
+	lines = []
+	for ix in range(count):
+		line = ["RI", _guid(rnd)]
+		if ix % 4 == 0:
+			line.append("%sint=%d" % (rnd.choice((">", "<", "=", ">=")), rnd.randint(0, 100)))
+		for _ in range(rnd.randint(1, 4)):
+			line.append(" %s%s" % (rnd.choice("IIIi"), _guid(rnd)))
+			if rnd.random() < 0.5:
+				line.append(" P%d" % (rnd.randint(1, 20),))
+			if rnd.random() < 0.2:
+				line.append(rnd.choice((" V", " Vint=%d" % (rnd.randint(0, 100),))))
+		lines.append(u"".join(line))
+	return lines
+
+def _datetime_value(rnd):
+	d = (rnd.randint(0, 25), rnd.randint(1, 12), rnd.randint(1, 28), rnd.randint(0, 23), rnd.randint(0, 59), rnd.randint(0, 59))
+	return rnd.choice((
+		u"20%02d-%02d-%02dT%02d:%02d:%02dZ" % d,
+		u"20%02d-%02d-%02dT%02d:%02d:%02d+0200" % d,
+		u"20%02d-%02d-%02dT%02d:%02d+10M" % d[:5],
+		u"20%02d-%02d-%02dT%02d+2H" % d[:4],
+		u"20%02d-%02d-%02d" % d[:3],
+		u"20%02d-%02d" % d[:2],
+	))
+
+# Values as the user would write them, for each valuetype.
+_human_values = {
+	"string"  : lambda rnd: u"some %d words with\tspace" % (rnd.randint(0, 1000),),
+	"word"    : lambda rnd: u"word%d" % (rnd.randint(0, 1000),),
+	"int"     : lambda rnd: u"%d%s" % (rnd.randint(-5000, 5000), rnd.choice(("", "", "+10"))),
+	"uint"    : lambda rnd: u"%d%s" % (rnd.randint(0, 5000), rnd.choice(("", "", "+10"))),
+	"float"   : lambda rnd: u"%d.%02d%s" % (rnd.randint(-100, 100), rnd.randint(0, 99), rnd.choice(("", "", "+0.5"))),
+	"f-stop"  : lambda rnd: rnd.choice((u"1.4", u"2", u"2.8", u"4", u"5.6", u"8", u"11")),
+	"stop"    : lambda rnd: rnd.choice((u"100", u"200", u"400", u"800", u"1600", u"3200")),
+	"datetime": _datetime_value,
+	"gps"     : lambda rnd: u"%.5f,%.5f%s" % (rnd.uniform(-80, 80), rnd.uniform(-180, 180), rnd.choice(("", ",%d" % (rnd.randint(0, 3000),), "+-%d" % (rnd.randint(1, 500),)))),
+}
+
+def _wire_values(valuetype, count, seed=1):
+	"""count values of valuetype, formatted as the server sends them."""
+	rnd = Random(seed)
+	gen = _human_values[valuetype]
+	return [vtparse(valuetype, gen(rnd), True).format() for _ in range(count)]
+
+def synthetic_exif(jpeg=False, seed=1):
+	"""A small TIFF (or JPEG) with typical camera Exif in it, as bytes."""
+	rnd = Random(seed)
+	ifd0 = MakeTIFF()
+	ifd0.add(0x010f, (2, u"Pentax"))
+	ifd0.add(0x0110, (2, u"PENTAX K-%d" % (rnd.randint(1, 70),)))
+	ifd0.add(0x0112, (3, (rnd.choice((1, 3, 6, 8)),)))
+	exif = MakeTIFF()
+	exif.add(0x829a, (5, (1, rnd.choice((60, 125, 250, 1000)))))
+	exif.add(0x829d, (5, (rnd.randint(14, 110), 10)))
+	exif.add(0x8827, (3, (rnd.choice((100, 200, 400, 3200)),)))
+	exif.add(0x9003, (2, u"20%02d:%02d:%02d %02d:%02d:%02d" % (rnd.randint(0, 25), rnd.randint(1, 12), rnd.randint(1, 28), rnd.randint(0, 23), rnd.randint(0, 59), rnd.randint(0, 59))))
+	exif.add(0x920a, (5, (rnd.randint(100, 3000), 10)))
+	exif.add(0xa405, (3, (rnd.randint(15, 450),)))
+	exif.add(0xa434, (2, u"smc PENTAX-DA 35mm F2.4 AL"))
+	# Same layout as _rawexif in util: the Exif IFD follows IFD0.
+	offset = len(ifd0.serialize()) + 12
+	ifd0.add(0x8769, (4, (offset,)))
+	tiff = ifd0.serialize() + exif.serialize(offset - 8)[8:]
+	if not jpeg:
+		return tiff
+	app1 = b"Exif\x00\x00" + tiff
+	return b"\xFF\xD8\xFF\xE1" + pack(">H", len(app1) + 2) + app1 + b"\xFF\xDA\x00\x02" + b"\x00" * 64 + b"\xFF\xD9"
+
+def _client():
+	cfg = DotDict(server="/dev/null", image_base="/", thumb_base="/", thumb_sizes="128")
+	return Client(cfg)
+
+# Each benchmark does its setup and returns (work, items, unit),
+# where calling work() is what gets measured.
+
+def bench_parse_search(count, compact=False):
+	lines = synthetic_search_lines(count)
+	client = _client()
+	wanted = ["tagname", "tagguid", "tagdata", "datatags", "implied", "ext", "created", "width", "height"]
+	parse = client._parse_search
+	def work():
+		posts = []
+		intern = client._new_intern()
+		for line in lines:
+			parse(line, posts, wanted, None, compact, intern)
+		return posts
+	return work, count, "posts"
+
+def bench_parse_search_compact(count):
+	return bench_parse_search(count, True)
+
+def bench_populate(count):
+	lines = [line.decode("utf-8") for line in synthetic_search_lines(max(count // 12, 1))[:-1]]
+	pieces = []
+	for line in lines:
+		pieces.extend(piece.split(u" ", 1)[1] for piece in line.split(u" :")[1:-1])
+	def work():
+		for data in pieces:
+			Tag()._populate(data)
+	return work, len(pieces), "tags"
+
+def bench_parse_implies(count):
+	lines = _synthetic_implies_lines(count)
+	client = _client()
+	def work():
+		data = {}
+		for line in lines:
+			client._parse_implies(line, data)
+		return data
+	return work, count, "lines"
+
+def bench_build_search(count):
+	rnd = Random(1)
+	client = _client()
+	wanted = ["tagname", "tagguid", "tagdata", "implied", "ext", "created"]
+	args = []
+	for _ in range(count):
+		guids = [rnd.choice((u"", u"!", u"~", u"-")) + _guid(rnd) for _ in range(rnd.randint(1, 4))]
+		if rnd.random() < 0.3:
+			guids.append((_guid(rnd), rnd.choice((u"=", u">", u"<=")), vtparse("int", str(rnd.randint(0, 100)))))
+		excl = [_guid(rnd) for _ in range(rnd.randint(0, 2))]
+		range_ = rnd.choice((None, (0, 999), (_md5(rnd), 100)))
+		args.append(dict(guids=guids, excl_guids=excl, wanted=wanted, order=rnd.choice((None, "group", "-created")), range=range_))
+	def work():
+		for kw in args:
+			client._build_search(**kw)
+	return work, count, "searches"
+
+def _bench_vtparse(valuetype):
+	# The parsing itself, without the cache in vtparse.
+	def bench(count):
+		values = _wire_values(valuetype, 1000)
+		values = values * (count // len(values) or 1)
+		def work():
+			for v in values:
+				_vtparse(valuetype, v, False)
+		return work, len(values), "values"
+	return bench
+
+def bench_vtparse_cached(count):
+	# 1000 different values of each type, starting from an empty cache.
+	values = [(vt, v) for vt in sorted(valuetypes) for v in _wire_values(vt, 1000)]
+	rnd = Random(4)
+	values = [rnd.choice(values) for _ in range(count)]
+	def work():
+		vtparse.cache_clear()
+		for vt, v in values:
+			vtparse(vt, v)
+	return work, len(values), "values"
+
+def bench_datetime_init(count):
+	values = _wire_values("datetime", 1000) * (count // 1000 or 1)
+	def work():
+		for v in values:
+			VTdatetime(v)
+	return work, len(values), "values"
+
+def bench_datetime_overlap(count):
+	values = [VTdatetime(v) for v in _wire_values("datetime", 1000)]
+	pairs = list(zip(values, values[1:] + values[:1])) * (count // 1000 or 1)
+	def work():
+		for a, b in pairs:
+			a.overlap(b)
+	return work, len(pairs), "compares"
+
+def bench_gps_distance(count):
+	values = [VTgps(v) for v in _wire_values("gps", 1000)]
+	pairs = list(zip(values, values[1:] + values[:1])) * (count // 1000 or 1)
+	def work():
+		for a, b in pairs:
+			a.distance(b)
+	return work, len(pairs), "distances"
+
+def _strings(count, seed=1):
+	rnd = Random(seed)
+	chars = u"abcdefghij ABC\t\\'\"=`åäö☃\U0001f600"
+	return [u"".join(rnd.choice(chars) for _ in range(rnd.randint(4, 40))) for _ in range(count)]
+
+def bench_strenc(count):
+	strings = _strings(count)
+	def work():
+		for s in strings:
+			_strenc(s)
+	return work, count, "strings"
+
+def bench_strdec(count):
+	strings = [_strenc(s) for s in _strings(count)]
+	def work():
+		for s in strings:
+			_strdec(s)
+	return work, count, "strings"
+
+def bench_enc(count):
+	strings = _strings(count)
+	def work():
+		for s in strings:
+			_enc(s)
+	return work, count, "strings"
+
+def bench_dec(count):
+	strings = [_enc(s) for s in _strings(count)]
+	def work():
+		for s in strings:
+			_dec(s)
+	return work, count, "strings"
+
+def _bench_exif(jpeg):
+	def bench(count):
+		# ExifWrapper is much slower than the rest, so fewer of them.
+		files = [synthetic_exif(jpeg, seed) for seed in range(100)]
+		files = files * (count // 2000 or 1)
+		def work():
+			for data in files:
+				exif = ExifWrapper(BytesIO(data))
+				exif.date("Z")
+				exif.rotation()
+		return work, len(files), "files"
+	return bench
+
+benchmarks = DotDict(
+	parse_search=bench_parse_search,
+	parse_search_compact=bench_parse_search_compact,
+	populate=bench_populate,
+	parse_implies=bench_parse_implies,
+	build_search=bench_build_search,
+	vtparse_cached=bench_vtparse_cached,
+	datetime_init=bench_datetime_init,
+	datetime_overlap=bench_datetime_overlap,
+	gps_distance=bench_gps_distance,
+	strenc=bench_strenc,
+	strdec=bench_strdec,
+	enc=bench_enc,
+	dec=bench_dec,
+	exif_tiff=_bench_exif(False),
+	exif_jpeg=_bench_exif(True),
+)
+for _vt in valuetypes:
+	benchmarks["vtparse_" + _vt] = _bench_vtparse(_vt)
+del _vt
+
+def _measure(name, count, repeat):
+	work, items, unit = benchmarks[name](count)
+	best = None
+	for _ in range(repeat):
+		t0 = time()
+		work()
+		elapsed = time() - t0
+		if best is None or elapsed < best:
+			best = elapsed
+	res = DotDict(items=items, unit=unit, seconds=best, rate=items / max(best, 1e-9))
+	if tracemalloc:
+		# A separate run, tracing makes everything slower.
+		tracemalloc.start()
+		base = tracemalloc.get_traced_memory()[0]
+		work()
+		res.peak_bytes = tracemalloc.get_traced_memory()[1] - base
+		tracemalloc.stop()
+	return res
+
+def run(names=None, count=20000, repeat=3, report=None):
+	"""Run the named benchmarks (default all), returns
+	{"meta": {...}, "results": {name: {items, unit, seconds, rate, peak_bytes}}}
+	(no peak_bytes without tracemalloc).
+	report(name, result) is called as each benchmark finishes.
+	"""
+	results = {}
+	for name in names or sorted(benchmarks):
+		results[name] = _measure(name, count, repeat)
+		if report:
+			report(name, results[name])
+	meta = dict(count=count, repeat=repeat, python=sys.version.split()[0], time=int(time()))
+	return dict(meta=meta, results=results)
+
+def compare(current, baseline, tolerance=10.0):
+	"""Compare two run() results, returns [(name, what, change percent,
+	regression)], what being "rate" or "memory". Benchmarks missing from
+	either are skipped.
+	"""
+	res = []
+	for name, cur in sorted(current["results"].items()):
+		base = baseline["results"].get(name)
+		if not base: continue
+		change = (cur["rate"] / base["rate"] - 1) * 100
+		res.append((name, "rate", change, change < -tolerance))
+		if cur.get("peak_bytes") is not None and base.get("peak_bytes"):
+			change = (float(cur["peak_bytes"]) / base["peak_bytes"] - 1) * 100
+			res.append((name, "memory", change, change > tolerance))
+	return res
+
+def main(arg0, argv):
+	from argparse import ArgumentParser
+	parser = ArgumentParser(prog=arg0, description="Benchmark the client side hot paths")
+	parser.add_argument("-n", "--count", type=int, default=20000, help="size of synthetic input")
+	parser.add_argument("-r", "--repeat", type=int, default=3, help="best of this many runs")
+	parser.add_argument("-o", "--output", metavar="FILE", help="save results as JSON (- for stdout)")
+	parser.add_argument("-b", "--baseline", metavar="FILE", help="compare with results saved by -o")
+	parser.add_argument("-t", "--tolerance", type=float, default=10.0, metavar="PERCENT", help="allowed regression against baseline (default %(default)s)")
+	parser.add_argument("-l", "--list", action="store_true", help="list benchmarks")
+	parser.add_argument("name", nargs="*", help="benchmarks to run (default all)")
+	args = parser.parse_args(argv)
+	if args.list:
+		print("\n".join(sorted(benchmarks)))
+		return 0
+	for name in args.name:
+		if name not in benchmarks:
+			print("Unknown benchmark", name, file=sys.stderr)
+			return 1
+	# Keep stdout clean for the JSON
+	out = sys.stderr if args.output == "-" else sys.stdout
+	def report(name, r):
+		mem = "%10.1f kB" % (r.peak_bytes / 1024.0,) if "peak_bytes" in r else ""
+		print("%-24s %12.0f %-9s/s %s" % (name, r.rate, r.unit, mem), file=out)
+	data = run(args.name, args.count, args.repeat, report)
+	if args.output == "-":
+		json.dump(data, sys.stdout, indent=1, sort_keys=True)
+		print()
+	elif args.output:
+		with open(args.output, "w") as fh:
+			json.dump(data, fh, indent=1, sort_keys=True)
+			fh.write("\n")
+	if args.baseline:
+		with open(args.baseline) as fh:
+			baseline = json.load(fh)
+		regressions = 0
+		print(file=out)
+		for name, what, change, bad in compare(data, baseline, args.tolerance):
+			print("%-24s %-6s %+7.1f%%%s" % (name, what, change, "  REGRESSION" if bad else ""), file=out)
+			regressions += bad
+		if regressions:
+			print(regressions, "regression(s) beyond", args.tolerance, "%", file=out)
+			return 1
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main("python -m wellpapp.bench", sys.argv[1:]))
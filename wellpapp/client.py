@@ -2,30 +2,49 @@ import socket
 import os
 import hashlib
 import re
-from functools import partial
 from collections import namedtuple
+from operator import attrgetter
 import sys
+from select import select
+from threading import Condition
+from time import time
 
-from wellpapp.vt import VTdatetime, VTuint, VTint, VTnull, valuetypes
-from wellpapp._util import _uniw, _uni
+from wellpapp.vt import VTnull, valuetypes
+from wellpapp._util import _uniw, _uni, _LRU
 from wellpapp.util import DotDict, CommentWrapper, make_pdirs, RawWrapper
+from wellpapp import stats as _stats
+from wellpapp import trace as _trace
 
-__all__ = ("Client", "Config", "Post", "Tag", "WellpappError", "ResponseError",
-           "DuplicateError", "InheritValue", "ImplicationTuple", "vtparse",
+__all__ = ("Client", "ClientPool", "Config", "Post", "Tag", "CompactPost", "CompactTag", "SearchCursor",
+           "WellpappError", "ResponseError",
+           "DuplicateError", "PipelineError", "InheritValue", "ImplicationTuple",
+           "vtparse",
           )
 
 if sys.version_info[0] > 2:
 	basestring = (bytes, str)
 	def itervalues(d):
 		return iter(d.values())
+	def _ascii(b):
+		return b.decode("ascii")
 else:
 	def itervalues(d):
 		return d.itervalues()
+	_ascii = str
 
 class WellpappError(Exception): pass
 class ResponseError(WellpappError): pass
 class DuplicateError(WellpappError): pass
 
+class PipelineError(WellpappError):
+	"""Some commands in a pipeline failed.
+	.errors is a list of (command, response) in the order they were sent.
+	"""
+
+	def __init__(self, errors):
+		WellpappError.__init__(self, "%d pipelined command(s) failed, first: %s -> %s" % ((len(errors),) + errors[0]))
+		self.errors = errors
+
 class InheritValue:
 	def __str__(self):
 		return "<InheritValue>"
@@ -49,39 +68,44 @@ class Post(DotDict): pass
 
 class Tag(DotDict):
 	def _populate(self, res, flags=""):
-		res = res.split()
+		# This runs for every tag in every search result, so it avoids
+		# attribute access (DotDict.__getattr__ is slow) and temporaries.
 		alias = []
 		flaglist = []
-		hexint = partial(int, base=16)
-		dummy = lambda s: s
-		incl = {u"N": ("name", dummy),
-		        u"T": ("type", dummy),
-		        u"A": ("alias", alias.append),
-		        u"P": ("posts", hexint),
-		        u"W": ("weak_posts", hexint),
-		        u"F": ("flags", flaglist.append),
-		        u"G": ("guid", str),
-		        u"V": ("valuetype", str),
-		       }
-		for data in res:
-			if data[0] in incl:
-				name, parser = incl[data[0]]
-				self[name] = parser(data[1:])
-		self.alias = alias
-		if flaglist:
-			del self.flags
-			for flag in flaglist:
-				self[flag] = True
-		vt = (self.valuetype or "").split("=", 1)
-		if len(vt) == 2:
-			self.valuetype = vt[0]
-			self.value = vtparse(*vt)
+		for data in res.split():
+			c = data[0]
+			if c == u"G":
+				self["guid"] = str(data[1:])
+			elif c == u"N":
+				self["name"] = data[1:]
+			elif c == u"T":
+				self["type"] = data[1:]
+			elif c == u"V":
+				self["valuetype"] = str(data[1:])
+			elif c == u"P":
+				self["posts"] = int(data[1:], 16)
+			elif c == u"W":
+				self["weak_posts"] = int(data[1:], 16)
+			elif c == u"A":
+				alias.append(data[1:])
+			elif c == u"F":
+				flaglist.append(data[1:])
+		self["alias"] = alias
+		for flag in flaglist:
+			self[flag] = True
+		vt = self.get("valuetype")
+		if vt and u"=" in vt:
+			vt, value = vt.split(u"=", 1)
+			self["valuetype"] = vt
+			self["value"] = vtparse(vt, value)
+		name = self.get("name")
+		guid = self.get("guid")
 		if u"~" in flags:
-			if self.name: self.pname = u"~" + self.name
-			if self.guid: self.pguid = "~" + self.guid
+			if name: self["pname"] = u"~" + name
+			if guid: self["pguid"] = "~" + guid
 		else:
-			if self.name: self.pname = self.name
-			if self.guid: self.pguid = self.guid
+			if name: self["pname"] = name
+			if guid: self["pguid"] = guid
 
 _nonetag = Tag()
 
@@ -133,7 +157,343 @@ class TagDict(dict):
 		"""
 		return dict.get(self, key, default)
 
-def vtparse(vtype, val, human=False):
+# Tag kinds in CompactPosts, in the order the tags TagDict gets them.
+_K_FULL, _K_WEAK, _K_IMPLFULL, _K_IMPLWEAK, _K_DATA = range(5)
+
+_TagMeta = namedtuple("_TagMeta", "name guid type valuetype alias posts weak_posts flags")
+
+def _parse_tag_meta(res):
+	"""Like Tag._populate, but gives (_TagMeta, value)."""
+	name = guid = type = valuetype = posts = weak_posts = value = None
+	alias = []
+	flags = []
+	for data in res.split():
+		c = data[0]
+		if c == u"G":
+			guid = str(data[1:])
+		elif c == u"N":
+			name = data[1:]
+		elif c == u"T":
+			type = data[1:]
+		elif c == u"V":
+			valuetype = str(data[1:])
+		elif c == u"P":
+			posts = int(data[1:], 16)
+		elif c == u"W":
+			weak_posts = int(data[1:], 16)
+		elif c == u"A":
+			alias.append(data[1:])
+		elif c == u"F":
+			flags.append(data[1:])
+	if valuetype and u"=" in valuetype:
+		valuetype, value = valuetype.split(u"=", 1)
+		value = vtparse(valuetype, value)
+	meta = _TagMeta(name, guid, type, valuetype, tuple(alias), posts, weak_posts, tuple(flags))
+	return meta, value
+
+class CompactTag(object):
+	"""A tag on a CompactPost. Reads like a Tag (t.name, t["guid"],
+	t.get("value"), t.ordered), but can't be modified.
+	Use to_tag() if you need a real Tag.
+	"""
+
+	__slots__ = ("_meta", "_kind", "value")
+
+	def __init__(self, meta, kind, value=None):
+		self._meta = meta
+		self._kind = kind
+		self.value = value
+
+	name = property(lambda self: self._meta.name)
+	guid = property(lambda self: self._meta.guid)
+	type = property(lambda self: self._meta.type)
+	valuetype = property(lambda self: self._meta.valuetype)
+	alias = property(lambda self: list(self._meta.alias))
+	posts = property(lambda self: self._meta.posts)
+	weak_posts = property(lambda self: self._meta.weak_posts)
+
+	@property
+	def pname(self):
+		name = self._meta.name
+		if name and self._kind in (_K_WEAK, _K_IMPLWEAK):
+			return u"~" + name
+		return name
+
+	@property
+	def pguid(self):
+		guid = self._meta.guid
+		if guid and self._kind in (_K_WEAK, _K_IMPLWEAK):
+			return "~" + guid
+		return guid
+
+	def __getattr__(self, name):
+		# Only reached for flags and things a Tag wouldn't have either.
+		if name[0] == "_":
+			raise AttributeError(name)
+		if name in self._meta.flags: return True
+
+	def keys(self):
+		k = [n for n in ("guid", "name", "type", "valuetype") if getattr(self, n) is not None]
+		k.append("alias")
+		k.extend(self._meta.flags)
+		for n in ("posts", "weak_posts", "value", "pname", "pguid"):
+			if getattr(self, n) is not None: k.append(n)
+		return k
+
+	def get(self, key, default=None):
+		value = getattr(self, key, None)
+		if value is None: return default
+		return value
+
+	def __getitem__(self, key):
+		value = getattr(self, key, None)
+		if value is None: raise KeyError(key)
+		return value
+
+	def __contains__(self, key):
+		return getattr(self, key, None) is not None
+
+	def __iter__(self):
+		return iter(self.keys())
+
+	def __len__(self):
+		return len(self.keys())
+
+	def to_tag(self):
+		t = Tag()
+		for k in self.keys():
+			t[k] = self[k]
+		return t
+
+	def __repr__(self):
+		return repr(type(self)) + repr(self.to_tag())
+
+class _TagView(object):
+	"""The TagDict API (minus modification) over some of the tags in a
+	CompactPost. Lookups are linear, which is fine for normal posts.
+	The TagDict for names, guids and iterating is made on first use.
+	"""
+
+	__slots__ = ("_tags", "_kinds", "_prefixed", "_td")
+
+	def __init__(self, tags, kinds, prefixed):
+		self._tags = tags
+		self._kinds = kinds
+		self._prefixed = prefixed
+		self._td = None
+
+	def _iter_all(self):
+		kinds = self._kinds
+		return (t for t in self._tags if t._kind in kinds)
+
+	def _keys(self, tag):
+		if self._prefixed:
+			return tag.pname, tag.pguid
+		return tag._meta.name, tag._meta.guid
+
+	def _tagdict(self):
+		td = self._td
+		if td is None:
+			td = TagDict()
+			for tag in self._iter_all():
+				td._add(tag, *self._keys(tag))
+			self._td = td
+		return td
+
+	@property
+	def names(self):
+		return self._tagdict().names
+
+	@property
+	def guids(self):
+		return self._tagdict().guids
+
+	def get(self, key, default=_nonetag):
+		by_name = None
+		by_guid = None
+		for tag in self._iter_all():
+			name, guid = self._keys(tag)
+			if guid == key:
+				by_guid = tag
+			elif name == key and by_name is None:
+				by_name = tag
+		if by_guid is not None: return by_guid
+		if by_name is not None: return by_name
+		return default
+
+	def __getitem__(self, key):
+		tag = self.get(key, None)
+		if tag is None: raise KeyError(key)
+		return tag
+
+	def __contains__(self, key):
+		return self.get(key, None) is not None
+
+	def __iter__(self):
+		return iter(self._tagdict())
+
+	itervalues = __iter__
+
+	def values(self):
+		return self._tagdict().values()
+
+	def keys(self):
+		return self._tagdict().keys()
+
+	def items(self):
+		return self._tagdict().items()
+
+	def __len__(self):
+		return len(self._tagdict())
+
+	def __bool__(self):
+		return any(True for _ in self._iter_all())
+	__nonzero__ = __bool__
+
+_tagviews = {
+	"fulltags"    : ((_K_FULL,), False),
+	"weaktags"    : ((_K_WEAK,), False),
+	"implfulltags": ((_K_IMPLFULL,), False),
+	"implweaktags": ((_K_IMPLWEAK,), False),
+	"datatags"    : ((_K_DATA,), False),
+	"settags"     : ((_K_FULL, _K_WEAK), True),
+	"impltags"    : ((_K_IMPLFULL, _K_IMPLWEAK), True),
+	"tags"        : ((_K_FULL, _K_WEAK, _K_IMPLFULL, _K_IMPLWEAK, _K_DATA), True),
+}
+
+class CompactPost(DotDict):
+	"""What searches give you with compact=True.
+	Holds all tags in one tuple of CompactTags, and .tags, .fulltags and
+	the other tag lists are views over that. They work like the TagDicts
+	in a Post, except they can't be modified and aren't dicts.
+	(All the lists are always there, a Post only has some of them
+	depending on wanted.)
+	The other fields are in the dict as usual, so Post(post) gives you
+	a Post without tags.
+	"""
+
+	__slots__ = ("_tags", "_views")
+
+	def __init__(self, *a, **kw):
+		DotDict.__init__(self, *a, **kw)
+		self._tags = ()
+
+	def __setattr__(self, name, value):
+		if name == "_tags":
+			object.__setattr__(self, "_views", None)
+			object.__setattr__(self, name, value)
+		else:
+			self[name] = value
+
+	def __getstate__(self):
+		# The views are just a cache.
+		return None, {"_tags": self._tags}
+
+	def _view(self, key):
+		"""The _TagView for key, kept so its TagDict is only made once."""
+		views = self._views
+		if views is None:
+			views = {}
+			object.__setattr__(self, "_views", views)
+		view = views.get(key)
+		if view is None:
+			view = views[key] = _TagView(self._tags, *_tagviews[key])
+		return view
+
+	def get(self, key, default=None):
+		if key in _tagviews:
+			return self._view(key)
+		return dict.get(self, key, default)
+
+	def __getitem__(self, key):
+		if key in _tagviews:
+			return self._view(key)
+		return dict.__getitem__(self, key)
+
+def _copy_tag(tag):
+	"""A Tag that can be modified without affecting tag."""
+	tag = Tag(tag)
+	if "alias" in tag:
+		tag["alias"] = list(tag["alias"])
+	return tag
+
+class _TagIntern:
+	"""Parsed tags from search results, keyed on the raw tag data.
+	Popular tags show up on lots of posts, and parsing them once is
+	faster and (for compact posts) shares the metadata between posts.
+	The key is everything the server sent about the tag, so a renamed
+	tag just gets a new entry and nothing needs invalidating.
+	"""
+
+	def __init__(self, max_size=None):
+		self.max_size = max_size
+		self.clear()
+
+	def clear(self):
+		self._tags = {}
+		self._compact = {}
+		self._metas = {}
+
+	def _make_room(self, d):
+		if self.max_size and len(d) >= self.max_size:
+			self.clear()
+
+	def tag(self, data, weak):
+		"""A new Tag (callers are allowed to modify it) for data."""
+		tag = self._tags.get(data)
+		if tag is None:
+			self._make_room(self._tags)
+			tag = Tag()
+			tag._populate(data.decode("utf-8"))
+			self._tags[data] = tag
+		tag = _copy_tag(tag)
+		if weak:
+			name = tag.get("name")
+			guid = tag.get("guid")
+			if name: tag["pname"] = u"~" + name
+			if guid: tag["pguid"] = "~" + guid
+		return tag
+
+	def compact(self, data):
+		"""(meta, value) for a CompactTag, with the meta shared."""
+		res = self._compact.get(data)
+		if res is None:
+			self._make_room(self._compact)
+			meta, value = _parse_tag_meta(data.decode("utf-8"))
+			meta = self._metas.setdefault(meta, meta)
+			res = self._compact[data] = (meta, value)
+		return res
+
+class _ValueCache:
+	"""Parsed values, keyed on (valuetype, string, human). ValueTypes
+	are immutable, so the same one can be handed out any number of
+	times. Values repeat a lot (extensions, camera settings, popular
+	dates) and some (datetimes) are slow to parse.
+	Cleared when it reaches max_size, 0 disables it.
+	"""
+
+	def __init__(self, max_size):
+		self.max_size = max_size
+		self.clear()
+
+	def clear(self):
+		self._data = {}
+		self.hits = self.misses = 0
+
+	def info(self):
+		"""DotDict with hits, misses, hit_rate, size and max_size."""
+		lookups = self.hits + self.misses
+		return DotDict(
+			hits=self.hits,
+			misses=self.misses,
+			hit_rate=self.hits / float(lookups) if lookups else 0.0,
+			size=len(self._data),
+			max_size=self.max_size,
+		)
+
+_value_cache = _ValueCache(65536)
+
+def _vtparse(vtype, val, human):
 	try:
 		return valuetypes[vtype](val, human)
 	except ValueError:
@@ -141,12 +501,36 @@ def vtparse(vtype, val, human=False):
 			return VTnull()
 		raise
 
+def vtparse(vtype, val, human=False):
+	"""Parse val as a vtype. The result may be shared with other callers
+	(see vtparse.cache_info() and vtparse.cache_clear()).
+	"""
+	cache = _value_cache
+	if not cache.max_size:
+		return _vtparse(vtype, val, human)
+	key = (vtype, val, human)
+	try:
+		res = cache._data.get(key)
+	except TypeError: # unhashable val
+		return _vtparse(vtype, val, human)
+	if res is not None:
+		cache.hits += 1
+		return res
+	cache.misses += 1
+	res = _vtparse(vtype, val, human)
+	if len(cache._data) >= cache.max_size:
+		cache._data.clear()
+	cache._data[key] = res
+	return res
+vtparse.cache_info = _value_cache.info
+vtparse.cache_clear = _value_cache.clear
+
 _field_sparser = {
-	"created"        : VTdatetime,
-	"imgdate"        : VTdatetime,
-	"width"          : VTuint,
-	"height"         : VTuint,
-	"rotate"         : VTint,
+	"created"        : "datetime",
+	"imgdate"        : "datetime",
+	"width"          : "uint",
+	"height"         : "uint",
+	"rotate"         : "int",
 }
 
 _p_int = lambda i: str(int(i))
@@ -208,6 +592,291 @@ class Config(DotDict):
 				assert(len(a) == 2)
 				self[a[0]] = a[1]
 
+class _Pipeline:
+	"""Queues commands that only answer OK, and sends them in batches.
+	Use as a context manager (from Client.pipeline()). Errors are collected
+	and raised as a PipelineError when leaving the context.
+	If the connection fails the error is raised as it is, and nothing is
+	sent again, since the server may already have run some of the batch.
+	"""
+
+	def __init__(self, client, batch_bytes):
+		self._client = client
+		self._batch_bytes = batch_bytes
+		self._queue = []
+		self._queued_bytes = 0
+		self.errors = []
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		if exc_type is not None:
+			# Don't carry on with what was queued after something failed.
+			self._queue = []
+			self._queued_bytes = 0
+		try:
+			self.flush()
+		finally:
+			self._client._pipeline = None
+		if self.errors and exc_type is None:
+			raise PipelineError(self.errors)
+
+	def _add(self, cmd):
+		assert u"\n" not in cmd
+		line = cmd.encode("utf-8") + b"\n"
+		self._queue.append((cmd, line))
+		self._queued_bytes += len(line)
+		if self._queued_bytes >= self._batch_bytes:
+			self.flush()
+
+	def flush(self):
+		"""Send everything queued and read all the responses."""
+		queue = self._queue
+		if not queue: return
+		self._queue = []
+		self._queued_bytes = 0
+		client = self._client
+		client._send(b"".join(line for cmd, line in queue), retry=False)
+		try:
+			for cmd, line in queue:
+				res = client._readline()
+				if res != u"OK":
+					self.errors.append((cmd, res))
+		except BaseException:
+			# Whatever is left of the responses would be read as the
+			# responses to later commands.
+			client.close()
+			raise
+
+class _SearchIterator:
+	"""Iterates over the posts from a search as they arrive.
+
+	.props gets result_count (and first_result) as soon as the server
+	sends them, which is before the first post.
+
+	If you stop early the rest of the response still has to be dealt
+	with before the connection can be used again. Either drain() it
+	(reads and discards it) or abandon() it (closes the connection).
+	Leaving a with-block drains (abandon if there was an exception).
+	Using the client for something else drains too, but then the
+	iterator raises WellpappError instead of ending early, so the
+	posts that were thrown away aren't silently missing.
+	"""
+
+	def __init__(self, client, wanted, props, compact=False):
+		self._client = client
+		self._wanted = wanted
+		self._compact = compact
+		self._intern = client._new_intern()
+		self.props = {} if props is None else props
+		self._next = None
+		self.done = False
+		self.interrupted = False
+		client._active_search = self
+		# Read until we know the count, or until the first post if
+		# the server didn't send one.
+		while not self.done and self._next is None and "result_count" not in self.props:
+			self._next = self._read()
+
+	def _finish(self):
+		self.done = True
+		if self._client._active_search is self:
+			self._client._active_search = None
+
+	def _read(self):
+		client = self._client
+		line = client._readline_raw()
+		posts = []
+		try:
+			if client._parse_search(line, posts, self._wanted, self.props, self._compact, self._intern):
+				self._finish()
+		except Exception:
+			if line[:2] == b"RE":
+				self._finish()
+			else:
+				# Don't know where we are in the response any more.
+				self.abandon()
+			raise
+		if posts: return posts[0]
+
+	def __iter__(self):
+		return self
+
+	def __next__(self):
+		if self.interrupted:
+			raise WellpappError("Search interrupted by another command on the same client")
+		post = self._next
+		if post is not None:
+			self._next = None
+			return post
+		while not self.done:
+			post = self._read()
+			if post is not None:
+				return post
+		raise StopIteration()
+	next = __next__
+
+	def drain(self):
+		"""Read and discard the rest of the response."""
+		self._next = None
+		while not self.done:
+			self._read()
+
+	def interrupt(self):
+		"""drain(), and make further iteration an error.
+		The client calls this when it needs the connection.
+		"""
+		if not self.done:
+			self.drain()
+			self.interrupted = True
+
+	def abandon(self):
+		"""Close the connection instead of reading the rest."""
+		self._next = None
+		if not self.done:
+			self._finish()
+			self._client.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		if exc_type is None:
+			self.drain()
+		else:
+			self.abandon()
+
+class SearchCursor:
+	"""Walks through all posts a search finds, page_size at a time, so
+	memory use stays bounded however many posts there are.
+	Get one from Client.search_cursor, then iterate over it for posts
+	or call next_page() for lists of them.
+
+	.total is the number of results the server reported for the first
+	page, which is fetched when the cursor is created.
+
+	Pages after the first are anchored on the last post seen (with an
+	RM<md5> range), so posts getting (un)tagged while you walk don't
+	make it skip or repeat posts the way numeric ranges would. If the
+	anchor post disappears it falls back to a numeric range.
+
+	With prefetch the next page is requested as soon as a page has been
+	returned, so the server works on it while you deal with the current
+	one. If you use the client for something else in between, that
+	page is read (and kept) first.
+	"""
+
+	def __init__(self, client, wanted, page_size, compact, prefetch, kw):
+		assert page_size > 0
+		assert "range" not in kw
+		self._client = client
+		self._wanted = wanted
+		self._compact = compact
+		self._kw = kw
+		self.page_size = page_size
+		self.prefetch = prefetch
+		self.done = False
+		self._anchor = None
+		self._pos = 0
+		self._sent = False
+		self._send()
+		self._buffer = self._receive()
+		self.total = self._buffer[1].get("result_count")
+
+	def _send(self):
+		if self._anchor is None:
+			range = (self._pos, self._pos + self.page_size - 1)
+		else:
+			range = (self._anchor, self.page_size + 1)
+		client = self._client
+		client._writeline(u"SP" + client._build_search(wanted=self._wanted, range=range, **self._kw))
+		client._active_search = self
+		self._sent = True
+
+	def _receive(self):
+		client = self._client
+		if client._active_search is self:
+			client._active_search = None
+		self._sent = False
+		props = {}
+		try:
+			posts = list(_SearchIterator(client, self._wanted, props, self._compact))
+		except ResponseError:
+			if self._anchor is None: raise
+			# The anchor post is gone (or no longer matches).
+			self._anchor = None
+			self._send()
+			return self._receive()
+		return posts, props
+
+	def next_page(self):
+		"""The next page of posts, or an empty list at the end."""
+		if self.done: return []
+		if self._buffer is not None:
+			(posts, props), self._buffer = self._buffer, None
+		else:
+			if not self._sent:
+				self._send()
+			posts, props = self._receive()
+		expected = self.page_size
+		if self._anchor is not None:
+			expected += 1
+		if len(posts) < expected:
+			self.done = True
+		if posts and posts[0].md5 == self._anchor:
+			posts = posts[1:]
+		if posts:
+			self._anchor = posts[-1].md5
+		self._pos += len(posts)
+		if self.prefetch and not self.done:
+			self._send()
+		return posts
+
+	def __iter__(self):
+		while True:
+			page = self.next_page()
+			if not page and self.done: return
+			for post in page:
+				yield post
+
+	# The client calls these (as for _SearchIterator) when it needs the
+	# connection while a page is outstanding.
+
+	def drain(self):
+		if self._sent:
+			self._buffer = self._receive()
+
+	# Nothing is lost, the page is kept.
+	interrupt = drain
+
+	def _finish(self):
+		# Connection closed, just ask again.
+		self._sent = False
+		if self._client._active_search is self:
+			self._client._active_search = None
+
+	def abandon(self):
+		if self._sent:
+			self._finish()
+			self._client.close()
+
+	def close(self):
+		"""Stop early (reads the prefetched page, if any)."""
+		self.drain()
+		self._buffer = None
+		self.done = True
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		if exc_type is None:
+			self.close()
+		else:
+			self.abandon()
+			self.done = True
+
 class _Transaction_Ctx:
 	def __init__(self, client):
 		self._client = client
@@ -222,7 +891,29 @@ class _Transaction_Ctx:
 class Client:
 	_prot_max_len = 4096
 
-	def __init__(self, cfg=None):
+	# Max size of the tag intern table with intern_tags=True
+	intern_size = 65536
+
+	def __init__(self, cfg=None, intern_tags=False, tag_cache=0, tag_cache_ttl=60, stats=None, trace=None):
+		"""intern_tags=True keeps parsed tags from search results around
+		between searches (instead of just within each search).
+
+		With tag_cache, find_tag, get_tag and parse_tag remember up to
+		that many found tags for tag_cache_ttl seconds (None for no
+		limit). Tags that weren't found are always looked up again, so
+		new tags show up at once. Changing tags through this client
+		forgets them all, but changes from other clients (renames,
+		aliases, post counts) are only seen when the lookups expire (or
+		after invalidate()), so the tags can be that stale. Meant for
+		batch jobs that look up the same tags over and over.
+
+		stats is a wellpapp.stats.Stats to record commands in. (If not
+		set, WELLPAPP_STATS in the environment can enable it.)
+
+		trace is a wellpapp.trace.Trace to record all commands and
+		responses in. (WELLPAPP_TRACE in the environment works here too,
+		unless trace is False.)
+		"""
 		if not cfg:
 			cfg = Config()
 		self.cfg = cfg
@@ -238,8 +929,33 @@ class Client:
 		base = re.escape(base)
 		self._destmd5re = re.compile(r"^" + base + r"/[0-9a-f]/[0-9a-f]{2}/([0-9a-f]{32})$")
 		self._transaction_ctx = _Transaction_Ctx(self)
+		self._pipeline = None
+		self._active_search = None
+		self._tag_intern = _TagIntern(self.intern_size) if intern_tags else None
+		self._tag_cache = _LRU(tag_cache, tag_cache_ttl) if tag_cache else None
+		if stats is None:
+			stats = _stats._from_env()
+		self.stats = stats
+		self._stats_tracker = None if stats is None else _stats._Tracker(stats)
+		if trace is None:
+			trace = _trace._from_env()
+		self._trace = trace.connection() if trace else None
+
+	def invalidate(self):
+		"""Forget cached tag lookups."""
+		if self._tag_cache is not None:
+			self._tag_cache.clear()
+
+	def _new_intern(self):
+		if self._tag_intern is not None:
+			return self._tag_intern
+		return _TagIntern()
 
 	def close(self):
+		if self._active_search:
+			self._active_search._finish()
+		if self._stats_tracker:
+			self._stats_tracker.reset()
 		if self.is_connected:
 			self.is_connected = False
 			self._fh.close()
@@ -263,123 +979,192 @@ class Client:
 		self._fh = self._sock.makefile('rb')
 		self.is_connected = True
 
-	def _writeline(self, line, retry=True):
-		assert u"\n" not in line
+	def _send(self, data, retry=True):
+		if self._active_search:
+			self._active_search.interrupt()
 		self._reconnect()
-		line = line.encode("utf-8") + b"\n"
 		try:
-			self._sock.sendall(line)
+			self._sock.sendall(data)
 		except IOError:
 			self.close()
-			if retry:
-				self._reconnect()
-				self._sock.sendall(line)
+			if not retry: raise
+			self._reconnect()
+			self._sock.sendall(data)
+		if self._stats_tracker:
+			self._stats_tracker.sent(data)
+		if self._trace:
+			self._trace.sent(data)
+
+	def _writeline(self, line, retry=True):
+		assert u"\n" not in line
+		if self._pipeline:
+			self._pipeline.flush()
+		self._send(line.encode("utf-8") + b"\n", retry)
+
+	def _readline_raw(self):
+		line = self._fh.readline()
+		if self._stats_tracker:
+			self._stats_tracker.received(line)
+		if self._trace:
+			self._trace.received(line)
+		return line[:-1]
 
 	def _readline(self):
-		return self._fh.readline()[:-1].decode("utf-8")
+		return self._readline_raw().decode("utf-8")
 
-	def _parse_search(self, line, posts, wanted, props):
-		if line == u"OK": return True
-		if line[0] != u"R": raise ResponseError(line)
-		if line[1] == u"E": raise ResponseError(line)
-		if line[1] == u"R":
+	def _cmd(self, cmd):
+		"""Send a command that answers only OK (or an error).
+		Queued instead if there is an active pipeline."""
+		if self._pipeline:
+			self._pipeline._add(cmd)
+			return
+		self._writeline(cmd)
+		res = self._readline()
+		if res != u"OK": raise ResponseError(res)
+
+	def pipeline(self, batch_bytes=65536):
+		"""Context manager that queues modifying commands (tag_post,
+		add_post and so on) and sends them batch_bytes at a time instead
+		of waiting for each response. Any other command flushes the queue
+		first, so the order is still the order you called things in.
+
+		Raises PipelineError when leaving the context if any command
+		failed, with all the failures in .errors. If the with block
+		raises, the commands still queued are dropped (but batches that
+		were already sent stay done).
+		"""
+		assert not self._pipeline, "Already in a pipeline"
+		self._pipeline = _Pipeline(self, batch_bytes)
+		return self._pipeline
+
+	def _parse_search(self, line, posts, wanted, props, compact=False, intern=None):
+		# line is bytes here, unlike the other parsers. Tags that were not
+		# wanted (datatags are always sent) are skipped without decoding.
+		# intern is a _TagIntern, use the same one for the whole search.
+		if line == b"OK": return True
+		if line[:1] != b"R" or line[1:2] == b"E": raise ResponseError(_uni(line))
+		if line[1:2] == b"R":
 			if props != None:
-				a = line[2:].split(':')
+				a = line[2:].split(b":")
 				props["result_count"] = int(a[0], 16)
 				if len(a) > 1:
 					props["first_result"] = int(a[1], 16)
 			return
-		f = Post()
-		seen = set()
-		pieces = line[1:].split(u" :")
+		f = CompactPost() if compact else Post()
+		pieces = line[1:].split(b" :")
 		for token in pieces[0].split():
-			type = token[0]
-			data = token[1:]
-			if type == u"P":
-				f.md5 = str(data)
-			elif type == u"F":
-				field, value = data.split(u"=", 1)
-				field = str(field)
+			type = token[:1]
+			if type == b"P":
+				f["md5"] = _ascii(token[1:])
+			elif type == b"F":
+				field, value = token[1:].split(b"=", 1)
+				field = _ascii(field)
+				value = value.decode("utf-8")
 				if field in _field_sparser:
-					f[field] = _field_sparser[field](value)
+					f[field] = vtparse(_field_sparser[field], value)
 				else:
 					f[field] = value
 			else:
-				raise ResponseError(line)
-		f.fulltags = TagDict()
-		f.weaktags = TagDict()
-		f.implfulltags = TagDict()
-		f.implweaktags = TagDict()
-		f.datatags = TagDict()
+				raise ResponseError(_uni(line))
+		if not f.get("md5"): raise ResponseError(_uni(line))
+		if intern is None:
+			intern = self._new_intern()
+		want_implied = wanted and "implied" in wanted
+		want_data = wanted and "datatags" in wanted
+		if compact:
+			self._parse_compact_tags(f, pieces[1:-1], want_implied, want_data, intern)
+			posts.append(f)
+			return
+		f["fulltags"] = fulltags = TagDict()
+		f["weaktags"] = weaktags = TagDict()
+		tagdicts = [fulltags, weaktags]
+		if want_implied:
+			f["implfulltags"] = implfulltags = TagDict()
+			f["implweaktags"] = implweaktags = TagDict()
+			tagdicts += [implfulltags, implweaktags]
+		if want_data:
+			f["datatags"] = datatags = TagDict()
+			tagdicts.append(datatags)
 		for piece in pieces[1:-1]:
-			flags, data = piece.split(u" ", 1)
-			if u"I" in flags and u"~" in flags:
-				ta = f.implweaktags
-			elif u"I" in flags:
-				ta = f.implfulltags
-			elif u"~" in flags:
-				ta = f.weaktags
-			elif u"D" in flags:
-				ta = f.datatags
+			flags, data = piece.split(b" ", 1)
+			weak = b"~" in flags
+			if b"I" in flags:
+				if not want_implied: continue
+				ta = implweaktags if weak else implfulltags
+			elif weak:
+				ta = weaktags
+			elif b"D" in flags:
+				if not want_data: continue
+				ta = datatags
 			else:
-				ta = f.fulltags
-			t = Tag()
-			t._populate(data, flags)
-			ta._add(t, t.name, t.guid)
-		if not f.md5: raise ResponseError(line)
-		if f.md5 in seen: raise DuplicateError(f.md5)
-		seen.add(f.md5)
-		tagdicts = [f.fulltags, f.weaktags]
-		if wanted and "implied" in wanted:
-			settags = TagDict()
-			for td in tagdicts:
+				ta = fulltags
+			t = intern.tag(data, weak)
+			ta._add(t, t.get("name"), t.get("guid"))
+		if want_implied:
+			f["settags"] = settags = TagDict()
+			for td in tagdicts[:2]:
 				for tag in td:
-					settags._add(tag, tag.pname, tag.pguid)
-			idicts = [f.implfulltags, f.implweaktags]
-			tagdicts += idicts
-			impltags = TagDict()
-			for td in idicts:
+					settags._add(tag, tag.get("pname"), tag.get("pguid"))
+			f["impltags"] = impltags = TagDict()
+			for td in tagdicts[2:4]:
 				for tag in td:
-					impltags._add(tag, tag.pname, tag.pguid)
-			f.settags = settags
-			f.impltags = impltags
-		else:
-			del f.implfulltags
-			del f.implweaktags
-		if not wanted or "datatags" not in wanted:
-			del f.datatags
-		else:
-			tagdicts.append(f.datatags)
-		alltags = TagDict()
+					impltags._add(tag, tag.get("pname"), tag.get("pguid"))
+		f["tags"] = alltags = TagDict()
 		for td in tagdicts:
 			for tag in td:
-				alltags._add(tag, tag.pname, tag.pguid)
-		f.tags = alltags
+				alltags._add(tag, tag.get("pname"), tag.get("pguid"))
 		posts.append(f)
 
-	def _search_post(self, search, wanted=None, props=None):
+	def _parse_compact_tags(self, post, pieces, want_implied, want_data, intern):
+		tags = []
+		for piece in pieces:
+			flags, data = piece.split(b" ", 1)
+			weak = b"~" in flags
+			if b"I" in flags:
+				if not want_implied: continue
+				kind = _K_IMPLWEAK if weak else _K_IMPLFULL
+			elif weak:
+				kind = _K_WEAK
+			elif b"D" in flags:
+				if not want_data: continue
+				kind = _K_DATA
+			else:
+				kind = _K_FULL
+			meta, value = intern.compact(data)
+			tags.append(CompactTag(meta, kind, value))
+		# Same order as the tags TagDict in a normal Post gets.
+		tags.sort(key=attrgetter("_kind"))
+		post._tags = tuple(tags)
+
+	def _iter_search(self, search, wanted=None, props=None, compact=False):
 		self._writeline(search)
-		posts = []
-		while not self._parse_search(self._readline(), posts, wanted, props): pass
-		return posts
+		return _SearchIterator(self, wanted, props, compact)
 
-	def get_post(self, md5, separate_implied=False, wanted=None):
+	def _search_post(self, search, wanted=None, props=None, compact=False):
+		return list(self._iter_search(search, wanted, props, compact))
+
+	def _get_post_search(self, md5, separate_implied, wanted):
 		if wanted is None:
 			wanted = ["tagname", "tagguid", "tagdata", "datatags", "ext", "created", "width", "height"]
 		if separate_implied and "implied" not in wanted:
 			wanted = ["implied"] + wanted
 		search = u"SPM" + _uniw(md5) + " F".join([""] + self._filter_wanted(wanted))
-		posts = self._search_post(search, wanted)
+		return search, wanted
+
+	def _get_post_result(self, md5, posts):
 		if not posts: return None
 		assert posts[0].md5 == md5
 		return posts[0]
 
+	def get_post(self, md5, separate_implied=False, wanted=None, compact=False):
+		search, wanted = self._get_post_search(md5, separate_implied, wanted)
+		posts = self._search_post(search, wanted, compact=compact)
+		return self._get_post_result(md5, posts)
+
 	def delete_post(self, md5):
 		assert " " not in md5
 		cmd = u"DP" + _uniw(md5)
-		self._writeline(cmd)
-		res = self._readline()
-		if res != u"OK": raise ResponseError(res)
+		self._cmd(cmd)
 
 	def _list(self, data, converter=_uniw):
 		if not data: return []
@@ -427,11 +1212,28 @@ class Client:
 				search += [u"R%x:%x" % tuple(range)]
 		return u"".join(search)
 
-	def search_post(self, wanted=None, props=None, **kw):
+	def search_post(self, wanted=None, props=None, compact=False, **kw):
+		"""compact=True gives CompactPosts, which use a lot less memory."""
 		search = u"SP" + self._build_search(wanted=wanted, **kw)
-		posts = self._search_post(search, wanted, props)
+		posts = self._search_post(search, wanted, props, compact)
 		return posts
 
+	def iter_search_post(self, wanted=None, props=None, compact=False, **kw):
+		"""Like search_post, but returns an iterator that parses posts as
+		they arrive instead of a list of all of them.
+		The iterator has the props dict as .props, already filled in.
+		See _SearchIterator for what to do if you don't read all posts.
+		"""
+		search = u"SP" + self._build_search(wanted=wanted, **kw)
+		return self._iter_search(search, wanted, props, compact)
+
+	def search_cursor(self, wanted=None, page_size=1000, compact=False, prefetch=True, **kw):
+		"""A SearchCursor over search_post(wanted, **kw), for searches
+		that may have more results than you want in memory at once.
+		(Don't pass range, the cursor handles that.)
+		"""
+		return SearchCursor(self, wanted, page_size, compact, prefetch, kw)
+
 	def _fieldspec(self, **kwargs):
 		f = [_uniw(f) + u"=" + _field_cparser[f](kwargs[f]) for f in kwargs]
 		if not f: return u""
@@ -441,9 +1243,7 @@ class Client:
 		fspec = self._fieldspec(**kwargs)
 		if fspec:
 			cmd = u"MP" + _uniw(md5) + fspec
-			self._writeline(cmd)
-			res = self._readline()
-			if res != u"OK": raise ResponseError(res)
+			self._cmd(cmd)
 
 	def add_post(self, md5, **kwargs):
 		cmd  = u"AP" + _uniw(md5)
@@ -451,17 +1251,13 @@ class Client:
 		assert "height" in kwargs
 		assert "ext" in kwargs
 		cmd += self._fieldspec(**kwargs)
-		self._writeline(cmd)
-		res = self._readline()
-		if res != u"OK": raise ResponseError(res)
+		self._cmd(cmd)
 
 	def _rels(self, c, md5, rels):
 		cmd = [u"R", c, md5]
 		for rel in self._list(rels, _uniw):
 			cmd.append(u" " + rel)
-		self._writeline(u"".join(cmd))
-		res = self._readline()
-		if res != u"OK": raise ResponseError(res)
+		self._cmd(u"".join(cmd))
 
 	def add_rels(self, md5, rels):
 		self._rels(u"R", md5, rels)
@@ -494,21 +1290,18 @@ class Client:
 			cmd += u" G" + _uniw(guid)
 		if valuetype:
 			cmd += u" V" + _uniw(valuetype)
-		self._writeline(cmd)
-		res = self._readline()
-		if res != u"OK": raise ResponseError(res)
+		self.invalidate()
+		self._cmd(cmd)
 
 	def add_alias(self, name, origin_guid):
 		cmd = u"AAG" + _uniw(origin_guid) + u" N" + _uniw(name)
-		self._writeline(cmd)
-		res = self._readline()
-		if res != u"OK": raise ResponseError(res)
+		self.invalidate()
+		self._cmd(cmd)
 
 	def remove_alias(self, name):
 		cmd = u"DAN" + _uniw(name)
-		self._writeline(cmd)
-		res = self._readline()
-		if res != u"OK": raise ResponseError(res)
+		self.invalidate()
+		self._cmd(cmd)
 
 	def _addrem_implies(self, addrem, set_tag, implied_tag, datastr, filter, value=None):
 		set_tag = self._tag2spec(set_tag)
@@ -527,9 +1320,7 @@ class Client:
 		if value:
 			datastr += " V" + value.format()
 		cmd = u"I" + addrem + set_tag + add + datastr
-		self._writeline(cmd)
-		res = self._readline()
-		if res != u"OK": raise ResponseError(res)
+		self._cmd(cmd)
 
 	def add_implies(self, set_tag, implied_tag, priority=0, filter=None, value=None):
 		datastr = u""
@@ -540,8 +1331,7 @@ class Client:
 	def remove_implies(self, set_tag, implied_tag, filter=None):
 		self._addrem_implies("i", set_tag, implied_tag, "", filter)
 
-	def _parse_implies(self, data):
-		res = self._readline()
+	def _parse_implies(self, res, data):
 		if res == u"OK": return
 		guid, impl = res.split(u" ", 1)
 		assert guid[:2] == u"RI"
@@ -549,7 +1339,9 @@ class Client:
 		if len(guid) == 27:
 			filter = None
 		else:
-			pt = self._parse_tag("", guid, 27, True, True)
+			tag = Tag()
+			tag.guid = guid[:27]
+			pt = self._tag_value("", tag, guid, 27, True, True)
 			filter = pt[1:]
 			if filter == (None, None): filter = None
 			guid = pt[0]
@@ -587,8 +1379,11 @@ class Client:
 		cmd = u"IR" if reverse else u"IS"
 		self._writeline(cmd + tag)
 		data = {}
-		while self._parse_implies(data):
+		while self._parse_implies(self._readline(), data):
 			pass
+		return self._implies_result(tag, data, reverse)
+
+	def _implies_result(self, tag, data, reverse):
 		if reverse:
 			rev = []
 			for itag in data:
@@ -608,18 +1403,16 @@ class Client:
 
 	def merge_tags(self, into_t, from_t):
 		cmd = u"MTG" + _uniw(into_t) + u" M" + _uniw(from_t)
-		self._writeline(cmd)
-		res = self._readline()
-		if res != u"OK": raise ResponseError(res)
+		self.invalidate()
+		self._cmd(cmd)
 
 	def mod_tag(self, guid, name=None, type=None, valuetype=None):
 		cmd = u"MTG" + _uniw(guid)
 		for init, field in ((u" N", name), (u" T", type), (u" V", valuetype)):
 			if field:
 				cmd += init + _uniw(field)
-		self._writeline(cmd)
-		res = self._readline()
-		if res != u"OK": raise ResponseError(res)
+		self.invalidate()
+		self._cmd(cmd)
 
 	def _tag2spec(self, t, value_allowed=True):
 		if type(t) in (tuple, list):
@@ -634,7 +1427,7 @@ class Client:
 		else:
 			return _uniw(t)
 
-	def tag_post(self, md5, full_tags=None, weak_tags=None, remove_tags=None):
+	def _tag_post_cmds(self, md5, full_tags, weak_tags, remove_tags):
 		tags = self._list(full_tags, lambda s: u" T" + self._tag2spec(s))
 		tags += self._list(weak_tags, lambda s: u" T~" + self._tag2spec(s))
 		tags += self._list(remove_tags, lambda s: u" t" + self._tag2spec(s, False))
@@ -645,19 +1438,18 @@ class Client:
 			assert u" " not in tag[1:]
 			clen += len(tag.encode("utf-8"))
 			if clen >= self._prot_max_len:
-				self._writeline(u"".join(cmd))
-				res = self._readline()
-				if res != u"OK": raise ResponseError(res)
+				yield u"".join(cmd)
 				cmd = [init]
 				clen = len(init) + len(tag.encode("utf-8"))
 			cmd.append(tag)
 		if len(cmd) > 1:
-			self._writeline(u"".join(cmd))
-			res = self._readline()
-			if res != u"OK": raise ResponseError(res)
+			yield u"".join(cmd)
 
-	def _parse_tagres(self, resdata = None):
-		res = self._readline()
+	def tag_post(self, md5, full_tags=None, weak_tags=None, remove_tags=None):
+		for cmd in self._tag_post_cmds(md5, full_tags, weak_tags, remove_tags):
+			self._cmd(cmd)
+
+	def _parse_tagres(self, res, resdata=None):
 		if res == u"OK": return
 		if res[0] != u"R": raise ResponseError(res)
 		if res[1] == u"E": raise ResponseError(res)
@@ -667,7 +1459,7 @@ class Client:
 		if resdata != None: resdata.append(t)
 		return t
 
-	def find_tags(self, matchtype, name, range=None, order=None, flags=None, **kw):
+	def _find_tags_cmd(self, matchtype, name, range=None, order=None, flags=None, **kw):
 		if kw:
 			filter = self._build_search(**kw)
 			if filter:
@@ -685,30 +1477,15 @@ class Client:
 			assert len(range) == 2
 			cmd.append(u" R%x:%x" % tuple(range))
 		cmd.append(filter)
-		self._writeline(u"".join(cmd))
+		return u"".join(cmd)
+
+	def find_tags(self, matchtype, name, range=None, order=None, flags=None, **kw):
+		self._writeline(self._find_tags_cmd(matchtype, name, range, order, flags, **kw))
 		tags = []
-		while self._parse_tagres(tags): pass
+		while self._parse_tagres(self._readline(), tags): pass
 		return tags
 
-	def _parse_tag(self, prefix, spec, pos, comparison, is_guid=False):
-		if pos == -1:
-			return None
-		if is_guid:
-			assert comparison
-			ppos = -1
-			tag = Tag()
-			tag.guid = spec[:pos]
-		else:
-			tag = self.find_tag(spec[:pos])
-			if comparison:
-				ppos = _rfindany(spec, u"=<>", pos)
-			else:
-				ppos = spec.rfind(u"=", 0, pos)
-			if not tag:
-				return self._parse_tag(prefix, spec, ppos, comparison)
-			tag = self.get_tag(tag)
-			if not tag or tag.valuetype in (None, "none"):
-				return self._parse_tag(prefix, spec, ppos, comparison)
+	def _tag_value(self, prefix, tag, spec, pos, comparison, is_guid=False):
 		if comparison:
 			if pos + 1 < len(spec) and spec[pos + 1] in u"=~":
 				comp = spec[pos:pos + 2]
@@ -735,7 +1512,12 @@ class Client:
 				val = None
 			return (prefix + tag.guid, val)
 
-	def parse_tag(self, spec, comparison=False):
+	def _tag_candidates(self, spec, comparison):
+		"""Where parse_tag might split spec into tag and value.
+		Returns (prefix, spec, whole, positions), where whole says if
+		all of spec could be a tag name and positions are in the order
+		they should be tried.
+		"""
 		spec = _uni(spec)
 		if not spec: return None
 		if spec[0] in u"~-!":
@@ -743,20 +1525,65 @@ class Client:
 			spec = spec[1:]
 		else:
 			prefix = u""
-		if u" " not in spec and u"\n" not in spec:
-			tag = self.find_tag(spec)
-		else:
-			tag = None
-		if tag:
-			if comparison:
-				return (prefix + tag, None, None)
-			else:
-				return (prefix + tag, None)
+		whole = u" " not in spec and u"\n" not in spec
 		if comparison:
-			ppos = _rfindany(spec, u"=<>", spec.find(u" "))
+			find = lambda pos: _rfindany(spec, u"=<>", pos)
 		else:
-			ppos = spec.rfind(u"=", 0, spec.find(u" "))
-		return self._parse_tag(prefix, spec, ppos, comparison)
+			find = lambda pos: spec.rfind(u"=", 0, pos)
+		positions = []
+		pos = find(spec.find(u" "))
+		while pos != -1:
+			positions.append(pos)
+			pos = find(pos)
+		return prefix, spec, whole, positions
+
+	def resolve_tags(self, specs, comparison=False):
+		"""parse_tag for several specs, as a list of the results.
+		All the lookups are sent to the server together (well, in two
+		rounds if the tag cache is disabled), so this is a lot faster
+		than calling parse_tag for each. If parse_tag would raise for
+		any of the specs, so does this.
+		"""
+		plans = [self._tag_candidates(spec, comparison) for spec in specs]
+		keys = []
+		for plan in plans:
+			if not plan: continue
+			prefix, spec, whole, positions = plan
+			if whole:
+				keys.append((u"EAN", spec))
+			keys.extend((u"EAN", spec[:pos]) for pos in positions)
+		# Lookups that parse_tag wouldn't get to might fail, so errors
+		# are only raised when reached.
+		errors = {}
+		found = self._lookup_tags(keys, errors)
+		guids = [(u"EAG", tag.guid) for tag in found.values() if tag]
+		found.update(self._lookup_tags(guids, errors))
+		def lookup(key):
+			if key in errors:
+				raise errors[key]
+			return found[key]
+		return [self._resolve_tag(plan, comparison, lookup) for plan in plans]
+
+	def _resolve_tag(self, plan, comparison, lookup):
+		if not plan: return None
+		prefix, spec, whole, positions = plan
+		if whole:
+			tag = lookup((u"EAN", spec))
+			if tag:
+				if comparison:
+					return (prefix + tag.guid, None, None)
+				else:
+					return (prefix + tag.guid, None)
+		for pos in positions:
+			tag = lookup((u"EAN", spec[:pos]))
+			if not tag: continue
+			tag = lookup((u"EAG", tag.guid))
+			if not tag or tag.valuetype in (None, "none"): continue
+			return self._tag_value(prefix, tag, spec, pos, comparison)
+		return None
+
+	def parse_tag(self, spec, comparison=False):
+		return self.resolve_tags([spec], comparison)[0]
 
 	def _find_tag(self, matchtype, name, with_prefix):
 		name = _uniw(name)
@@ -765,14 +1592,72 @@ class Client:
 			name = name[1:]
 		else:
 			prefix = u""
-		tags = self.find_tags(matchtype, name)
-		if not tags: return None
-		assert len(tags) == 1
-		tag = tags[0]
+		tag = self._lookup_tag(matchtype, name)
+		if not tag: return None
 		tag.pname = prefix + tag.name
 		tag.pguid = prefix + tag.guid
 		return tag
 
+	# Max number of ST commands _lookup_tags sends at once.
+	_lookup_batch = 128
+
+	def _lookup_tags(self, keys, errors=None):
+		"""Look up several (matchtype, name), sending the ones that aren't
+		cached in one go. Returns {key: Tag or None}. The Tags may be the
+		cached ones, so don't modify them.
+		If errors is a dict, failed lookups go there instead of raising.
+		"""
+		cache = self._tag_cache
+		res = {}
+		missing = []
+		for key in keys:
+			if key in res: continue
+			tag = False if cache is None else cache.get(key, False)
+			res[key] = tag
+			if tag is False:
+				missing.append(key)
+		for ix in range(0, len(missing), self._lookup_batch):
+			batch = missing[ix:ix + self._lookup_batch]
+			cmds = [self._find_tags_cmd(*key) for key in batch]
+			for cmd in cmds:
+				assert u"\n" not in cmd
+			if self._pipeline:
+				self._pipeline.flush()
+			self._send(b"".join(cmd.encode("utf-8") + b"\n" for cmd in cmds))
+			error = None
+			# Read all the responses even if some fail.
+			for key in batch:
+				tags = []
+				try:
+					while self._parse_tagres(self._readline(), tags): pass
+				except ResponseError as e:
+					del res[key]
+					if errors is None:
+						error = error or e
+					else:
+						errors[key] = e
+					continue
+				if not tags:
+					tag = None
+				else:
+					assert len(tags) == 1
+					tag = tags[0]
+				res[key] = tag
+				# Not misses, another client may be about to add the tag.
+				if cache is not None and tag:
+					cache[key] = tag
+					# Looking up the same tag the other way is common.
+					cache[(u"EAG", tag.guid)] = tag
+					cache[(u"EAN", tag.name)] = tag
+			if error:
+				raise error
+		return res
+
+	def _lookup_tag(self, matchtype, name):
+		key = (matchtype, name)
+		tag = self._lookup_tags([key])[key]
+		return tag and _copy_tag(tag)
+
 	def find_tag(self, name, resdata=None, with_prefix=False):
 		tag = self._find_tag(u"EAN", name, with_prefix)
 		if not tag: return None
@@ -847,17 +1732,13 @@ class Client:
 			cmd.append(post)
 			clen += len(post.encode("utf-8"))
 			if clen >= self._prot_max_len - 35:
-				self._writeline(u"".join(cmd))
-				res = self._readline()
-				if res != u"OK": raise ResponseError(res)
+				self._cmd(u"".join(cmd))
 				# Overlap one, so previous ordering doesn't mess us up.
 				cmd = [init, post]
 				dolen = 3
 				clen = len(init) + len(post.encode("utf-8"))
 		if len(cmd) >= dolen:
-			self._writeline(u"".join(cmd))
-			res = self._readline()
-			if res != u"OK": raise ResponseError(res)
+			self._cmd(u"".join(cmd))
 
 	def metalist(self, name):
 		cmd = u"L" + _uniw(name)
@@ -920,6 +1801,97 @@ class Client:
 						t = t.convert("L")
 				t.save(fn, **opts)
 
+class _Pool_Ctx:
+	def __init__(self, pool, timeout):
+		self._pool = pool
+		self._timeout = timeout
+
+	def __enter__(self):
+		self._client = self._pool.get(self._timeout)
+		return self._client
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		# If something went wrong half way through a command we don't
+		# know what state the connection is in, so don't reuse it.
+		self._pool.put(self._client, broken=exc_type is not None)
+		self._client = None
+
+class ClientPool:
+	"""Up to max_size Clients sharing one Config, for use from several threads.
+
+	Either get() a client and put() it back when done, or use
+	"with pool.client() as client:". Connections are kept open between
+	uses, and checked for having been closed by the server when handed out.
+	All the clients record in stats and trace, if given (see Client).
+	"""
+
+	def __init__(self, cfg=None, max_size=4, stats=None, trace=None):
+		if not cfg:
+			cfg = Config()
+		assert max_size > 0
+		self.cfg = cfg
+		self.max_size = max_size
+		self.stats = stats
+		self.trace = trace
+		self._idle = []
+		self._count = 0
+		self._cond = Condition()
+
+	def _healthy(self, client):
+		if not client.is_connected:
+			return True # will connect when used
+		try:
+			# An idle connection should never have anything to read,
+			# so if it does it's either EOF or garbage.
+			return not select([client._sock], [], [], 0)[0]
+		except (IOError, ValueError):
+			return False
+
+	def get(self, timeout=None):
+		"""Check out a Client, waiting up to timeout seconds if max_size
+		clients are already in use. (Forever if timeout is None.)
+		"""
+		deadline = None if timeout is None else time() + timeout
+		with self._cond:
+			while not self._idle and self._count >= self.max_size:
+				if deadline is None:
+					self._cond.wait()
+				else:
+					left = deadline - time()
+					if left <= 0:
+						raise WellpappError("No free client in pool")
+					self._cond.wait(left)
+			if self._idle:
+				client = self._idle.pop()
+			else:
+				client = Client(self.cfg, stats=self.stats, trace=self.trace)
+				self._count += 1
+		if not self._healthy(client):
+			client.close()
+		return client
+
+	def put(self, client, broken=False):
+		"""Return a Client from get(). If broken it is disconnected
+		(and will reconnect when used again).
+		"""
+		if broken:
+			client.close()
+		elif client._active_search:
+			client._active_search.abandon()
+		with self._cond:
+			self._idle.append(client)
+			self._cond.notify()
+
+	def client(self, timeout=None):
+		"""Context manager that does get() and put() for you."""
+		return _Pool_Ctx(self, timeout)
+
+	def close(self):
+		"""Disconnect all idle clients."""
+		with self._cond:
+			for client in self._idle:
+				client.close()
+
 def _thumb(img, z):
 	from PIL import Image
 	if max(img.size) > z:
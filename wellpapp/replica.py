@@ -0,0 +1,1264 @@
+"""Local copy of the database, for queries that don't need the server.
+
+	replica = Replica()    # the file from replica= in the config
+	replica.sync()         # fetch what changed on the server
+	posts = replica.search_post(guids=[guid], wanted=["tagname", "ext"])
+
+Replica has the read methods of Client (search_post, get_post,
+find_tags, find_tag, get_tag, parse_tag, resolve_tags, tag_implies and
+post_rels) and answers them from an sqlite file, giving what the
+server would have given at the time of the last sync. It never
+changes anything on the server. "wp replica sync" updates the replica
+from the config, Replicas that are already open see that on their next
+query.
+
+Searches are evaluated locally, on bitmaps (an int per tag, where bit
+n is the n:th post in the server's order) built as tags are used. The
+details (fuzzy matching in find_tags, sorting of equal values) may
+differ slightly from the server.
+"""
+
+from __future__ import print_function
+
+import os
+import sqlite3
+import sys
+from binascii import hexlify
+from bisect import bisect_left, bisect_right
+from math import radians, sin, cos, pi
+from time import time
+
+from wellpapp.client import Client, Config, WellpappError, ResponseError, InheritValue, ImplicationTuple, vtparse
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+__all__ = ("Replica", "default_path", "main",)
+
+if sys.version_info[0] > 2:
+	unicode = str
+
+_schema = """
+CREATE TABLE IF NOT EXISTS meta (
+	key TEXT PRIMARY KEY,
+	value TEXT
+);
+CREATE TABLE IF NOT EXISTS tags (
+	guid TEXT PRIMARY KEY,
+	name TEXT NOT NULL,
+	type TEXT,
+	valuetype TEXT,
+	posts INTEGER NOT NULL DEFAULT 0,
+	weak_posts INTEGER NOT NULL DEFAULT 0,
+	flags TEXT NOT NULL DEFAULT ''
+);
+CREATE TABLE IF NOT EXISTS aliases (
+	name TEXT PRIMARY KEY,
+	guid TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS posts (
+	id INTEGER PRIMARY KEY,
+	md5 TEXT NOT NULL UNIQUE,
+	ext TEXT,
+	width TEXT,
+	height TEXT,
+	created TEXT,
+	imgdate TEXT,
+	rotate TEXT,
+	pos INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS posts_pos ON posts (pos);
+CREATE TABLE IF NOT EXISTS post_tags (
+	post INTEGER NOT NULL,
+	guid TEXT NOT NULL,
+	flags TEXT NOT NULL,
+	value TEXT,
+	num_value REAL,
+	num_min REAL,
+	num_max REAL,
+	num_steps INTEGER
+);
+CREATE INDEX IF NOT EXISTS post_tags_post ON post_tags (post);
+CREATE INDEX IF NOT EXISTS post_tags_guid ON post_tags (guid);
+CREATE TABLE IF NOT EXISTS implications (
+	set_guid TEXT NOT NULL,
+	filter_comp TEXT,
+	filter_value TEXT,
+	guid TEXT NOT NULL,
+	prio INTEGER NOT NULL,
+	value TEXT
+);
+CREATE INDEX IF NOT EXISTS implications_set ON implications (set_guid);
+CREATE INDEX IF NOT EXISTS implications_guid ON implications (guid);
+CREATE TABLE IF NOT EXISTS rels (
+	md5 TEXT NOT NULL,
+	rel TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS rels_md5 ON rels (md5);
+CREATE TABLE IF NOT EXISTS orders (
+	guid TEXT NOT NULL,
+	pos INTEGER NOT NULL,
+	post INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS orders_guid ON orders (guid);
+"""
+# Bumped when _schema changes, older files are emptied on open.
+_schema_version = 3
+_tables = ("meta", "tags", "aliases", "posts", "post_tags", "implications", "rels", "orders",)
+
+_post_fields = ("ext", "width", "height", "created", "imgdate", "rotate")
+_comps = ("=~", "<=", ">=", "=", "<", ">")
+
+# sqlite has a limit on the number of parameters in a statement.
+_chunk = 500
+
+# Posts per R range when syncing, and how small a part of the post
+# order with removed posts has to be before it's fetched instead of
+# split.
+_page = 10000
+_walk_fetch = 64
+
+# The server's "changed" datatag.
+_changed_guid = u"aaaaaa-aaaaas-faketg-chaage"
+
+def _chunks(l):
+	for ix in range(0, len(l), _chunk):
+		yield l[ix:ix + _chunk]
+
+def _fuzz(name):
+	return u"".join(c for c in name.lower() if c.isalnum())
+
+def _compare(value, comp, other):
+	try:
+		if comp in (u"=", u"=~"): return value.overlap(other)
+		if comp == u"<": return value < other
+		if comp == u">": return value > other
+		if comp == u"<=": return value <= other
+		if comp == u">=": return value >= other
+	except TypeError:
+		pass
+	return False
+
+def default_path(cfg):
+	"""replica= from cfg, or replica.sqlite in the wellpapp cache dir."""
+	if cfg.get("replica"):
+		return os.path.expanduser(cfg.replica)
+	cache_home = os.environ.get("XDG_CACHE_HOME")
+	if not cache_home:
+		cache_home = os.path.join(os.environ["HOME"], ".cache")
+	return os.path.join(cache_home, "wellpapp", "replica.sqlite")
+
+def _to_bits(positions):
+	"""An int with the bits in positions set."""
+	if not positions: return 0
+	data = bytearray((max(positions) >> 3) + 1)
+	for pos in positions:
+		data[pos >> 3] |= 1 << (pos & 7)
+	data.reverse()
+	return int(hexlify(bytes(data)), 16)
+
+def _from_bits(bits):
+	"""The set bits in bits, lowest first."""
+	s = bin(bits)[:1:-1]
+	res = []
+	pos = s.find(u"1")
+	while pos >= 0:
+		res.append(pos)
+		pos = s.find(u"1", pos + 1)
+	return res
+
+if hasattr(int, "bit_count"):
+	_popcount = int.bit_count
+else:
+	def _popcount(bits):
+		return bin(bits).count(u"1")
+
+# Valuetypes that _ValueColumn handles, the rest are compared as ValueTypes.
+# Values of the first ones are stored as numbers too, see _numbers.
+_number_valuetypes = ("int", "uint", "float", "f-stop", "stop", "datetime",)
+_column_valuetypes = _number_valuetypes + ("gps",)
+
+def _numbers(valuetype, value):
+	"""(value, min, max, steps) of a value as the server sent it, as
+	numbers (steps is 1 for datetimes with steps). These are what
+	_ValueColumn needs, so it doesn't have to parse anything.
+	"""
+	if value is None or valuetype not in _number_valuetypes:
+		return (None, None, None, None)
+	try:
+		v = vtparse(valuetype, value)
+	except ValueError:
+		return (None, None, None, None)
+	return (float(v.value), float(v.min), float(v.max), int(getattr(v, "with_steps", False)))
+
+def _array_to_bits(positions, size):
+	"""Like _to_bits, for a numpy array of positions below size."""
+	if not len(positions): return 0
+	flags = numpy.zeros(size, dtype=bool)
+	flags[positions] = True
+	packed = numpy.packbits(flags, bitorder="little")
+	return int(hexlify(packed[::-1].tobytes()), 16)
+
+class _ValueColumn:
+	"""The values of one tag as numpy arrays with one entry per value:
+	pos, weak, value, min and max (the last three as (lat, lon) pairs
+	for gps, which also has fuzz_r). Comparisons are done on all of
+	them at once, with the same fuzz rules as ValueType.
+
+	Numbers become floats, so integers beyond 2**53 lose precision.
+	"""
+
+	def __init__(self, valuetype, rows, size):
+		"""rows are (pos, weak, value, num_value, num_min, num_max, num_steps)."""
+		self.valuetype = valuetype
+		self.pos = numpy.array([r[0] for r in rows], dtype=numpy.int64)
+		self.weak = numpy.array([r[1] for r in rows], dtype=bool)
+		self._size = size
+		self._wire = [r[2] for r in rows]
+		if valuetype == u"gps":
+			parsed = [vtparse(valuetype, v) for v in self._wire]
+			pairs = lambda l: numpy.array(l, dtype=float).reshape(-1, 2)
+			self.value = pairs([v.value[:2] for v in parsed])
+			self.min = pairs([v.min for v in parsed])
+			self.max = pairs([v.max for v in parsed])
+			self.fuzz_r = numpy.array([v._fuzz_R for v in parsed], dtype=float)
+			self.first = None
+			return
+		numbers = [r[3:] if r[3] is not None else _numbers(valuetype, r[2]) for r in rows]
+		numbers = numpy.array(numbers, dtype=float).reshape(-1, 4)
+		self.value = numbers[:, 0]
+		self.min = numbers[:, 1]
+		self.max = numbers[:, 2]
+		# Datetimes with steps (2020-05+-1-01) only overlap on some days,
+		# the intervals are just a first filter for them.
+		self._stepped = numbers[:, 3] == 1
+		# The first value on each post, for sorting.
+		self.first = numpy.full(size, numpy.nan)
+		posts, ix = numpy.unique(self.pos, return_index=True)
+		self.first[posts] = self.value[ix]
+
+	def match(self, prefix, comp, other):
+		"""Bits of the posts where prefix value comp other holds."""
+		if prefix == u"!":
+			keep = ~self.weak
+		elif prefix == u"~":
+			keep = self.weak.copy()
+		else:
+			keep = numpy.ones(len(self.pos), dtype=bool)
+		if self.valuetype == u"gps":
+			keep &= self._gps_compare(comp, other)
+		elif comp == u"<":
+			keep &= self.min < other.max
+		elif comp == u"<=":
+			keep &= self.min <= other.max
+		elif comp == u">":
+			keep &= self.max > other.min
+		elif comp == u">=":
+			keep &= self.max >= other.min
+		else:
+			keep &= (self.min <= other.max) & (self.max >= other.min)
+			if self.valuetype == u"datetime":
+				check = keep if other.with_steps else keep & self._stepped
+				for ix in numpy.nonzero(check)[0]:
+					keep[ix] = vtparse(self.valuetype, self._wire[ix]).overlap(other)
+		return _array_to_bits(self.pos[keep], self._size)
+
+	def _gps_compare(self, comp, other):
+		if comp in (u"=", u"=~"):
+			lat = numpy.radians(self.value[:, 0])
+			olat = radians(other.lat)
+			x = numpy.sin(lat) * sin(olat) + numpy.cos(lat) * cos(olat) * numpy.cos(numpy.radians(other.lon - self.value[:, 1]))
+			# acos outside [-1, 1] fails in VTgps, which then uses pi.
+			dist = numpy.where(numpy.abs(x) <= 1, numpy.arccos(numpy.clip(x, -1, 1)), pi)
+			return dist <= self.fuzz_r + other._fuzz_R
+		# Tuple comparisons of (lat, lon).
+		if comp in (u"<", u"<="):
+			a, b = self.min, other.max
+		else:
+			a, b = self.max, other.min
+		first = a[:, 0]
+		second = a[:, 1]
+		if comp == u"<": return (first < b[0]) | ((first == b[0]) & (second < b[1]))
+		if comp == u"<=": return (first < b[0]) | ((first == b[0]) & (second <= b[1]))
+		if comp == u">": return (first > b[0]) | ((first == b[0]) & (second > b[1]))
+		return (first > b[0]) | ((first == b[0]) & (second >= b[1]))
+
+	def sort(self, ids, positions, reverse):
+		"""ids sorted on the first value of the posts at positions,
+		like sorted with key (no value, value).
+		"""
+		keys = self.first[numpy.array(positions, dtype=numpy.int64)]
+		missing = numpy.isnan(keys).astype(numpy.int8)
+		keys[missing == 1] = 0
+		if reverse:
+			order = numpy.lexsort((-keys, -missing))
+		else:
+			order = numpy.lexsort((keys, missing))
+		return [ids[ix] for ix in order]
+
+class _Bitmaps:
+	"""The posts in the replica as bits in ints (bit n is the post at
+	pos n), so searches are a few big int operations. Tags are loaded
+	when first used. Only valid until the replica changes.
+	"""
+
+	def __init__(self, replica):
+		self._replica = replica
+		self.ids = [r[0] for r in replica._db.execute("SELECT id FROM posts ORDER BY pos")]
+		self.all = (1 << len(self.ids)) - 1
+		self.pos = dict((id, pos) for pos, id in enumerate(self.ids))
+		self._tags = {}
+		self._values = {}
+		self._columns = {}
+
+	def _load(self, guids):
+		"""Load guids (that aren't already) with as few queries as possible."""
+		guids = [g for g in guids if g not in self._tags]
+		if not guids: return
+		found = dict((g, ([], [], [], [], [])) for g in guids)
+		if len(guids) > 64:
+			rows = self._replica._db.execute("SELECT guid, post, flags, value FROM post_tags")
+		else:
+			marks = u",".join(u"?" * len(guids))
+			rows = self._replica._db.execute("SELECT guid, post, flags, value FROM post_tags WHERE guid IN (" + marks + ")", guids)
+		pos = self.pos
+		for guid, post, flags, value in rows:
+			if guid not in found: continue
+			strong, weak, direct_strong, direct_weak, values = found[guid]
+			p = pos[post]
+			is_weak = u"~" in flags
+			(weak if is_weak else strong).append(p)
+			if u"I" not in flags and u"D" not in flags:
+				(direct_weak if is_weak else direct_strong).append(p)
+			if value is not None:
+				values.append((p, is_weak, value))
+		for guid, (strong, weak, direct_strong, direct_weak, values) in found.items():
+			self._tags[guid] = (_to_bits(strong), _to_bits(weak), _to_bits(direct_strong), _to_bits(direct_weak), values)
+
+	def tag(self, guid):
+		"""(strong, weak, direct strong, direct weak, [(pos, weak, value)])
+		where direct is without implied tags and datatags.
+		"""
+		if guid not in self._tags:
+			self._load([guid])
+		return self._tags[guid]
+
+	def _parsed_values(self, guid):
+		if guid not in self._values:
+			valuetype = self._replica._tags[guid][3]
+			self._values[guid] = [(p, weak, vtparse(valuetype, v)) for p, weak, v in self.tag(guid)[4]]
+		return self._values[guid]
+
+	def column(self, guid):
+		"""A _ValueColumn for guid, or None without numpy or for valuetypes
+		it doesn't handle.
+		"""
+		if numpy is None: return None
+		valuetype = self._replica._tags[guid][3]
+		if valuetype not in _column_valuetypes: return None
+		if guid not in self._columns:
+			pos = self.pos
+			rows = [(pos[r[0]], u"~" in r[1]) + r[2:] for r in self._replica._db.execute(
+				"SELECT post, flags, value, num_value, num_min, num_max, num_steps FROM post_tags WHERE guid = ? AND value IS NOT NULL", (guid,)
+			)]
+			self._columns[guid] = _ValueColumn(valuetype, rows, len(self.ids))
+		return self._columns[guid]
+
+	def match(self, spec):
+		"""Bits of the posts matching spec (from Replica._tagspec)."""
+		prefix, guid, comp, value = spec
+		column = comp and self.column(guid)
+		if column:
+			return column.match(prefix, comp, value)
+		if comp:
+			positions = [p for p, weak, v in self._parsed_values(guid)
+			             if (prefix != u"!" or not weak) and (prefix != u"~" or weak) and _compare(v, comp, value)]
+			return _to_bits(positions)
+		strong, weak = self.tag(guid)[:2]
+		if prefix == u"!": return strong
+		if prefix == u"~": return weak
+		return strong | weak
+
+	def search(self, want, dontwant):
+		"""Bits of the posts matching all of want and none of dontwant."""
+		if want:
+			# Smallest first, so the rest mostly AND with nothing.
+			matches = sorted((self.match(s) for s in want), key=_popcount)
+			bits = matches[0]
+			for m in matches[1:]:
+				if not bits: break
+				bits &= m
+		else:
+			bits = self.all
+		for s in dontwant:
+			if not bits: break
+			bits &= ~self.match(s)
+		return bits
+
+	def posts(self, bits):
+		"""Post ids for bits, in order."""
+		ids = self.ids
+		return [ids[p] for p in _from_bits(bits)]
+
+def _pipelined(client, cmds, read_response, batch=256):
+	"""Send cmds batch at a time without waiting for the responses,
+	then call read_response(cmd) for each, which must read exactly
+	that response.
+	"""
+	for ix in range(0, len(cmds), batch):
+		chunk = cmds[ix:ix + batch]
+		client._send(b"".join(cmd.encode("utf-8") + b"\n" for cmd in chunk))
+		try:
+			for cmd in chunk:
+				read_response(cmd)
+		except BaseException:
+			# The rest of the responses are still coming, so the
+			# connection is out of step with the commands.
+			client.close()
+			raise
+
+class _LocalClient(Client):
+	"""A Client that never connects, tag lookups come from the replica.
+	Used for parsing and for the tag spec handling in Client.
+	"""
+
+	def __init__(self, cfg, replica):
+		Client.__init__(self, cfg, tag_cache=0, trace=False)
+		self._replica = replica
+
+	def _reconnect(self):
+		raise WellpappError("The replica can't talk to the server")
+
+	def _lookup_tags(self, keys, errors=None):
+		res = {}
+		for key in keys:
+			tags = self._replica.find_tags(*key)
+			res[key] = tags[0] if tags else None
+		return res
+
+class Replica:
+	"""An sqlite copy of the server database, see the module docstring.
+	path defaults to default_path(cfg).
+	"""
+
+	def __init__(self, path=None, cfg=None):
+		if not cfg:
+			cfg = Config()
+		self.cfg = cfg
+		self.path = path or default_path(cfg)
+		dirname = os.path.dirname(self.path)
+		if dirname and not os.path.isdir(dirname):
+			os.makedirs(dirname)
+		self._db = sqlite3.connect(self.path, check_same_thread=False)
+		if self._db.execute("PRAGMA user_version").fetchone()[0] != _schema_version:
+			with self._db:
+				for table in _tables:
+					self._db.execute("DROP TABLE IF EXISTS " + table)
+			self._db.execute("PRAGMA user_version = %d" % (_schema_version,))
+		self._db.executescript(_schema)
+		self._local = _LocalClient(cfg, self)
+		self._load_tags()
+
+	def close(self):
+		self._db.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+	def _load_tags(self):
+		"""Tags are small enough to keep in memory, and used everywhere."""
+		# Read first, so a sync committed while loading is seen next time.
+		self._data_version = self._data_version_now()
+		self._bitmaps_cache = None
+		self._tags = {}
+		self._names = {}
+		self._aliases = {}
+		for row in self._db.execute("SELECT guid, name, type, valuetype, posts, weak_posts, flags FROM tags"):
+			self._tags[row[0]] = row
+			self._names[row[1]] = row[0]
+		for name, guid in self._db.execute("SELECT name, guid FROM aliases ORDER BY rowid"):
+			self._aliases.setdefault(guid, []).append(name)
+			self._names.setdefault(name, guid)
+
+	def _data_version_now(self):
+		return self._db.execute("PRAGMA data_version").fetchone()[0]
+
+	def _check_changed(self):
+		"""Reload what is kept in memory (tags, bitmaps) if another
+		connection (a sync in another process) changed the file.
+		"""
+		if self._data_version_now() != self._data_version:
+			self._load_tags()
+
+	def meta(self, key, default=None):
+		row = self._db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+		return row[0] if row else default
+
+	def _set_meta(self, **kw):
+		self._db.executemany("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", [(k, unicode(v)) for k, v in kw.items()])
+
+	def __len__(self):
+		return self._db.execute("SELECT COUNT(*) FROM posts").fetchone()[0]
+
+	# Syncing
+
+	def sync(self, client=None, verbose=False, full=False):
+		"""Update from the server (using client, or a new Client with the
+		same config). Readers see either the old or the new contents,
+		never a mix.
+
+		Only fetches what changed since the last sync (see _sync_changes)
+		unless full, or there hasn't been a sync yet.
+		"""
+		client = client or Client(self.cfg)
+		def log(*a):
+			if verbose:
+				print(*a)
+		t0 = time()
+		full = full or not self.meta("synced")
+		with self._db:
+			if full:
+				tags = self._sync_full(client, log)
+				self._set_meta(full_synced=int(t0))
+			else:
+				tags = self._sync_changes(client, log)
+			self._set_meta(synced=int(t0), server=self.cfg.server, posts=len(self), tags=len(tags),
+			               watermark=self._watermark() or u"")
+		self._load_tags()
+		log("%s sync of %d posts and %d tags in %.1fs" % ("Full" if full else "Incremental", len(self), len(tags), time() - t0))
+
+	_sync_wanted = u" Ftagguid Ftagname Ftagdata Fimplied" + u"".join(u" F" + f for f in _post_fields)
+
+	def _sync_full(self, client, log):
+		for table in _tables[1:]:
+			self._db.execute("DELETE FROM " + table)
+		log("Fetching tags")
+		tags = client.find_tags(u"EAI", u"")
+		self._store_tags(tags)
+		log("Fetching posts")
+		md5s = self._fetch_posts(client, [u"SP" + self._sync_wanted])
+		log("Fetching implications")
+		self._fetch_implications(client, [t.guid for t in tags])
+		log("Fetching relations")
+		self._fetch_rels(client, md5s)
+		self._fetch_orders(client, tags, log)
+		return tags
+
+	def _sync_changes(self, client, log):
+		"""Find and fetch what changed since the last sync.
+
+		The protocol has no change log, so this compares:
+		  Posts with a "changed" datatag newer than the watermark
+		  (the newest one seen at the last sync), if the server has it.
+		  These are the only posts that can have been added, moved or
+		  (un)tagged, so the post order only has to be checked for
+		  deleted posts, see _server_md5s_since.
+		  The tag list (with post counts) with the stored tags. Tags
+		  whose counts changed by something other than what the posts
+		  fetched here account for have their posts listed and compared
+		  with the stored ones. Without the changed datatag that is done
+		  for all tags, and for the post order (see _server_md5s).
+		  All implications (one IS per tag) with the stored ones.
+		  Posts with tags whose implications changed count as changed.
+		  The group orders of ordered tags with the stored ones.
+		Posts found this way are fetched again, with their relations.
+
+		Without the changed datatag, changes that don't alter which
+		posts have which tags (only values, or only fields) are missed.
+		Run a full sync now and then if your server is like that.
+		"""
+		db = self._db
+		log("Fetching tags")
+		tags = client.find_tags(u"EAI", u"")
+		rows = dict((t.guid, self._tag_row(t)) for t in tags)
+		removed_tags = [g for g in self._tags if g not in rows]
+		log("Comparing posts")
+		stored = [r[0] for r in db.execute("SELECT md5 FROM posts ORDER BY pos")]
+		watermark = self.meta("watermark")
+		if watermark and _changed_guid in rows:
+			spec = (_changed_guid, u">=", vtparse(rows[_changed_guid][3], watermark))
+			touched = set(p.md5 for p in client.search_post(guids=[spec]))
+			order = self._server_md5s_since(client, stored, touched)
+			recount = None # decided by the counts, after fetching
+		else:
+			touched = set()
+			order = self._server_md5s(client)
+			# One post tagged and another untagged leaves the count as it was.
+			recount = list(rows)
+		stored_set = set(stored)
+		order_set = set(order)
+		deleted = stored_set - order_set
+		new = order_set - stored_set
+		changed = new | touched
+		for guid in recount or ():
+			changed.update(self._tag_diff(client, guid))
+		for guid in removed_tags:
+			changed.update(self._tag_members(guid))
+		log("Fetching implications")
+		# Posts with tags that imply something else now have new implied tags.
+		for guid in self._fetch_implications(client, [t.guid for t in tags]):
+			changed.update(self._tag_members(guid))
+		changed -= deleted
+		changed = sorted(changed)
+		log("%d new, %d deleted, %d changed posts, %d changed tags" % (
+			len(new), len(deleted), len(changed) - len(new),
+			len([g for g, row in rows.items() if self._tags.get(g) != row]) + len(removed_tags),
+		))
+		before = self._tag_counts(changed + sorted(deleted))
+		self._delete_posts(sorted(deleted))
+		for chunk in _chunks(removed_tags):
+			db.execute("DELETE FROM tags WHERE guid IN (" + u",".join(u"?" * len(chunk)) + ")", chunk)
+		db.execute("DELETE FROM aliases")
+		self._store_tags(tags)
+		if changed:
+			log("Fetching posts")
+			self._fetch_posts(client, [u"SPM" + m + self._sync_wanted for m in changed], missing_ok=True)
+		if recount is None:
+			after = self._tag_counts(changed)
+			def miscounted(guid):
+				old = self._tags[guid][4:6] if guid in self._tags else (0, 0)
+				b, a = before.get(guid, (0, 0)), after.get(guid, (0, 0))
+				return (rows[guid][4] - old[0], rows[guid][5] - old[1]) != (a[0] - b[0], a[1] - b[1])
+			recount = [g for g in rows if miscounted(g)]
+			if recount:
+				log("Comparing posts of %d tags" % (len(recount),))
+			more = set()
+			for guid in recount:
+				more.update(self._tag_diff(client, guid))
+			more = sorted(more - set(changed))
+			if more:
+				self._fetch_posts(client, [u"SPM" + m + self._sync_wanted for m in more], missing_ok=True)
+				changed += more
+		if changed:
+			self._fetch_rels(client, changed, refresh=True)
+		if order != stored:
+			old = dict((m, pos) for pos, m in enumerate(stored))
+			db.executemany("UPDATE posts SET pos = ? WHERE md5 = ?",
+			               [(pos, m) for pos, m in enumerate(order) if old.get(m) != pos])
+		self._fetch_orders(client, tags, log, refresh=True)
+		return tags
+
+	def _tag_diff(self, client, guid):
+		"""Posts that have guid either on the server or in the replica."""
+		members = self._tag_members(guid)
+		return set(self._server_md5s(client, guids=[guid])).symmetric_difference(members)
+
+	def _tag_counts(self, md5s):
+		"""{guid: [posts, weak posts]} like the server counts them (not
+		implied or datatags), but counting only the stored md5s.
+		"""
+		res = {}
+		for chunk in _chunks(md5s):
+			for guid, flags in self._db.execute(
+				"SELECT guid, flags FROM post_tags WHERE post IN (SELECT id FROM posts WHERE md5 IN (" + u",".join(u"?" * len(chunk)) + "))", chunk
+			):
+				if u"I" not in flags and u"D" not in flags:
+					res.setdefault(guid, [0, 0])[u"~" in flags] += 1
+		return res
+
+	def _server_md5s(self, client, **search):
+		"""The md5s of the posts search (search_post arguments except
+		range) gives on the server, in order.
+		Only bare md5s, fetched _page at a time, which is cheap next to
+		fetching the posts.
+		"""
+		props = {}
+		client.search_post(range=(0, 0), props=props, **search)
+		return self._fetch_md5s(client, 0, props.get("result_count", 0) - 1, search)
+
+	def _fetch_md5s(self, client, first, last, search):
+		res = []
+		for ix in range(first, last + 1, _page):
+			res.extend(p.md5 for p in client.search_post(range=(ix, min(ix + _page - 1, last)), **search))
+		return res
+
+	def _server_positions(self, client, md5s, search):
+		"""{md5: offset in the result of search} for the md5s it has."""
+		res = {}
+		def read(cmd):
+			while True:
+				line = client._readline_raw()
+				if line[:2] == b"RE": return # not in the result
+				if line == b"OK": break
+				if line[:2] == b"RR":
+					res[cmds[cmd]] = int(line[2:].split(b":")[1], 16)
+		cmds = dict((u"SP" + client._build_search(range=(m, 1), **search), m) for m in md5s)
+		_pipelined(client, list(cmds), read)
+		return res
+
+	def _server_md5s_since(self, client, stored, touched, **search):
+		"""Like _server_md5s, but only fetches the parts that changed.
+		stored is what search gave at the last sync, and only the posts
+		in touched can have been added or moved since (the rest can
+		only have been removed).
+
+		The offsets of the touched posts on the server, and the total,
+		tell how many posts were removed between any two stored posts
+		by comparing where they are. Stretches with none removed are
+		kept, the others are split (looking up the offset of a stored
+		post in the middle) until they are small enough to fetch.
+		"""
+		props = {}
+		client.search_post(range=(0, 0), props=props, **search)
+		total = props.get("result_count", 0)
+		placed = self._server_positions(client, sorted(touched), search)
+		offsets = sorted(placed.values())
+		kept = [m for m in stored if m not in touched]
+		def position(ix):
+			return self._server_positions(client, [kept[ix]], search).get(kept[ix])
+		def fetch(first, last):
+			return [m for m in self._fetch_md5s(client, first, last, search) if m not in touched]
+		def walk(a, pa, b, pb):
+			# kept[a] is at pa and kept[b] at pb on the server
+			between = bisect_left(offsets, pb) - bisect_right(offsets, pa)
+			removed = (b - a) - (pb - pa - between)
+			if removed == 0:
+				return kept[a + 1:b]
+			if removed > 0 and b - a > _walk_fetch:
+				mid = (a + b) // 2
+				for m in (mid, mid + 1, mid - 1, mid + 2, mid - 2):
+					pm = position(m)
+					if pm is not None:
+						if pa < pm < pb:
+							return walk(a, pa, m, pm) + [kept[m]] + walk(m, pm, b, pb)
+						break # moved, so touched was incomplete
+			return fetch(pa + 1, pb - 1)
+		rest = iter(walk(-1, -1, len(kept), total))
+		res = [None] * total
+		for m, pos in placed.items():
+			if pos < total:
+				res[pos] = m
+		res = [m or next(rest, None) for m in res]
+		if None in res or next(rest, None) is not None or len(set(res)) != total:
+			# The server changed while walking (or touched was incomplete).
+			return self._server_md5s(client, **search)
+		return res
+
+	def _tag_members(self, guid):
+		"""md5s of the stored posts with guid, in order."""
+		return [r[0] for r in self._db.execute(
+			"SELECT md5 FROM posts WHERE id IN (SELECT post FROM post_tags WHERE guid = ?) ORDER BY pos", (guid,)
+		)]
+
+	def _delete_posts(self, md5s):
+		db = self._db
+		for chunk in _chunks(md5s):
+			marks = u",".join(u"?" * len(chunk))
+			ids = [r[0] for r in db.execute("SELECT id FROM posts WHERE md5 IN (" + marks + ")", chunk)]
+			idmarks = u",".join(u"?" * len(ids))
+			db.execute("DELETE FROM post_tags WHERE post IN (" + idmarks + ")", ids)
+			db.execute("DELETE FROM orders WHERE post IN (" + idmarks + ")", ids)
+			db.execute("DELETE FROM posts WHERE id IN (" + idmarks + ")", ids)
+			db.execute("DELETE FROM rels WHERE md5 IN (" + marks + ") OR rel IN (" + marks + ")", chunk + chunk)
+
+	def _watermark(self):
+		"""Newest changed datatag value in the replica."""
+		return self._db.execute("SELECT MAX(value) FROM post_tags WHERE guid = ?", (_changed_guid,)).fetchone()[0]
+
+	def _store_tags(self, tags):
+		self._db.executemany(
+			"INSERT OR REPLACE INTO tags (guid, name, type, valuetype, posts, weak_posts, flags) VALUES (?, ?, ?, ?, ?, ?, ?)",
+			[self._tag_row(t) for t in tags]
+		)
+		self._db.executemany(
+			"INSERT OR REPLACE INTO aliases (name, guid) VALUES (?, ?)",
+			[(a, t.guid) for t in tags for a in t.alias]
+		)
+
+	def _tag_row(self, t):
+		flags = u" ".join(sorted(k for k, v in t.items() if v is True))
+		return (t.guid, t.name, t.get("type"), t.get("valuetype"), t.get("posts") or 0, t.get("weak_posts") or 0, flags)
+
+	def _fetch_posts(self, client, cmds, missing_ok=False):
+		"""Run the search commands, storing the raw results.
+		Posts that are already stored are updated (keeping the id),
+		new ones get pos in result order. Returns the md5s.
+		"""
+		db = self._db
+		md5s = []
+		seen_tags = {}
+		pos = [db.execute("SELECT COUNT(*) FROM posts").fetchone()[0]]
+		def read(cmd):
+			while True:
+				line = client._readline_raw()
+				if line == b"OK": break
+				if line[:1] != b"R" or line[1:2] == b"E":
+					if missing_ok and line[:2] == b"RE": break
+					raise ResponseError(line.decode("utf-8"))
+				if line[1:2] == b"R": continue
+				post, tags = self._parse_raw_post(line.decode("utf-8"), seen_tags)
+				values = [post.get(f) for f in _post_fields]
+				row = db.execute("SELECT id FROM posts WHERE md5 = ?", (post["md5"],)).fetchone()
+				if row:
+					post_id = row[0]
+					db.execute("UPDATE posts SET " + u", ".join(f + " = ?" for f in _post_fields) + " WHERE id = ?", values + [post_id])
+					db.execute("DELETE FROM post_tags WHERE post = ?", (post_id,))
+				else:
+					cur = db.execute("INSERT INTO posts (md5, " + u", ".join(_post_fields) + ", pos) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+					                 [post["md5"]] + values + [pos[0]])
+					post_id = cur.lastrowid
+					pos[0] += 1
+				db.executemany("INSERT INTO post_tags (post, guid, flags, value, num_value, num_min, num_max, num_steps) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+				               [(post_id,) + t for t in tags])
+				md5s.append(post["md5"])
+		_pipelined(client, cmds, read)
+		# Datatags (and anything else not in the tag list) still need names.
+		db.executemany("INSERT OR IGNORE INTO tags (guid, name, type, valuetype, flags) VALUES (?, ?, ?, ?, '')",
+		               [(g,) + v for g, v in seen_tags.items()])
+		return md5s
+
+	def _parse_raw_post(self, line, seen_tags):
+		"""The fields and [(guid, flags, value, num_value, num_min,
+		num_max, num_steps)] from an RP line, with the values left as
+		the server sent them (see _numbers for the rest).
+		"""
+		pieces = line[1:].split(u" :")
+		post = {}
+		for token in pieces[0].split():
+			if token[0] == u"P":
+				post["md5"] = token[1:]
+			elif token[0] == u"F":
+				field, value = token[1:].split(u"=", 1)
+				post[field] = value
+		tags = []
+		for piece in pieces[1:-1]:
+			flags, data = piece.split(u" ", 1)
+			guid = name = type = valuetype = value = None
+			for token in data.split():
+				c = token[0]
+				if c == u"G":
+					guid = token[1:]
+				elif c == u"N":
+					name = token[1:]
+				elif c == u"T":
+					type = token[1:]
+				elif c == u"V":
+					valuetype = token[1:]
+					if u"=" in valuetype:
+						valuetype, value = valuetype.split(u"=", 1)
+			tags.append((guid, flags, value) + _numbers(valuetype, value))
+			if guid not in seen_tags:
+				seen_tags[guid] = (name, type, valuetype)
+		return post, tags
+
+	def _fetch_implications(self, client, guids):
+		"""Replace the stored implications with those of guids.
+		Returns the set guids that have different implications now.
+		"""
+		db = self._db
+		rows = []
+		def read(cmd):
+			data = {}
+			while True:
+				line = client._readline()
+				if line[:2] == u"RE": raise ResponseError(line)
+				if not client._parse_implies(line, data): break
+			for set_guid, impls in data.items():
+				for impl in impls:
+					rows.append(self._implication_row(set_guid, impl))
+		_pipelined(client, [u"IS" + g for g in guids], read)
+		old, new = {}, {}
+		for row in db.execute("SELECT * FROM implications ORDER BY rowid"):
+			old.setdefault(row[0], []).append(row)
+		for row in rows:
+			new.setdefault(row[0], []).append(row)
+		db.execute("DELETE FROM implications")
+		db.executemany(
+			"INSERT INTO implications (set_guid, filter_comp, filter_value, guid, prio, value) VALUES (?, ?, ?, ?, ?, ?)",
+			rows
+		)
+		return set(g for g in set(old) | set(new) if old.get(g) != new.get(g))
+
+	def _implication_row(self, set_guid, impl):
+		comp = fvalue = value = None
+		if impl.filter:
+			comp, fvalue = impl.filter[0], impl.filter[1].format()
+		if impl.value is InheritValue:
+			value = u""
+		elif impl.value is not None:
+			value = impl.value.format()
+		return (set_guid, comp, fvalue, impl.guid, impl.prio, value)
+
+	def _fetch_rels(self, client, md5s, refresh=False):
+		"""Store the relations of md5s, replacing any stored ones
+		(on both sides) if refresh.
+		"""
+		db = self._db
+		if refresh:
+			for chunk in _chunks(md5s):
+				marks = u",".join(u"?" * len(chunk))
+				db.execute("DELETE FROM rels WHERE md5 IN (" + marks + ") OR rel IN (" + marks + ")", chunk + chunk)
+		fetched = set(md5s) if refresh else ()
+		rows = []
+		def read(cmd):
+			rels = {}
+			while not client._parse_rels(client._readline(), rels): pass
+			md5 = cmd[2:]
+			for rel in rels.get(md5, ()):
+				rows.append((md5, rel))
+				# The other side wasn't fetched, but lost this in the DELETE.
+				if refresh and rel not in fetched:
+					rows.append((rel, md5))
+		_pipelined(client, [u"RS" + m for m in md5s], read)
+		db.executemany("INSERT INTO rels (md5, rel) VALUES (?, ?)", rows)
+
+	def _fetch_orders(self, client, tags, log, refresh=False):
+		"""Store the group order of the ordered tags. With refresh
+		only the ones that changed are replaced.
+		"""
+		db = self._db
+		ordered = [t.guid for t in tags if t.get("ordered")]
+		if refresh:
+			stored = {}
+			for guid, md5 in db.execute("SELECT guid, md5 FROM orders JOIN posts ON posts.id = orders.post ORDER BY orders.pos"):
+				stored.setdefault(guid, []).append(md5)
+			db.executemany("DELETE FROM orders WHERE guid = ?", [(g,) for g in stored if g not in ordered])
+		if not ordered: return
+		log("Fetching orders")
+		ids = dict(db.execute("SELECT md5, id FROM posts"))
+		for guid in ordered:
+			if refresh:
+				md5s = self._server_md5s(client, guids=[guid], order=u"group")
+				if md5s == stored.get(guid, []): continue
+				db.execute("DELETE FROM orders WHERE guid = ?", (guid,))
+			else:
+				md5s = [p.md5 for p in client.search_post(guids=[guid], order=u"group")]
+			db.executemany("INSERT INTO orders (guid, pos, post) VALUES (?, ?, ?)",
+			               [(guid, pos, ids[m]) for pos, m in enumerate(md5s) if m in ids])
+
+	# Searching
+
+	def _tagspec(self, spec):
+		"""(prefix, guid, comparison, value) from a T/t clause."""
+		prefix = u""
+		if spec[0] in u"~!":
+			prefix, spec = spec[0], spec[1:]
+		if spec[0] != u"G": raise ResponseError(u"REbad tag spec " + spec)
+		guid, rest = spec[1:28], spec[28:]
+		if guid not in self._tags: raise ResponseError(u"REno tag " + guid)
+		if not rest:
+			return prefix, guid, None, None
+		for comp in _comps:
+			if rest.startswith(comp): break
+		else:
+			raise ResponseError(u"REbad comparison " + rest)
+		return prefix, guid, comp, vtparse(self._tags[guid][3], rest[len(comp):])
+
+	def _bitmaps(self):
+		if self._bitmaps_cache is None:
+			self._bitmaps_cache = _Bitmaps(self)
+		return self._bitmaps_cache
+
+	def _parse_clauses(self, clauses):
+		"""A search in the server syntax (split in clauses) as
+		(want, dontwant, order, wanted, range).
+		"""
+		want = []
+		dontwant = []
+		order = []
+		wanted = set()
+		range = None
+		for c in clauses:
+			if c[0] == u"F":
+				wanted.add(c[1:])
+			elif c[0] == u"T":
+				want.append(self._tagspec(c[1:]))
+			elif c[0] == u"t":
+				dontwant.append(self._tagspec(c[1:]))
+			elif c[0] == u"O":
+				order.append(c[1:])
+			elif c[0] == u"R":
+				range = c[1:]
+			else:
+				raise ResponseError(u"REbad search clause " + c)
+		return want, dontwant, order, wanted, range
+
+	def _evaluate(self, clauses):
+		"""Run a search in the server syntax (split in clauses).
+		Returns (post ids in order, wanted, range).
+		"""
+		want, dontwant, order, wanted, range = self._parse_clauses(clauses)
+		bitmaps = self._bitmaps()
+		ids = bitmaps.posts(bitmaps.search(want, dontwant))
+		for o in reversed(order):
+			ids = self._sort(ids, o, want)
+		return ids, wanted, range
+
+	def _sort(self, ids, o, want):
+		reverse = o[:1] == u"-"
+		if reverse: o = o[1:]
+		if o == u"group":
+			if not want: raise ResponseError(u"REgroup order without tag")
+			pos = dict(self._db.execute("SELECT post, pos FROM orders WHERE guid = ?", (want[0][1],)).fetchall())
+			key = lambda i: (i not in pos, pos.get(i))
+		else:
+			if o not in self._tags: raise ResponseError(u"REno tag " + o)
+			bitmaps = self._bitmaps()
+			column = bitmaps.column(o)
+			if column and column.first is not None:
+				return column.sort(ids, [bitmaps.pos[i] for i in ids], reverse)
+			valuetype = self._tags[o][3]
+			values = {}
+			for post, v in self._db.execute("SELECT post, value FROM post_tags WHERE guid = ? AND value IS NOT NULL", (o,)):
+				values.setdefault(post, vtparse(valuetype, v).value)
+			key = lambda i: (i not in values, values.get(i))
+		try:
+			return sorted(ids, key=key, reverse=reverse)
+		except TypeError:
+			raise ResponseError(u"REcan't sort on " + o)
+
+	def _range(self, ids, range):
+		if range is None:
+			return ids, None
+		if range[0] == u"M":
+			a = range[1:].split(u":")
+			row = self._db.execute("SELECT id FROM posts WHERE md5 = ?", (a[0],)).fetchone()
+			try:
+				first = ids.index(row[0]) if row else -1
+			except ValueError:
+				first = -1
+			if first < 0: raise ResponseError(u"RErange anchor not found")
+			if len(a) > 1:
+				return ids[first:first + int(a[1])], first
+			return ids[first:], first
+		a, b = range.split(u":")
+		first = int(a, 16)
+		return ids[first:int(b, 16) + 1], first
+
+	def _post_lines(self, ids, wanted):
+		"""Result lines (as the server would send them) for ids."""
+		want_tags = u"tagguid" in wanted or u"tagname" in wanted
+		want_implied = u"implied" in wanted
+		fields = [f for f in _post_fields if f in wanted]
+		for chunk in _chunks(ids):
+			marks = u",".join(u"?" * len(chunk))
+			rows = {}
+			for row in self._db.execute("SELECT id, md5, " + u", ".join(_post_fields) + " FROM posts WHERE id IN (" + marks + ")", chunk):
+				rows[row[0]] = row
+			tags = {}
+			if want_tags:
+				for post, guid, flags, value in self._db.execute("SELECT post, guid, flags, value FROM post_tags WHERE post IN (" + marks + ") ORDER BY rowid", chunk):
+					tags.setdefault(post, []).append((guid, flags, value))
+			for i in chunk:
+				row = rows[i]
+				line = [u"RP", row[1]]
+				for f in fields:
+					v = row[2 + _post_fields.index(f)]
+					if v is not None:
+						line.append(u" F%s=%s" % (f, v))
+				for guid, flags, value in tags.get(i, ()):
+					if not want_implied:
+						flags = flags.replace(u"I", u"")
+					line.append(self._tag_piece(guid, flags, value, wanted))
+				line.append(u" :")
+				yield u"".join(line)
+
+	def _tag_piece(self, guid, flags, value, wanted):
+		guid, name, type, valuetype = self._tags[guid][:4]
+		res = [u" :", flags]
+		if u"tagguid" in wanted:
+			res.append(u" G" + guid)
+		if u"tagname" in wanted:
+			res.append(u" N" + name)
+		if u"tagdata" in wanted:
+			if type:
+				res.append(u" T" + type)
+			if valuetype:
+				res.append(u" V" + valuetype)
+				if value is not None:
+					res.append(u"=" + value)
+		return u"".join(res)
+
+	def _search(self, search, wanted, props, compact):
+		"""Answer search (an SP command) like the server would, parsing
+		the answer with the normal client code.
+		"""
+		self._check_changed()
+		if search.startswith(u"SPM"):
+			a = search[3:].split(u" ")
+			row = self._db.execute("SELECT id FROM posts WHERE md5 = ?", (a[0],)).fetchone()
+			ids = [row[0]] if row else []
+			swanted = set(c[1:] for c in a[1:])
+			lines = []
+		else:
+			ids, swanted, range = self._evaluate(search[2:].split())
+			total = len(ids)
+			ids, first = self._range(ids, range)
+			lines = [u"RR%x" % (total,) if first is None else u"RR%x:%x" % (total, first)]
+		lines.extend(self._post_lines(ids, swanted))
+		lines.append(u"OK")
+		posts = []
+		intern = self._local._new_intern()
+		parse = self._local._parse_search
+		for line in lines:
+			parse(line.encode("utf-8"), posts, wanted, props, compact, intern)
+		return posts
+
+	def search_post(self, wanted=None, props=None, compact=False, **kw):
+		"""Like Client.search_post."""
+		search = u"SP" + self._local._build_search(wanted=wanted, **kw)
+		return self._search(search, wanted, props, compact)
+
+	def get_post(self, md5, separate_implied=False, wanted=None, compact=False):
+		"""Like Client.get_post."""
+		search, wanted = self._local._get_post_search(md5, separate_implied, wanted)
+		posts = self._search(search, wanted, None, compact)
+		return self._local._get_post_result(md5, posts)
+
+	# Tags
+
+	def _tag_line(self, guid, counts=None):
+		guid, name, type, valuetype, posts, weak_posts, flags = self._tags[guid]
+		if counts:
+			posts, weak_posts = counts
+		res = [u"RG%s N%s" % (guid, name)]
+		if type:
+			res.append(u" T" + type)
+		if valuetype:
+			res.append(u" V" + valuetype)
+		for a in self._aliases.get(guid, ()):
+			res.append(u" A" + a)
+		res.append(u" P%x W%x" % (posts, weak_posts))
+		for f in flags.split():
+			res.append(u" F" + f)
+		return u"".join(res)
+
+	def _match_tags(self, matchtype, name):
+		for ix, c in enumerate(matchtype):
+			if c in u"NGIP":
+				how, where = matchtype[:ix], c
+				break
+		else:
+			raise ResponseError(u"REbad matchtype " + matchtype)
+		aliases = u"A" in how
+		if where == u"G":
+			return [name] if name in self._tags else []
+		if u"F" in how:
+			name = _fuzz(name)
+			norm = _fuzz
+		else:
+			norm = lambda n: n
+		if where == u"N" and not u"F" in how:
+			guid = self._names.get(name)
+			if guid and (aliases or self._tags[guid][1] == name):
+				return [guid]
+			return []
+		if where == u"N":
+			match = lambda n: norm(n) == name
+		elif where == u"I":
+			match = lambda n: norm(n).startswith(name)
+		else:
+			match = lambda n: name in norm(n)
+		res = []
+		for guid, row in self._tags.items():
+			if match(row[1]) or (aliases and any(match(a) for a in self._aliases.get(guid, ()))):
+				res.append(guid)
+		return res
+
+	def find_tags(self, matchtype, name, range=None, order=None, flags=None, **kw):
+		"""Like Client.find_tags."""
+		self._check_changed()
+		guids = sorted(self._match_tags(matchtype, name), key=lambda g: self._tags[g][1])
+		counts = None
+		if kw:
+			want, dontwant = self._parse_clauses(self._local._build_search(**kw).split())[:2]
+			bitmaps = self._bitmaps()
+			bits = bitmaps.search(want, dontwant)
+			# Only tags that are on some post can be on the matching ones.
+			guids = [g for g in guids if self._tags[g][4] or self._tags[g][5]]
+			bitmaps._load(guids)
+			counts = {}
+			for guid in guids:
+				strong, weak = bitmaps.tag(guid)[2:4]
+				c = (_popcount(strong & bits), _popcount(weak & bits))
+				if c != (0, 0):
+					counts[guid] = c
+			guids = [g for g in guids if g in counts]
+		for o in self._local._list(order):
+			reverse = o[:1] == u"-"
+			if reverse: o = o[1:]
+			if o == u"post":
+				if counts:
+					key = lambda g: sum(counts[g])
+				else:
+					key = lambda g: self._tags[g][4] + self._tags[g][5]
+			elif o == u"name":
+				key = lambda g: self._tags[g][1]
+			else:
+				raise ResponseError(u"REbad tag order " + o)
+			guids.sort(key=key, reverse=reverse)
+		for f in self._local._list(flags):
+			negate = f[:1] == u"-"
+			if negate: f = f[1:]
+			guids = [g for g in guids if (f in self._tags[g][6].split()) != negate]
+		if range is not None:
+			guids = guids[range[0]:range[1] + 1]
+		tags = []
+		for guid in guids:
+			self._local._parse_tagres(self._tag_line(guid, counts and counts[guid]), tags)
+		return tags
+
+	def find_tag(self, name, resdata=None, with_prefix=False):
+		return self._local.find_tag(name, resdata, with_prefix)
+
+	def get_tag(self, guid, with_prefix=False):
+		return self._local.get_tag(guid, with_prefix)
+
+	def parse_tag(self, spec, comparison=False):
+		return self._local.parse_tag(spec, comparison)
+
+	def resolve_tags(self, specs, comparison=False):
+		return self._local.resolve_tags(specs, comparison)
+
+	def _implication(self, row, reverse):
+		set_guid, comp, fvalue, guid, prio, value = row
+		filter = None
+		if comp:
+			filter = (comp, vtparse(self._tags[set_guid][3], fvalue))
+		if value == u"":
+			value = InheritValue
+		elif value is not None:
+			value = vtparse(self._tags[guid.lstrip(u"-")][3], value)
+		if reverse:
+			guid = (u"-" if guid[0] == u"-" else u"") + set_guid
+		return ImplicationTuple(str(guid), prio, filter, value)
+
+	def tag_implies(self, tag, reverse=False):
+		"""Like Client.tag_implies."""
+		self._check_changed()
+		if reverse:
+			rows = self._db.execute("SELECT * FROM implications WHERE guid IN (?, ?) ORDER BY rowid", (tag, u"-" + tag))
+			return [self._implication(row, True) for row in rows]
+		rows = self._db.execute("SELECT * FROM implications WHERE set_guid = ? ORDER BY rowid", (tag,))
+		return [self._implication(row, False) for row in rows]
+
+	def post_rels(self, md5):
+		"""Like Client.post_rels."""
+		rels = [r[0] for r in self._db.execute("SELECT rel FROM rels WHERE md5 = ? ORDER BY rowid", (md5,))]
+		return rels or None
+
+def main(arg0, argv):
+	from argparse import ArgumentParser
+	from time import localtime, strftime
+	parser = ArgumentParser(prog=arg0, description="Keep a local copy of the database")
+	parser.add_argument("-f", "--file", help="replica file (default replica= from the config, or in ~/.cache)")
+	parser.add_argument("-q", "--quiet", action="store_true")
+	parser.add_argument("--full", action="store_true", help="copy everything, not just what changed since the last sync")
+	parser.add_argument("command", choices=("sync", "info"))
+	args = parser.parse_args(argv)
+	with Replica(args.file) as replica:
+		if args.command == "sync":
+			replica.sync(verbose=not args.quiet, full=args.full)
+		else:
+			fmt = lambda t: strftime("%Y-%m-%d %H:%M:%S", localtime(int(t))) if t else "never"
+			print("File:  ", replica.path)
+			print("Synced:", fmt(replica.meta("synced")), "(full %s)" % (fmt(replica.meta("full_synced")),))
+			print("Server:", replica.meta("server", "-"))
+			print("Posts: ", len(replica))
+			print("Tags:  ", len(replica._tags))
+	return 0
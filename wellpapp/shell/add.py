@@ -7,6 +7,7 @@ from io import BytesIO
 from os.path import basename, dirname, realpath, exists, lexists, join, sep
 from os import readlink, symlink, unlink, stat
 from wellpapp import Client, VTstring, make_pdirs, RawWrapper, identify_raw, ExifWrapper, raw_exts, VTgps
+from wellpapp.statcache import stat_t, append_stat_cache
 from struct import unpack
 from multiprocessing import Lock, cpu_count, Queue, Process, Manager
 from traceback import print_exc
@@ -228,7 +229,19 @@ def main(arg0, argv):
 				print("Unknown tag " + s)
 
 		def update(self, l):
-			[self.add_spec(s) for s in l]
+			l = list(l)
+			try:
+				with lock:
+					res = client.resolve_tags(l)
+			except Exception:
+				# One at a time to find which one(s) failed
+				[self.add_spec(s) for s in l]
+				return
+			for s, t in zip(l, res):
+				if t:
+					self.add(t)
+				else:
+					print("Unknown tag " + s)
 
 		def update_tags(self, l):
 			[self.add((t.pguid, t.value)) for t in l]
@@ -263,15 +276,9 @@ def main(arg0, argv):
 		cache_fn = client.cfg.image_base + "/cache"
 		if exists(cache_fn):
 			s = stat(fn)
-			z = s.st_size
-			mt = int(s.st_mtime)
-			if jz:
-				l = "1 %s %d %d %d %s\n" % (m, z, mt, jz, fn)
-			else:
-				l = "0 %s %d %d %s\n" % (m, z, mt, fn)
+			st = stat_t(1 if jz else 0, s.st_size, int(s.st_mtime), fn, jz or 0)
 			with lock:
-				with open(cache_fn, "a", encoding="utf-8") as fh:
-					fh.write(l)
+				append_stat_cache(cache_fn, m, st)
 
 	def add_image(fn, m, data, warn_q):
 		fn = realpath(fn)
@@ -414,7 +421,8 @@ def main(arg0, argv):
 	if args.thumb_src:
 		args.regenerate_thumbnail = True
 
-	client = Client()
+	# The same TAGS files are parsed for every file added.
+	client = Client(tag_cache=1024)
 	lock = Lock()
 
 	if args.thumb_src:
@@ -0,0 +1,2 @@
+# The benchmarks live in wellpapp.bench so they also work as "python -m".
+from wellpapp.bench import main
@@ -127,7 +127,7 @@ def main(arg0, argv):
 
 	posts = {}
 	for s in spec.search:
-		ps = src_client.search_post(wanted=["tagguid", "tagname", "implied", "ext", "width", "height", "rotate", "tagdata", "datatags"], **s)
+		ps = src_client.search_post(wanted=["tagguid", "tagname", "implied", "ext", "width", "height", "rotate", "tagdata", "datatags"], compact=True, **s)
 		for p in ps:
 			posts[p.md5] = p
 	md5s = set(posts.keys())
@@ -211,60 +211,60 @@ def main(arg0, argv):
 
 	dest_client.begin_transaction()
 
-	print("Tags..")
-	ordered = set()
-	for t in spec.include:
-		tag = src_client.get_tag(t)
-		dest_client.add_tag(tag.name, tag.type, tag.guid, tag.valuetype)
-		if "alias" in tag:
-			for alias in tag.alias:
-				dest_client.add_alias(alias, tag.guid)
-		if tag.ordered: ordered.add(tag.guid)
-
-	for t in spec.include:
-		for impl in src_client.tag_implies(t):
-			if impl.guid in spec.include:
-				dest_client.add_implies(t, *impl)
-
-	print("Posts..")
-	for post in posts:
-		full = [(t.guid, t.value) for t in post.fulltags if t.guid in spec.include]
-		weak = [(t.guid, t.value) for t in post.weaktags if t.guid in spec.include]
-		data = Post(post)
-		for t in post.datatags:
-			if t.guid in datatags:
-				full.append((t.guid, t.value))
-			if t.guid == "aaaaaa-aaaads-faketg-create":
-				data.created = t.value
-		for d in ("tags", "fulltags", "weaktags", "implfulltags", "implweaktags", "settags", "impltags", "datatags"):
-			del data[d]
-		w, h = map(int, (data.width, data.height))
-		if w > z:
-			h = h * z // w
-			w = z
-		if h > z:
-			w = w * z // h
-			h = z
-		data.width, data.height = w, h
-		data.rotate = 0
-		if data.ext in raw_exts: data.ext = "jpeg"
-		dest_client.add_post(**data)
-		dest_client.tag_post(post.md5, full, weak)
-
-	rels = set()
-	print("Relationships..")
-	for post in posts:
-		all = []
-		for rel in src_client.post_rels(post.md5) or []:
-			if rel + post.md5 not in rels and rel in md5s:
-				rels.add(post.md5 + rel)
-				all.append(rel)
-		if all:
-			dest_client.add_rels(post.md5, all)
-
-	print("Ordering..")
-	for g in ordered:
-		order = [p.md5 for p in src_client.search_post(guids=[g], order=["group"])]
-		dest_client.order(g, [m for m in order if m in md5s])
+	# Everything sent to dest_client from here on only answers OK
+	with dest_client.pipeline():
+		print("Tags..")
+		ordered = set()
+		for t in spec.include:
+			tag = src_client.get_tag(t)
+			dest_client.add_tag(tag.name, tag.type, tag.guid, tag.valuetype)
+			if "alias" in tag:
+				for alias in tag.alias:
+					dest_client.add_alias(alias, tag.guid)
+			if tag.ordered: ordered.add(tag.guid)
+
+		for t in spec.include:
+			for impl in src_client.tag_implies(t):
+				if impl.guid in spec.include:
+					dest_client.add_implies(t, *impl)
+
+		print("Posts..")
+		for post in posts:
+			full = [(t.guid, t.value) for t in post.fulltags if t.guid in spec.include]
+			weak = [(t.guid, t.value) for t in post.weaktags if t.guid in spec.include]
+			data = Post(post) # no tags in this, posts are compact
+			for t in post.datatags:
+				if t.guid in datatags:
+					full.append((t.guid, t.value))
+				if t.guid == "aaaaaa-aaaads-faketg-create":
+					data.created = t.value
+			w, h = map(int, (data.width, data.height))
+			if w > z:
+				h = h * z // w
+				w = z
+			if h > z:
+				w = w * z // h
+				h = z
+			data.width, data.height = w, h
+			data.rotate = 0
+			if data.ext in raw_exts: data.ext = "jpeg"
+			dest_client.add_post(**data)
+			dest_client.tag_post(post.md5, full, weak)
+
+		rels = set()
+		print("Relationships..")
+		for post in posts:
+			all = []
+			for rel in src_client.post_rels(post.md5) or []:
+				if rel + post.md5 not in rels and rel in md5s:
+					rels.add(post.md5 + rel)
+					all.append(rel)
+			if all:
+				dest_client.add_rels(post.md5, all)
+
+		print("Ordering..")
+		for g in ordered:
+			order = [p.md5 for p in src_client.search_post(guids=[g], order=["group"])]
+			dest_client.order(g, [m for m in order if m in md5s])
 
 	dest_client.end_transaction()
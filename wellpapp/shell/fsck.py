@@ -145,9 +145,9 @@ def main(arg0, argv):
 				guids = guids[16:]
 
 	client = Client()
-	posts = client._search_post("SPFtagguid Fimplied Fext", ["tagguid", "datatags", "implied", "ext"])
-	print(len(posts), "posts")
+	posts = client._iter_search("SPFtagguid Fimplied Fext", ["tagguid", "datatags", "implied", "ext"], compact=True)
 	posts = dict(map(lambda f: (f["md5"], f), posts))
+	print(len(posts), "posts")
 	tags = client.find_tags("EAI", "")
 	print(len(tags), "tags")
 	bad_images = None
@@ -5,16 +5,18 @@ import stat
 import errno
 import os
 import sys
-from wellpapp import Client, Tag, raw_exts
+from wellpapp import Client, ClientPool, Tag, raw_exts
+from wellpapp.statcache import StatCache, stat_t as _stat_t
+from wellpapp._util import _LRU
 import re
-from time import time, sleep
+from time import time
 from hashlib import md5
 from struct import pack, unpack
 from zlib import crc32
 from xml.sax.saxutils import escape as xmlescape
 from os.path import exists
-from threading import Thread, RLock, Lock
-from collections import namedtuple
+from threading import Thread, Lock, Event
+from collections import namedtuple, OrderedDict
 
 if not hasattr(fuse, "__version__"):
 	raise RuntimeError("No fuse.__version__, too old?")
@@ -22,8 +24,10 @@ fuse.fuse_python_api = (0, 2)
 
 if sys.version_info[0] == 2:
 	PY3 = False
+	import Queue
 else:
 	PY3 = True
+	import queue as Queue
 	unicode = str
 	unichr = chr
 	if fuse.__version__ < "1.0.0":
@@ -34,14 +38,49 @@ shortmd5re = re.compile(r"^(?:\d{6}\.)?([0-9a-f]{32})$")
 metamd5re = re.compile(r"^(?:\d{6}\.)?([0-9a-f]{32})\.(\w+)\.gq\.xmp$")
 sre = re.compile(r"[ /]+")
 orient = {0: 1, 90: 6, 180: 3, 270: 8}
-default_range = (0, 10000)
+# Searches without R: are read this many posts at a time.
+search_page = 10000
 
-_stat_t = namedtuple("stat_t", ["version", "size", "mtime", "dest", "jpegsize"])
 _search_t = namedtuple("search_t", ["want", "dontwant", "order", "range", "clean"])
 
 def NOTFOUND():
 	raise IOError(errno.ENOENT, "Not found")
 
+class _Locked:
+	"""Context manager giving obj while holding lock."""
+
+	def __init__(self, obj, lock):
+		self._obj = obj
+		self._lock = lock
+
+	def __enter__(self):
+		self._lock.acquire()
+		return self._obj
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self._lock.release()
+
+_missing = object()
+
+class _Memo:
+	"""func with its results (None too, but not exceptions) kept in
+	an _LRU. Safe to call from several threads.
+	"""
+
+	def __init__(self, func, max_size, ttl):
+		self._func = func
+		self._lru = _LRU(max_size, ttl)
+		self._lock = Lock()
+
+	def __call__(self, *a):
+		with self._lock:
+			res = self._lru.get(a, _missing)
+		if res is _missing:
+			res = self._func(*a)
+			with self._lock:
+				self._lru[a] = res
+		return res
+
 class WpStat(fuse.Stat):
 	def __init__(self, mode, nlink, size, time):
 		self.st_mode = mode
@@ -55,27 +94,148 @@ class WpStat(fuse.Stat):
 		self.st_mtime = time
 		self.st_ctime = time
 
+class _Flight:
+	"""A getter call in progress, that others can wait for."""
+
+	def __init__(self):
+		self._event = Event()
+		self._value = self._exc = None
+
+	def done(self, value=None, exc=None):
+		self._value = value
+		self._exc = exc
+		self._event.set()
+
+	def wait(self):
+		self._event.wait()
+		if self._exc is not None:
+			raise self._exc
+		return self._value
+
+def _result_size(value):
+	"""Rough memory use of a _search result, including the thumbnail
+	map that _resolve_thumb may fill in later.
+	"""
+	fns = value[0]
+	return sum(len(fn) for fn in fns) + len(fns) * 300
+
 class Cache:
-	def __init__(self, ttl):
-		self._data = {}
+	"""At most max_entries values using about max_bytes (as measured by
+	sizeof), dropping the least recently used. Values expire ttl seconds
+	after they were fetched.
+
+	The lock is not held while fetching, so fetches of different keys
+	run in parallel. Concurrent gets of the same key wait for one fetch.
+
+	With stale, expired values are still returned for that many more
+	seconds, while a background thread fetches them again. If get was
+	given a check function and check(key, value) says the value is still
+	good, it is kept without fetching it again. But only until it was
+	fetched ttl + stale seconds ago, since check is allowed to be
+	approximate.
+	"""
+
+	def __init__(self, ttl, max_entries=1000, max_bytes=256 << 20, sizeof=_result_size, stale=0):
+		self._data = OrderedDict() # key: (time checked, value, size, time fetched)
+		self._pending = {} # key: _Flight
+		self._refreshing = set()
+		self._queue = None
+		self._bytes = 0
 		self._time = time()
-		self._ttl  = ttl
-		self._lock = RLock()
+		self._ttl = ttl
+		self._stale = stale
+		self._max_entries = max_entries
+		self._max_bytes = max_bytes
+		self._sizeof = sizeof
+		self._lock = Lock()
 
-	def get(self, key, getter):
+	def get(self, key, getter, check=None):
 		with self._lock:
-			if self._time < time() - self._ttl:
-				self._clean()
-			if key not in self._data:
-				self._data[key] = (time(), getter(key))
-			return self._data[key][1]
+			item = self._data.pop(key, None)
+			if item:
+				age = time() - item[0]
+				if age <= self._ttl + self._stale:
+					self._data[key] = item
+					if age > self._ttl:
+						self._revalidate(key, item[1], item[3], getter, check)
+					return item[1]
+				self._bytes -= item[2]
+			flight = self._pending.get(key)
+			fetch = flight is None
+			if fetch:
+				flight = self._pending[key] = _Flight()
+		if not fetch:
+			return flight.wait()
+		try:
+			value = getter(key)
+		except Exception as e:
+			with self._lock:
+				del self._pending[key]
+			flight.done(exc=e)
+			raise
+		with self._lock:
+			del self._pending[key]
+			self._put(key, value)
+		flight.done(value)
+		return value
 
-	def _clean(self):
-		self._time = time()
-		t = self._time - (self._ttl / 1.5)
+	def _revalidate(self, key, value, fetched, getter, check):
+		"""Have the refresher thread fetch key again (lock held)."""
+		if key in self._refreshing:
+			return
+		self._refreshing.add(key)
+		if self._queue is None:
+			self._queue = Queue.Queue()
+			t = Thread(target=self._refresher)
+			t.name = "cache refresher"
+			t.daemon = True
+			t.start()
+		self._queue.put((key, value, fetched, getter, check))
+
+	def _refresher(self):
+		while True:
+			key, value, fetched, getter, check = self._queue.get()
+			try:
+				if check and time() - fetched < self._ttl + self._stale and check(key, value):
+					with self._lock:
+						self._put(key, value, fetched)
+				else:
+					value = getter(key)
+					with self._lock:
+						self._put(key, value)
+			except Exception as e:
+				print("Refreshing", key, "failed:", e)
+				with self._lock:
+					item = self._data.pop(key, None)
+					if item:
+						self._bytes -= item[2]
+			finally:
+				with self._lock:
+					self._refreshing.discard(key)
+
+	def _put(self, key, value, fetched=None):
+		now = time()
+		if fetched is None:
+			fetched = now
+		if self._time < now - self._ttl:
+			self._clean(now)
+		old = self._data.pop(key, None)
+		if old:
+			self._bytes -= old[2]
+		size = self._sizeof(value)
+		self._data[key] = (now, value, size, fetched)
+		self._bytes += size
+		while len(self._data) > self._max_entries or \
+		      (self._bytes > self._max_bytes and len(self._data) > 1):
+			_, (_, _, size, _) = self._data.popitem(last=False)
+			self._bytes -= size
+
+	def _clean(self, now):
+		self._time = now
+		t = now - self._ttl - self._stale
 		too_old = [k for k, v in self._data.items() if v[0] < t]
 		for key in too_old:
-			del self._data[key]
+			self._bytes -= self._data.pop(key)[2]
 
 _thumbpaths = ([".thumblocal", "normal"], [".thumblocal", "large"])
 _cfgpath = "/.wellpapprc"
@@ -104,10 +264,28 @@ class Wellpapp(fuse.Fuse):
 		fuse.Fuse.__init__(self, *a, **kw)
 		self._raw2jpeg = False
 		self._default_search = None
+		self._replica = False
+		self._cache_ttl = 30
+		self._cache_entries = 1000
+		self._cache_mb = 256
+		self._cache_stale = 600
+		self._threads = 4
 		self.parser.add_option(mountopt="raw2jpeg", action="store_true", dest="_raw2jpeg",
 		                       help="Present RAW files as JPEG")
+		self.parser.add_option(mountopt="replica", action="store_true", dest="_replica",
+		                       help="Search in the local replica (see wp replica) instead of on the server")
 		self.parser.add_option(mountopt="default_search", dest="_default_search",
 		                       help="Default search (added to all searches)")
+		self.parser.add_option(mountopt="threads", dest="_threads",
+		                       help="Number of connections to the server [default: 4]")
+		self.parser.add_option(mountopt="cache_ttl", dest="_cache_ttl",
+		                       help="Seconds to cache search results [default: 30]")
+		self.parser.add_option(mountopt="cache_entries", dest="_cache_entries",
+		                       help="Max number of searches to cache [default: 1000]")
+		self.parser.add_option(mountopt="cache_mb", dest="_cache_mb",
+		                       help="Max size of cached search results in MB (roughly) [default: 256]")
+		self.parser.add_option(mountopt="cache_stale", dest="_cache_stale",
+		                       help="Seconds to keep using expired search results while they are refreshed [default: 600]")
 
 	def _cfg2file(self):
 		cfg = self._client.cfg
@@ -120,33 +298,15 @@ class Wellpapp(fuse.Fuse):
 			res = res.encode("utf-8")
 		return res
 
-	def _cache_read(self):
-		self._cache_fh.seek(0, 1)
-		for line in self._cache_fh:
-			try:
-				v, m, size, mtime, dest = line.rstrip("\n").split(" ", 4)
-				if v == "1":
-					jz, dest = dest.split(" ", 1)
-				else:
-					jz = 0
-					assert v == "0"
-				self._stat_cache[m] = _stat_t(int(v), int(size), int(mtime), dest, int(jz))
-			except Exception:
-				print("Bad line in cache:", line)
-
-	def _cache_thread(self):
-		while True:
-			sleep(1)
-			self._cache_read()
 
 	def _prime_stat_cache(self):
 		fn = self._client.cfg.image_base + "/cache"
 		if not exists(fn): return
 		try:
 			print("Loading stat-cache..")
-			self._cache_fh = open(fn, "r", encoding="utf-8") if PY3 else open(fn, "r")
-			self._stat_cache = {}
-			self._cache_read()
+			self._stat_cache = StatCache(fn)
+			if not self._stat_cache.binary:
+				print("Text stat-cache, \"wp make_cache compact\" in image_base makes this faster")
 			self._use_cache = True
 		except Exception as e:
 			print("Failed to load cache:", e)
@@ -154,20 +314,21 @@ class Wellpapp(fuse.Fuse):
 	# Starting threads doesn't work from __init__.
 	def fsinit(self):
 		if self._use_cache:
-			t = Thread(target=self._cache_thread)
+			t = Thread(target=self._stat_cache.follow)
 			t.name = "cache loader"
 			t.daemon = True
 			t.start()
 		print("Ready")
 
 	def _stat(self, m):
-		if m not in self._stat_cache:
+		res = self._stat_cache.get(m)
+		if res is None:
 			print(m, "not in cache")
 			p = self._client.image_path(m)
 			dest = os.readlink(p)
 			st = os.stat(dest)
-			self._stat_cache[m] = _stat_t(0, st.st_size, st.st_mtime, dest, 0)
-		return self._stat_cache[m]
+			res = self._stat_cache[m] = _stat_t(0, st.st_size, st.st_mtime, dest, 0)
+		return res
 
 	def getattr(self, path):
 		path = pathfix(path)
@@ -222,7 +383,7 @@ class Wellpapp(fuse.Fuse):
 			search = self._path2search(path)
 			if not search: NOTFOUND()
 			try:
-				self._cache.get(search, self._search)
+				self._results(search)
 			except Exception:
 				m = shortmd5re.match(spath[-1])
 				if m:
@@ -242,11 +403,11 @@ class Wellpapp(fuse.Fuse):
 				pass
 			if count < 1: count = 1
 		want, dontwant = self._path2search("/" + "/".join(spath))[:2]
-		with self._client_lock:
+		with self._searcher() as searcher:
 			range = (0, count - 1 + len(want))
-			tags = self._client.find_tags("EI", "", range=range, guids=want,
-			                              excl_guids=dontwant, order="-post",
-			                              flags="-datatag")
+			tags = searcher.find_tags("EI", "", range=range, guids=want,
+			                          excl_guids=dontwant, order="-post",
+			                          flags="-datatag")
 		want = [w[0][-27:] for w in want]
 		names = [t.name for t in tags if t.guid not in want]
 		res = "\n".join(names) + "\n"
@@ -254,8 +415,8 @@ class Wellpapp(fuse.Fuse):
 
 	def _generate_meta(self, m):
 		data = u"""<?xml version="1.0" encoding="UTF-8"?><x:xmpmeta xmlns:x="adobe:ns:meta/" x:xmptk="XMP Core 4.1.1-Exiv2"><rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#"><rdf:Description rdf:about="" xmlns:tiff="http://ns.adobe.com/tiff/1.0/" xmlns:dc="http://purl.org/dc/elements/1.1/" """
-		with self._client_lock:
-			post = self._client.get_post(m, wanted=["tagname", "tagdata", "rotate"])
+		with self._pool.client() as client:
+			post = client.get_post(m, wanted=["tagname", "tagdata", "rotate"])
 		if "rotate" in post and post.rotate.value in orient:
 			data += u"tiff:Orientation=\"" + unicode(orient[post.rotate.value]) + u"\""
 		data += u"><dc:subject><rdf:Bag>"
@@ -267,14 +428,17 @@ class Wellpapp(fuse.Fuse):
 
 	def _resolve_thumb(self, search, thumbname):
 		thumbmd5 = thumbname[:32]
-		fns, pcache = self._cache.get(search, self._search)
+		fns, pcache = self._results(search)[:2]
 		if not pcache:
+			# Filled in one go, so other threads never see half of it.
+			res = {}
 			for fn in fns:
 				m = md5re.match(fn)
 				ext = m.group(2)
 				ofn = m.group(1) + "." + _rawext_r.get(ext, ext)
 				tmd5 = md5(fn.encode("utf-8")).hexdigest()
-				pcache[tmd5] = (md5(ofn.encode("utf-8")).hexdigest(), fn)
+				res[tmd5] = (md5(ofn.encode("utf-8")).hexdigest(), fn)
+			pcache.update(res)
 		return pcache.get(thumbmd5)
 
 	def readlink(self, path):
@@ -302,7 +466,7 @@ class Wellpapp(fuse.Fuse):
 			pass
 		elif search:
 			try:
-				list += self._cache.get(search, self._search)[0]
+				list += self._results(search)[0]
 			except Exception:
 				NOTFOUND()
 		else:
@@ -310,18 +474,48 @@ class Wellpapp(fuse.Fuse):
 		for e in list:
 			yield fuse.Direntry(e)
 
-	def _search(self, search):
-		order = search.order
-		range = search.range
-		if not range: range = default_range
+	def _results(self, search):
+		"""(filenames, thumbnail map, probe) for search, cached."""
+		return self._cache.get(search, self._search, self._unchanged)
+
+	def _search_post(self, search, range, props, wanted=None):
+		"""The posts in range, or all of them if range is None (read a
+		page at a time with a SearchCursor, however many there are).
+		"""
 		assert None not in search.want
 		assert None not in search.dontwant
-		with self._client_lock:
-			s = self._client.search_post(guids=search.want,
-			                             excl_guids=search.dontwant,
-			                             wanted=["ext"],
-			                             order=order,
-			                             range=range)
+		kw = dict(guids=search.want,
+		          excl_guids=search.dontwant,
+		          wanted=wanted,
+		          order=search.order)
+		with self._searcher() as searcher:
+			if range is None and hasattr(searcher, "search_cursor"):
+				cursor = searcher.search_cursor(page_size=search_page, **kw)
+				posts = list(cursor)
+				if cursor.total is not None:
+					props["result_count"] = cursor.total
+				return posts
+			# The replica has no need for pages.
+			return searcher.search_post(range=range, props=props, **kw)
+
+	def _probe(self, s, props):
+		"""What _unchanged compares: the total count and the first post."""
+		count = props.get("result_count")
+		if count is None: return None
+		return count, (s[0].md5 if s else None)
+
+	def _unchanged(self, search, value):
+		"""Cheap check (one result) that a cached _search is still current."""
+		first = search.range[0] if search.range else 0
+		props = {}
+		s = self._search_post(search, (first, first), props)
+		probe = self._probe(s, props)
+		return probe is not None and probe == value[2]
+
+	def _search(self, search):
+		order = search.order
+		props = {}
+		s = self._search_post(search, search.range, props, ["ext"])
 		r = []
 		idx = 0
 		prefix = ""
@@ -339,17 +533,28 @@ class Wellpapp(fuse.Fuse):
 				r.append(prefix + m + "." + ext)
 		if not PY3:
 			r = map(str, r)
-		return r, {}
+		return r, {}, self._probe(s, props)
+
+	def _searcher(self):
+		"""Context manager giving the Client (from the pool) or Replica
+		to search in.
+		"""
+		if self._replica_db:
+			return _Locked(self._replica_db, self._replica_lock)
+		return self._pool.client()
 
 	def _escape_wrap(self, f_name, name, *a):
-		f = getattr(self._client, f_name)
-		with self._client_lock:
+		with self._pool.client() as client:
+			f = getattr(client, f_name)
 			res = f(name, *a)
 			if not res and '\\' in name:
 				res = f(unescape(name), *a)
 		return res
 
 	def _path2search(self, path):
+		return self._search_memo(path)
+
+	def _parse_path(self, path):
 		if path == "/": return None
 		want = set()
 		dontwant = set()
@@ -360,7 +565,7 @@ class Wellpapp(fuse.Fuse):
 		nodefault = False
 		for e in filter(None, sre.split(path[1:])):
 			if e[0] == "-":
-				e = self._escape_wrap('parse_tag', e[1:], True)
+				e = self._tag_memo(e[1:])
 				dontwant.add(e)
 			elif e[:2] == "O:":
 				o = e[2:]
@@ -376,7 +581,7 @@ class Wellpapp(fuse.Fuse):
 			elif e == "N:":
 				nodefault = True
 			else:
-				e = self._escape_wrap('parse_tag', e, True)
+				e = self._tag_memo(e)
 				want.add(e)
 				if not first: first = e
 		if self._default_search and not nodefault:
@@ -395,9 +600,21 @@ class Wellpapp(fuse.Fuse):
 		return _search_t(tuple(want), tuple(dontwant), tuple(order), range, clean)
 
 	def main(self, *a, **kw):
-		self._cache = Cache(30)
+		self._cache = Cache(float(self._cache_ttl), int(self._cache_entries),
+		                    int(float(self._cache_mb) * (1 << 20)),
+		                    stale=float(self._cache_stale))
+		# Tag names in paths are looked up again as often as the searches.
+		self._tag_memo = _Memo(lambda name: self._escape_wrap('parse_tag', name, True),
+		                       10000, float(self._cache_ttl))
+		# Only for things that don't talk to the server (image_path and so
+		# on), everything else gets a Client from the pool.
 		self._client = Client()
-		self._client_lock = RLock()
+		self._pool = ClientPool(self._client.cfg, int(self._threads))
+		self._replica_db = None
+		if self._replica:
+			from wellpapp.replica import Replica
+			self._replica_db = Replica(cfg=self._client.cfg)
+			self._replica_lock = Lock()
 		self._cfgfile = self._cfg2file()
 		self._use_cache = False
 		self._prime_stat_cache()
@@ -408,9 +625,10 @@ class Wellpapp(fuse.Fuse):
 		if self._default_search:
 			ds = "/" + self._default_search
 			self._default_search = None
-			self._default_search = self._path2search(ds)
+			self._default_search = self._parse_path(ds)
 			if None in self._default_search.want or None in self._default_search.dontwant:
 				raise Exception("Default search broken (%r)" % (self._default_search,))
+		self._search_memo = _Memo(self._parse_path, 10000, float(self._cache_ttl))
 		wp = self
 		class FakeFile:
 			keep_cache = False
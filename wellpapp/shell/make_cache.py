@@ -1,20 +1,23 @@
 from __future__ import print_function
 
 from os import walk, readlink, stat
-from os.path import join
+from os.path import join, exists
 from wellpapp.client import Client
 from wellpapp.util import identify_raw, RawWrapper, raw_exts
+from wellpapp.statcache import stat_t, read_stat_cache, write_stat_cache, append_stat_cache
 from io import open
 
 def main(arg0, argv):
 	if len(argv) < 1 or argv[0][0] == "-":
-		print("Usage: " + arg0 + " . or raw or post-spec [post-spec [..]]")
+		print("Usage: " + arg0 + " . or raw or compact or post-spec [post-spec [..]]")
 		print("\t.         - Regenerate full cache")
 		print("\traw       - Regenerate cache for all raw images")
+		print("\tcompact   - Rewrite cache in the (sorted) binary format")
 		print("\tpost-spec - add post-spec to cache")
 		print("Run in image_base")
 		return 1
 
+	entries = {}
 	def add(m, fn):
 		try:
 			dest = readlink(fn)
@@ -28,15 +31,13 @@ def main(arg0, argv):
 				jfh.seek(0, 2)
 				jz = jfh.tell()
 				jfh.close()
-				l = "1 %s %d %d %d %s\n" % (m, z, mt, jz, dest)
+				entries[m] = stat_t(1, z, mt, dest, jz)
 			else:
-				l = "0 %s %d %d %s\n" % (m, z, mt, dest)
+				entries[m] = stat_t(0, z, mt, dest, 0)
 			fh.close()
-			res.write(l)
 		except Exception:
 			print(m, "failed")
 
-	res = open("cache", "a", encoding="utf-8")
 	if argv == ["."]:
 		for dp, dns, fns in walk("."):
 			for n in [n for n in fns if len(n) == 32]:
@@ -49,7 +50,7 @@ def main(arg0, argv):
 			ms += [p.md5 for p in p]
 		for m in ms:
 			add(m, client.image_path(m))
-	else:
+	elif argv != ["compact"]:
 		client = Client()
 		for n in argv:
 			m = client.postspec2md5(n)
@@ -57,4 +58,10 @@ def main(arg0, argv):
 				add(m, client.image_path(m))
 			else:
 				print("Failed to convert " + n + " to post")
-	res.close()
+	if argv in (["."], ["compact"]):
+		res = read_stat_cache("cache") if exists("cache") else {}
+		res.update(entries)
+		write_stat_cache("cache", res)
+	else:
+		for m, st in sorted(entries.items()):
+			append_stat_cache("cache", m, st)
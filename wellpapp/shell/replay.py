@@ -0,0 +1,2 @@
+# The replay tool lives in wellpapp.trace, next to the recording.
+from wellpapp.trace import main
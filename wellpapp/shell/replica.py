@@ -0,0 +1,2 @@
+# The replica code lives in wellpapp.replica, it is useful outside the shell too.
+from wellpapp.replica import main
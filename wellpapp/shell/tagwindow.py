@@ -28,7 +28,7 @@ from threading import Thread
 from multiprocessing import cpu_count
 import re
 
-from wellpapp import Client, RawWrapper, WellpappError
+from wellpapp import Client, ClientPool, RawWrapper, WellpappError
 
 def clean(n):
 	n = _uni(n)
@@ -210,6 +210,8 @@ def button_with_mnemonic(ag, text, func, *args):
 class TagWindow:
 	def __init__(self):
 		self.client = Client()
+		# For the loader threads, so they don't reconnect every time.
+		self.pool = ClientPool(self.client.cfg, 8)
 		self.posts = {}
 		self.window = gtk.Window(type=gtk.WindowType.TOPLEVEL)
 		self.window.set_border_width(2)
@@ -684,11 +686,17 @@ class TagWindow:
 
 	def _tagfield_problems(self):
 		text = _uni(self.tagfield.get_text())
-		for m in re.finditer(r'[^\s]+', text):
+		matches = list(re.finditer(r'[^\s]+', text))
+		todo = []
+		for m in matches:
 			tag_txt = clean(m.group())
-			if tag_txt not in self.tagfield_cache:
-				tag = self.client.parse_tag(tag_txt)
+			if tag_txt not in self.tagfield_cache and tag_txt not in todo:
+				todo.append(tag_txt)
+		if todo:
+			for tag_txt, tag in zip(todo, self.client.resolve_tags(todo)):
 				self.tagfield_cache[tag_txt] = tag
+		for m in matches:
+			tag_txt = clean(m.group())
 			if not self.tagfield_cache[tag_txt]:
 				a, b = m.span()
 				if not a <= self.tagfield.get_position() <= b:
@@ -745,10 +753,15 @@ class TagWindow:
 			return
 		good = []
 		failed = []
-		for t in orgtext.split():
-			tag = self.client.parse_tag(t)
+		specs = orgtext.split()
+		created = False
+		for t, tag in zip(specs, self.client.resolve_tags(specs)):
+			if not tag and created:
+				# Might be one we just created
+				tag = self.client.parse_tag(t)
 			if not tag and prefix(t) != u"-":
 				self.create_tag(clean(t))
+				created = True
 				tag = self.client.parse_tag(t)
 			if tag:
 				good.append((tag, t))
@@ -1268,11 +1281,14 @@ class PostRefresh(Thread):
 		Thread.__init__(self)
 		self.name = "PostRefresh"
 		self.daemon = True
-		self.client = Client()
 		self.tw = tw
 		self.reload_posts = reload_posts
 
 	def run(self):
+		with self.tw.pool.client() as client:
+			self._run(client)
+
+	def _run(self, client):
 		if self.reload_posts:
 			idle_add(self.tw.progress_begin, len(self.tw.thumbs) + 1)
 			posts = []
@@ -1283,7 +1299,7 @@ class PostRefresh(Thread):
 					to_remove.append(ix)
 				else:
 					seen.add(t[0])
-					p = self.client.get_post(t[0], True)
+					p = client.get_post(t[0], True)
 					if p:
 						posts.append(p)
 					else:
@@ -1319,7 +1335,6 @@ class FileLoaderWorker(Thread):
 		Thread.__init__(self)
 		self.name = "FileLoaderWorker"
 		self.daemon = True
-		self._client = Client()
 		self._tw = tw
 		self._q_in = q_in
 		self._d_out = d_out
@@ -1328,6 +1343,10 @@ class FileLoaderWorker(Thread):
 		self._z = z
 
 	def run(self):
+		with self._tw.pool.client() as self._client:
+			self._run()
+
+	def _run(self):
 		try:
 			while True:
 				d = self._q_in.get(False)
@@ -1379,7 +1398,7 @@ class FileLoader(Thread):
 		self._argv = argv
 
 	def run(self):
-		client = Client()
+		client = self._tw.client
 		q_in = Queue.Queue()
 		for d in self._argv:
 			q_in.put(d)
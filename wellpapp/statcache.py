@@ -0,0 +1,387 @@
+"""The stat-cache: size, mtime and location of the image files.
+
+fusefs uses it to answer stat without touching the files (and to
+present RAW files as JPEG, which needs the size of the embedded JPEG).
+It lives in image_base/cache and is written by "wp make_cache" and
+"wp add".
+
+There are two formats. The old text format has one line per post,
+	0 <md5> <size> <mtime> <dest>
+	1 <md5> <size> <mtime> <jpegsize> <dest>
+(1 is for RAW files), later lines replacing earlier ones. It has to be
+parsed completely, which takes a lot of time and memory with millions
+of posts.
+
+The binary format is a header, an array of fixed size records sorted
+on md5 and a heap with the dest paths. It is mmapped and binary
+searched, so opening it costs almost nothing and the memory is shared
+through the page cache. New entries are appended after the heap (with
+the dest inline) and kept in a dict when read. "wp make_cache compact"
+sorts them into the array again, and converts text caches.
+
+StatCache.follow() keeps a StatCache up to date with the file, waking
+up (through inotify, where available) only when it changes.
+"""
+
+from __future__ import print_function
+
+import errno
+import mmap
+import os
+import sys
+from binascii import hexlify, unhexlify
+from collections import namedtuple
+from io import open
+from select import select
+from struct import Struct
+from threading import RLock
+from time import sleep, time
+
+__all__ = ("stat_t", "StatCache", "read_stat_cache", "write_stat_cache", "append_stat_cache",)
+
+stat_t = namedtuple("stat_t", ["version", "size", "mtime", "dest", "jpegsize"])
+
+_magic = b"WPSTATC\0"
+_format_version = 1
+# magic, format version, flags (0), sorted records, heap size
+_header = Struct("<8sIIQQ")
+# md5, version, dest length, size, mtime, jpegsize, dest offset in heap
+_record = Struct("<16sB3xIQqQQ")
+
+if sys.version_info[0] > 2:
+	def _fs_enc(s):
+		return s.encode("utf-8", "surrogateescape")
+	def _fs_dec(b):
+		return b.decode("utf-8", "surrogateescape")
+	def _hex(b):
+		return hexlify(b).decode("ascii")
+else:
+	_fs_enc = _fs_dec = lambda s: s
+	_hex = hexlify
+
+def _parse_line(line):
+	"""(md5, stat_t) from a line in the text format."""
+	v, m, size, mtime, dest = line.split(" ", 4)
+	if v == "1":
+		jz, dest = dest.split(" ", 1)
+	else:
+		jz = 0
+		assert v == "0"
+	return m, stat_t(int(v), int(size), int(mtime), dest, int(jz))
+
+def _format_line(m, st):
+	if st.version == 1:
+		return "1 %s %d %d %d %s\n" % (m, st.size, st.mtime, st.jpegsize, st.dest)
+	return "0 %s %d %d %s\n" % (m, st.size, st.mtime, st.dest)
+
+def _pack(m, st, dest, offset):
+	return _record.pack(unhexlify(m), st.version, len(dest), st.size, int(st.mtime), st.jpegsize, offset)
+
+def _unpack(rec, dest):
+	return stat_t(rec[1], rec[3], rec[4], _fs_dec(dest), rec[5])
+
+def _read_text(fh, res):
+	"""Read complete lines from fh into res. Returns bytes used."""
+	used = 0
+	for line in iter(fh.readline, b""):
+		if line[-1:] != b"\n":
+			break
+		used += len(line)
+		line = _fs_dec(line[:-1])
+		try:
+			m, st = _parse_line(line)
+		except Exception:
+			print("Bad line in cache:", line)
+			continue
+		res[m] = st
+	return used
+
+def _read_tail(fh, res):
+	"""Read complete appended records from fh into res. Returns bytes used."""
+	used = 0
+	while True:
+		data = fh.read(_record.size)
+		if len(data) < _record.size:
+			return used
+		rec = _record.unpack(data)
+		dest = fh.read(rec[2])
+		if len(dest) < rec[2]:
+			return used
+		res[_hex(rec[0])] = _unpack(rec, dest)
+		used += len(data) + len(dest)
+
+class _Sorted:
+	"""The sorted part of a binary stat-cache."""
+
+	def __init__(self, fh, count, heap_size):
+		self.count = count
+		self.heap = _header.size + count * _record.size
+		self.end = self.heap + heap_size
+		self._mm = None
+		if count:
+			self._mm = mmap.mmap(fh.fileno(), self.end, access=mmap.ACCESS_READ)
+
+	def find(self, key):
+		"""Binary search for key (16 bytes)."""
+		mm = self._mm
+		lo, hi = 0, self.count
+		while lo < hi:
+			mid = (lo + hi) // 2
+			off = _header.size + mid * _record.size
+			k = mm[off:off + 16]
+			if k < key:
+				lo = mid + 1
+			elif k > key:
+				hi = mid
+			else:
+				return self.at(mid)[1]
+		return None
+
+	def at(self, ix):
+		off = _header.size + ix * _record.size
+		rec = _record.unpack_from(self._mm, off)
+		start = self.heap + rec[6]
+		return _hex(rec[0]), _unpack(rec, self._mm[start:start + rec[2]])
+
+class _Inotify:
+	"""Just enough inotify (through ctypes) to wait for changes to a file.
+	Watches the directory, so replacing the file is seen too.
+	"""
+
+	# IN_MODIFY | IN_MOVED_TO | IN_CREATE | IN_DELETE
+	_mask = 0x2 | 0x80 | 0x100 | 0x200
+	_overflow = 0x4000
+	_event = Struct("iIII")
+
+	def __init__(self, fn):
+		import ctypes
+		import ctypes.util
+		libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+		fd = libc.inotify_init1(0o2000000 | os.O_NONBLOCK) # IN_CLOEXEC
+		if fd < 0:
+			raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+		dn, name = os.path.split(os.path.abspath(fn))
+		if libc.inotify_add_watch(fd, _fs_enc(dn), self._mask) < 0:
+			err = ctypes.get_errno()
+			os.close(fd)
+			raise OSError(err, "inotify_add_watch failed")
+		self._fd = fd
+		self._name = _fs_enc(name)
+
+	def wait(self, timeout):
+		"""Wait until the file changes (True) or timeout seconds pass."""
+		end = time() + timeout
+		while True:
+			left = end - time()
+			if left <= 0:
+				return False
+			if select([self._fd], [], [], left)[0] and self._changed():
+				return True
+
+	def _changed(self):
+		try:
+			data = os.read(self._fd, 65536)
+		except OSError as e:
+			if e.errno == errno.EAGAIN:
+				return False
+			raise
+		res = False
+		pos = 0
+		while pos + self._event.size <= len(data):
+			wd, mask, cookie, length = self._event.unpack_from(data, pos)
+			pos += self._event.size
+			name = data[pos:pos + length].rstrip(b"\0")
+			pos += length
+			if name == self._name or mask & self._overflow:
+				res = True
+		return res
+
+	def close(self):
+		os.close(self._fd)
+
+class StatCache:
+	"""A stat-cache file (either format) as a read only {md5: stat_t}
+	mapping, plus whatever you set in it (only kept in memory).
+	Call refresh() or check() to pick up changes to the file, or run
+	follow() in a thread. Safe to use from several threads.
+	"""
+
+	def __init__(self, fn):
+		self.fn = fn
+		self._fh = None
+		self._lock = RLock()
+		self._open()
+
+	def _open(self):
+		"""(Re)read the file from the start."""
+		with self._lock:
+			fh = open(self.fn, "rb")
+			st = os.fstat(fh.fileno())
+			head = fh.read(_header.size)
+			binary = (head[:len(_magic)] == _magic)
+			sorted_part = None
+			pos = 0
+			if binary:
+				magic, version, flags, count, heap_size = _header.unpack(head)
+				if version != _format_version:
+					fh.close()
+					raise ValueError("Unsupported stat-cache version %d" % (version,))
+				sorted_part = _Sorted(fh, count, heap_size)
+				pos = sorted_part.end
+			if self._fh:
+				self._fh.close()
+			self._fh = fh
+			self._ino = (st.st_dev, st.st_ino)
+			self._head = head
+			self._pos = pos
+			self.binary = binary
+			# Everything readers use, replaced as a unit when the file
+			# is read again. New entries go into the dict, one at a time
+			# or with one update(), so readers never see half an entry.
+			# The old mmap stays alive until nobody uses it.
+			self._view = (sorted_part, {})
+			self.refresh()
+
+	def refresh(self):
+		"""Read entries appended to the file. Returns how many there were."""
+		with self._lock:
+			new = {}
+			self._fh.seek(self._pos)
+			if self.binary:
+				self._pos += _read_tail(self._fh, new)
+			else:
+				self._pos += _read_text(self._fh, new)
+			self._view[1].update(new)
+			return len(new)
+
+	def check(self):
+		"""Like refresh(), but if the file was replaced (compacted) or
+		truncated it is read again from the start.
+		"""
+		try:
+			st = os.stat(self.fn)
+		except OSError:
+			return 0 # keep what we have until it comes back
+		with self._lock:
+			if (st.st_dev, st.st_ino) != self._ino or st.st_size < self._pos or \
+			   self._pos == 0 or self._read_head() != self._head:
+				self._open()
+				return -1
+			if st.st_size == self._pos:
+				return 0
+			return self.refresh()
+
+	def _read_head(self):
+		self._fh.seek(0)
+		return self._fh.read(len(self._head))
+
+	def follow(self, poll=1):
+		"""Keep up with changes to the file forever (so run it in a thread).
+		Uses inotify when available, otherwise checks every poll seconds.
+		"""
+		try:
+			watch = _Inotify(self.fn)
+		except (ImportError, OSError, AttributeError):
+			watch = None
+		while True:
+			if watch:
+				# Also look now and then, in case some event was missed.
+				watch.wait(60)
+			else:
+				sleep(poll)
+			try:
+				self.check()
+			except Exception as e:
+				print("Failed to read stat-cache:", e)
+
+	def get(self, m, default=None):
+		sorted_part, extra = self._view
+		res = extra.get(m)
+		if res is None and sorted_part and sorted_part.count and len(m) == 32:
+			try:
+				key = unhexlify(m)
+			except (TypeError, ValueError):
+				return default
+			res = sorted_part.find(key)
+		if res is None:
+			return default
+		return res
+
+	def __getitem__(self, m):
+		res = self.get(m)
+		if res is None:
+			raise KeyError(m)
+		return res
+
+	def __contains__(self, m):
+		return self.get(m) is not None
+
+	def __setitem__(self, m, st):
+		self._view[1][m] = st
+
+	def items(self):
+		"""All (md5, stat_t), sorted ones first."""
+		sorted_part, extra = self._view
+		if sorted_part:
+			for ix in range(sorted_part.count):
+				m, st = sorted_part.at(ix)
+				if m not in extra:
+					yield m, st
+		for item in extra.items():
+			yield item
+
+	def close(self):
+		with self._lock:
+			self._view = (None, {})
+			self._fh.close()
+
+def read_stat_cache(fn):
+	"""Everything in the stat-cache in fn, as {md5: stat_t}."""
+	cache = StatCache(fn)
+	try:
+		return dict(cache.items())
+	finally:
+		cache.close()
+
+def write_stat_cache(fn, entries):
+	"""Write entries ({md5: stat_t}) to fn in the binary format.
+	This goes through a temporary file which is renamed over fn, so
+	anything appended to fn while this runs is lost.
+	"""
+	records = []
+	heap = []
+	heap_size = 0
+	for m in sorted(entries):
+		st = entries[m]
+		dest = _fs_enc(st.dest)
+		records.append(_pack(m, st, dest, heap_size))
+		heap.append(dest)
+		heap_size += len(dest)
+	tmp_fn = fn + ".tmp"
+	with open(tmp_fn, "wb") as fh:
+		fh.write(_header.pack(_magic, _format_version, 0, len(records), heap_size))
+		fh.writelines(records)
+		fh.writelines(heap)
+	os.rename(tmp_fn, fn)
+
+def append_stat_cache(fn, m, st):
+	"""Add (or replace) the entry for m in the stat-cache in fn, in the
+	format the file already has. A new file gets the binary format.
+	"""
+	fd = os.open(fn, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+	try:
+		if os.fstat(fd).st_size == 0:
+			dest = _fs_enc(st.dest)
+			data = _header.pack(_magic, _format_version, 0, 0, 0) + _pack(m, st, dest, 0) + dest
+		else:
+			with open(fn, "rb") as fh:
+				binary = (fh.read(len(_magic)) == _magic)
+			if binary:
+				dest = _fs_enc(st.dest)
+				data = _pack(m, st, dest, 0) + dest
+			else:
+				data = _fs_enc(_format_line(m, st))
+		# One write, so concurrent appends don't mix.
+		os.write(fd, data)
+	finally:
+		os.close(fd)
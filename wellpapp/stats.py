@@ -0,0 +1,201 @@
+"""Per-command statistics for Client.
+
+Client(cfg, stats=collector) records every command sent through it in
+collector, which is a Stats or anything else with a compatible record
+method. Commands are grouped by verb (SP, ST, TP, ...) and each gets
+wall time (from sending it to the last line of the response), bytes
+sent and received, number of response lines and whether it failed.
+
+Setting WELLPAPP_STATS in the environment (or running wp --stats)
+makes all Clients that weren't given a collector record in
+wellpapp.stats.default, and prints a summary to stderr at exit.
+If WELLPAPP_STATS is anything other than "1" it is also used as a
+filename to write the stats to as JSON.
+"""
+
+from __future__ import print_function
+
+import atexit
+import json
+import os
+import re
+import sys
+from collections import deque
+from math import log
+from threading import Lock
+from time import time
+
+__all__ = ("Stats", "default", "enable",)
+
+_verb_re = re.compile(br"SPM|SP|ST|TP|MP|AP|DP|RS|R[Rr]|ATN|AAG|DAN|I[IiSR]|MTG|OG|t[BE]|L")
+
+def _verb(line):
+	m = _verb_re.match(line)
+	verb = m.group() if m else line[:2]
+	return verb.decode("ascii", "replace")
+
+# Histogram buckets are powers of _step, starting at _base seconds.
+_base = 1e-6
+_step = 2 ** 0.25
+_logstep = log(_step)
+
+def _bucket(seconds):
+	if seconds <= _base: return 0
+	return int(log(seconds / _base) / _logstep)
+
+def _bucket_limit(bucket):
+	return _base * _step ** (bucket + 1)
+
+class _VerbStats:
+	__slots__ = ("count", "errors", "seconds", "max", "bytes_out", "bytes_in", "lines", "buckets",)
+
+	def __init__(self):
+		self.count = self.errors = self.lines = 0
+		self.bytes_out = self.bytes_in = 0
+		self.seconds = self.max = 0.0
+		self.buckets = {}
+
+	def percentile(self, pct):
+		"""Upper limit of the histogram bucket pct percent of the
+		commands fall within. (So not exact, but never more than
+		19% too high.)
+		"""
+		if not self.count: return None
+		want = self.count * pct / 100.0
+		seen = 0
+		for bucket in sorted(self.buckets):
+			seen += self.buckets[bucket]
+			if seen >= want:
+				return min(_bucket_limit(bucket), self.max)
+		return self.max
+
+class Stats:
+	"""Collects per verb statistics from one or more Clients.
+	Thread safe, so several Clients (in a ClientPool for example) can
+	share one.
+	"""
+
+	def __init__(self):
+		self._lock = Lock()
+		self._verbs = {}
+
+	def record(self, verb, seconds, bytes_out, bytes_in, lines, error):
+		with self._lock:
+			vs = self._verbs.get(verb)
+			if vs is None:
+				vs = self._verbs[verb] = _VerbStats()
+			vs.count += 1
+			if error: vs.errors += 1
+			vs.seconds += seconds
+			if seconds > vs.max: vs.max = seconds
+			vs.bytes_out += bytes_out
+			vs.bytes_in += bytes_in
+			vs.lines += lines
+			bucket = _bucket(seconds)
+			vs.buckets[bucket] = vs.buckets.get(bucket, 0) + 1
+
+	def clear(self):
+		with self._lock:
+			self._verbs = {}
+
+	def __len__(self):
+		return len(self._verbs)
+
+	def percentile(self, verb, pct):
+		with self._lock:
+			vs = self._verbs.get(verb)
+			return vs and vs.percentile(pct)
+
+	def as_dict(self):
+		"""{verb: {count, errors, seconds, ...}} with percentiles and the
+		histogram as [[bucket upper limit, count], ...].
+		"""
+		res = {}
+		with self._lock:
+			for verb, vs in self._verbs.items():
+				d = dict((name, getattr(vs, name)) for name in _VerbStats.__slots__[:-1])
+				for pct in (50, 90, 99):
+					d["p%d" % (pct,)] = vs.percentile(pct)
+				d["histogram"] = [[_bucket_limit(b), vs.buckets[b]] for b in sorted(vs.buckets)]
+				res[verb] = d
+		return res
+
+	def dump_json(self, fh):
+		"""Write as_dict() to fh (a file object or a filename) as JSON."""
+		if not hasattr(fh, "write"):
+			with open(fh, "w") as fh:
+				return self.dump_json(fh)
+		json.dump(self.as_dict(), fh, indent=1, sort_keys=True)
+		fh.write("\n")
+
+	def summary(self):
+		"""A table of the stats as a string."""
+		data = self.as_dict()
+		fmt = "%-4s %8s %6s %10s %9s %9s %9s %9s %11s %11s"
+		lines = [fmt % ("verb", "count", "errors", "total ms", "mean ms", "p50 ms", "p99 ms", "max ms", "bytes out", "bytes in")]
+		ms = lambda s: "%.2f" % (s * 1000,)
+		for verb, d in sorted(data.items(), key=lambda i: -i[1]["seconds"]):
+			lines.append(fmt % (
+				verb, d["count"], d["errors"], ms(d["seconds"]),
+				ms(d["seconds"] / d["count"]), ms(d["p50"]), ms(d["p99"]),
+				ms(d["max"]), d["bytes_out"], d["bytes_in"],
+			))
+		return "\n".join(lines)
+
+class _Tracker:
+	"""Matches response lines on one connection to the commands they
+	answer. Commands can be pipelined, so this keeps a queue of them.
+	Every response ends with OK or an RE line.
+	"""
+
+	def __init__(self, collector):
+		self.collector = collector
+		self._pending = deque()
+
+	def sent(self, data):
+		now = time()
+		for line in data.split(b"\n")[:-1]:
+			self._pending.append([_verb(line), now, len(line) + 1, 0, 0])
+
+	def received(self, line):
+		if not self._pending: return
+		p = self._pending[0]
+		p[3] += len(line)
+		p[4] += 1
+		if line == b"OK\n" or line[:2] == b"RE" or not line:
+			self._pending.popleft()
+			self.collector.record(p[0], time() - p[1], p[2], p[3], p[4], line != b"OK\n")
+
+	def reset(self):
+		"""The connection closed, count whatever was pending as failed."""
+		now = time()
+		while self._pending:
+			p = self._pending.popleft()
+			self.collector.record(p[0], now - p[1], p[2], p[3], p[4], True)
+
+default = Stats()
+
+_exit_registered = []
+
+def _at_exit():
+	if not len(default): return
+	print(default.summary(), file=sys.stderr)
+	dest = os.environ.get("WELLPAPP_STATS")
+	if dest and dest != "1":
+		default.dump_json(dest)
+
+def enable(dest="1"):
+	"""Make Clients created from now on record in default, and print
+	(and maybe save, see the module docstring) it at exit.
+	"""
+	os.environ["WELLPAPP_STATS"] = dest
+	if not _exit_registered:
+		atexit.register(_at_exit)
+		_exit_registered.append(True)
+
+def _from_env():
+	"""The collector to use for Clients that didn't get one."""
+	dest = os.environ.get("WELLPAPP_STATS")
+	if not dest: return None
+	enable(dest)
+	return default
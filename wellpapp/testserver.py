@@ -0,0 +1,872 @@
+"""In-memory stand-in for the wellpapp server, for tests and benchmarks.
+
+Implements the parts of the protocol Client uses, closely enough to run
+the client, FUSE and ingest code against it, but not the real server's
+exact behaviour in corner cases (or its speed). Everything lives in
+memory and is lost when the server stops.
+
+	with TestServer() as server:
+		make_db(server, posts=10000)
+		client = Client(server.client_config())
+
+Or run it stand-alone ("python -m wellpapp.testserver -h" for options)
+and point a wellpapprc at the socket.
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+from random import Random
+from tempfile import mkdtemp
+from threading import Thread, RLock
+from time import strftime, gmtime, sleep, time
+
+from wellpapp.util import DotDict
+from wellpapp.vt import valuetypes
+
+if sys.version_info[0] > 2:
+	import socketserver
+else:
+	import SocketServer as socketserver
+
+__all__ = ("TestServer", "make_db", "magic_tags",)
+
+class _Error(Exception): pass
+
+# guid: (name, valuetype, post field or None)
+magic_tags = {
+	"aaaaaa-aaaacr-faketg-FLekst": ("ext", "word", "ext"),
+	"aaaaaa-aaaac8-faketg-bddate": ("imgdate", "datetime", "imgdate"),
+	"aaaaaa-aaaads-faketg-create": ("created", "datetime", "created"),
+	"aaaaaa-aaaaas-faketg-chaage": ("changed", "datetime", None),
+	"aaaaaa-aaaadt-faketg-gpspos": ("gpspos", "gps", None),
+	"aaaaaa-aaaade-faketg-rotate": ("rotate", "int", "rotate"),
+	"aaaaaa-aaaaf9-faketg-heyght": ("height", "uint", "height"),
+	"aaaaaa-aaaaeL-faketg-bbredd": ("width", "uint", "width"),
+}
+_field2guid = dict((v[2], g) for g, v in magic_tags.items() if v[2])
+_changed_guid = "aaaaaa-aaaaas-faketg-chaage"
+_post_fields = ("ext", "width", "height", "created", "imgdate", "rotate")
+_guidchars = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"
+_comps = ("=~", "<=", ">=", "=", "<", ">")
+
+def _fuzz(name):
+	return "".join(c for c in name.lower() if c.isalnum())
+
+def _vtparse(vt, s):
+	try:
+		return valuetypes[vt](s)
+	except (KeyError, ValueError):
+		raise _Error("bad value " + s)
+
+def _compare(value, comp, other):
+	if value is None: return False
+	try:
+		if comp in ("=", "=~"): return value.overlap(other)
+		if comp == "<": return value < other
+		if comp == ">": return value > other
+		if comp == "<=": return value <= other
+		if comp == ">=": return value >= other
+	except TypeError:
+		pass
+	return False
+
+def _now():
+	return strftime("%Y-%m-%dT%H:%M:%SZ", gmtime())
+
+class _Tag:
+	def __init__(self, guid, name, type, valuetype, datatag=False):
+		self.guid = guid
+		self.name = name
+		self.type = type
+		self.valuetype = valuetype
+		self.alias = []
+		self.datatag = datatag
+		self.posts = 0
+		self.weak_posts = 0
+
+class _Post:
+	def __init__(self, md5, fields):
+		self.md5 = md5
+		self.fields = fields
+		self.tags = {} # guid: (weak, value)
+		self.rels = set()
+		self.changed = _now()
+
+class _Implication:
+	def __init__(self, guid, positive, prio, value, filter):
+		self.guid = guid
+		self.positive = positive
+		self.prio = prio
+		self.value = value # None, a ValueType or "inherit"
+		self.filter = filter # None or (comp, ValueType)
+
+class DB:
+	"""The data, and the commands. Usable without a socket (DB.handle)."""
+
+	def __init__(self):
+		self.lock = RLock()
+		self.tags = {}
+		self.names = {}
+		self.posts = {}
+		self.post_order = []
+		self.implications = {} # set guid: [_Implication]
+		self.groups = {} # guid: [md5]
+		self.metalists = {"tagtypes": ["unspecified", "inimage", "artist", "character", "copyright", "meta", "ambiguous"]}
+		self._implied_cache = {}
+		self._rnd = Random()
+		for guid, (name, vt, field) in magic_tags.items():
+			self._add_tag(guid, name, "meta", vt, True)
+
+	def _new_guid(self):
+		while True:
+			guid = "-".join("".join(self._rnd.choice(_guidchars) for _ in range(6)) for _ in range(4))
+			if guid not in self.tags: return guid
+
+	def _add_tag(self, guid, name, type, valuetype, datatag=False):
+		if name in self.names: raise _Error("tag exists " + name)
+		if guid in self.tags: raise _Error("guid exists " + guid)
+		tag = _Tag(guid, name, type, valuetype, datatag)
+		self.tags[guid] = tag
+		self.names[name] = tag
+		return tag
+
+	def _tag(self, guid):
+		tag = self.tags.get(guid)
+		if not tag: raise _Error("no tag " + guid)
+		return tag
+
+	def _post(self, md5):
+		post = self.posts.get(md5)
+		if not post: raise _Error("no post " + md5)
+		return post
+
+	def _changed(self, md5=None):
+		if md5 is None:
+			self._implied_cache.clear()
+		else:
+			self._implied_cache.pop(md5, None)
+			if md5 in self.posts:
+				self.posts[md5].changed = _now()
+
+	# Tag values on posts, including implied and data tags.
+
+	def _implied(self, post):
+		res = self._implied_cache.get(post.md5)
+		if res is not None: return res
+		best = {}
+		neg = set()
+		seen = set(post.tags)
+		todo = list(post.tags.items())
+		while todo:
+			guid, (weak, value) = todo.pop()
+			for impl in self.implications.get(guid, ()):
+				if impl.filter and not _compare(value, *impl.filter):
+					continue
+				if not impl.positive:
+					neg.add(impl.guid)
+					continue
+				v = value if impl.value == "inherit" else impl.value
+				cur = best.get(impl.guid)
+				if cur is None or (impl.prio, not weak) > (cur[0], not cur[1]):
+					best[impl.guid] = (impl.prio, weak, v)
+				if impl.guid not in seen:
+					seen.add(impl.guid)
+					todo.append((impl.guid, (weak, v)))
+		res = dict((g, (weak, v)) for g, (prio, weak, v) in best.items() if g not in neg and g not in post.tags)
+		self._implied_cache[post.md5] = res
+		return res
+
+	def _datatags(self, post):
+		res = {}
+		for field, guid in _field2guid.items():
+			if field in post.fields:
+				res[guid] = _vtparse(magic_tags[guid][1], post.fields[field])
+		res[_changed_guid] = _vtparse("datetime", post.changed)
+		return res
+
+	def _occurrences(self, post, guid):
+		"""[(weak, value)] for guid on post."""
+		res = []
+		if guid in post.tags:
+			res.append(post.tags[guid])
+		else:
+			implied = self._implied(post)
+			if guid in implied:
+				res.append(implied[guid])
+		if guid in magic_tags:
+			value = self._datatags(post).get(guid)
+			if value is not None:
+				res.append((False, value))
+		return res
+
+	# Search
+
+	def _parse_tagspec(self, spec):
+		prefix = ""
+		if spec[0] in "~!":
+			prefix = spec[0]
+			spec = spec[1:]
+		if spec[:1] != "G" or len(spec) < 28: raise _Error("bad tag spec " + spec)
+		guid = spec[1:28]
+		tag = self._tag(guid)
+		rest = spec[28:]
+		comp = None
+		value = None
+		if rest:
+			for comp in _comps:
+				if rest.startswith(comp): break
+			else:
+				raise _Error("bad comparison " + rest)
+			value = _vtparse(tag.valuetype, rest[len(comp):])
+		return prefix, guid, comp, value
+
+	def _matches(self, post, spec):
+		prefix, guid, comp, value = spec
+		for weak, v in self._occurrences(post, guid):
+			if prefix == "!" and weak: continue
+			if prefix == "~" and not weak: continue
+			if comp and not _compare(v, comp, value): continue
+			return True
+		return False
+
+	def _search(self, clauses):
+		"""Parse search clauses, returns (posts, wanted, range)."""
+		want = []
+		dontwant = []
+		order = []
+		wanted = set()
+		range = None
+		for c in clauses:
+			if c[0] == "F":
+				wanted.add(c[1:])
+			elif c[0] == "T":
+				want.append(self._parse_tagspec(c[1:]))
+			elif c[0] == "t":
+				dontwant.append(self._parse_tagspec(c[1:]))
+			elif c[0] == "O":
+				order.append(c[1:])
+			elif c[0] == "R":
+				range = c[1:]
+			else:
+				raise _Error("bad search clause " + c)
+		posts = [self.posts[m] for m in self.post_order]
+		if want or dontwant:
+			posts = [p for p in posts
+			         if all(self._matches(p, s) for s in want)
+			         and not any(self._matches(p, s) for s in dontwant)]
+		for o in reversed(order):
+			posts = self._sort(posts, o, want)
+		return posts, wanted, range
+
+	def _sort(self, posts, o, want):
+		reverse = o[:1] == "-"
+		if reverse: o = o[1:]
+		if o == "group":
+			if not want: raise _Error("group order without tag")
+			pos = dict((m, ix) for ix, m in enumerate(self.groups.get(want[0][1], ())))
+			key = lambda p: (p.md5 not in pos, pos.get(p.md5))
+		else:
+			self._tag(o)
+			def key(p):
+				for weak, v in self._occurrences(p, o):
+					if v is not None:
+						return (False, v.value)
+				return (True, None)
+		try:
+			return sorted(posts, key=key, reverse=reverse)
+		except TypeError:
+			raise _Error("can't sort on " + o)
+
+	def _range(self, posts, range):
+		first = 0
+		if range is None:
+			return posts, first
+		if range[0] == "M":
+			a = range[1:].split(":")
+			try:
+				first = [p.md5 for p in posts].index(a[0])
+			except ValueError:
+				raise _Error("range anchor not found")
+			if len(a) > 1:
+				return posts[first:first + int(a[1])], first
+			return posts[first:], first
+		a, b = range.split(":")
+		first = int(a, 16)
+		return posts[first:int(b, 16) + 1], first
+
+	def _fmt_tag(self, tag, flags, value, wanted):
+		res = [" :" + flags]
+		if "tagguid" in wanted:
+			res.append(" G" + tag.guid)
+		if "tagname" in wanted:
+			res.append(" N" + tag.name)
+		if "tagdata" in wanted:
+			res.append(" T" + tag.type)
+			if tag.valuetype:
+				res.append(" V" + tag.valuetype)
+				if value is not None:
+					res.append("=" + value.format())
+		return "".join(res)
+
+	def _fmt_post(self, post, wanted):
+		res = ["RP", post.md5]
+		for f in _post_fields:
+			if f in wanted and f in post.fields:
+				res.append(" F%s=%s" % (f, post.fields[f]))
+		if wanted & set(("tagguid", "tagname")):
+			for guid, (weak, value) in post.tags.items():
+				flags = "~" if weak else ""
+				if self.tags[guid].datatag: flags += "D"
+				res.append(self._fmt_tag(self.tags[guid], flags, value, wanted))
+			# Implied tags look like any other tags unless asked for separately.
+			impl = "I" if "implied" in wanted else ""
+			for guid, (weak, value) in self._implied(post).items():
+				res.append(self._fmt_tag(self.tags[guid], impl + "~" if weak else impl, value, wanted))
+			for guid, value in self._datatags(post).items():
+				res.append(self._fmt_tag(self.tags[guid], "D", value, wanted))
+		res.append(" :")
+		return "".join(res)
+
+	def cmd_SP(self, args):
+		if args[:1] == "M":
+			a = args[1:].split(" ")
+			post = self.posts.get(a[0])
+			wanted = set(c[1:] for c in a[1:] if c[:1] == "F")
+			return [self._fmt_post(post, wanted)] if post else []
+		posts, wanted, range = self._search(args.split())
+		total = len(posts)
+		posts, first = self._range(posts, range)
+		res = ["RR%x:%x" % (total, first) if range else "RR%x" % (total,)]
+		res.extend(self._fmt_post(p, wanted) for p in posts)
+		return res
+
+	# Tags
+
+	def _fmt_tagres(self, tag, counts=None):
+		posts, weak_posts = counts or (tag.posts, tag.weak_posts)
+		res = ["RG%s N%s T%s" % (tag.guid, tag.name, tag.type)]
+		if tag.valuetype:
+			res.append(" V" + tag.valuetype)
+		for a in tag.alias:
+			res.append(" A" + a)
+		res.append(" P%x W%x" % (posts, weak_posts))
+		if tag.datatag:
+			res.append(" Fdatatag")
+		if tag.guid in self.groups:
+			res.append(" Fordered")
+		return "".join(res)
+
+	def cmd_ST(self, args):
+		if " :" in args:
+			args, search = args.split(" :", 1)
+		else:
+			search = None
+		a = args.split(" ")
+		# The name starts after the matchtype letters
+		for ix, c in enumerate(a[0]):
+			if c in "NGIP":
+				matchtype, where, name = a[0][:ix], c, a[0][ix + 1:]
+				break
+		else:
+			raise _Error("bad matchtype")
+		fuzzy = matchtype[:1] == "F"
+		aliases = "A" in matchtype
+		if fuzzy: name = _fuzz(name)
+		def match(n):
+			if fuzzy: n = _fuzz(n)
+			if where == "N": return n == name
+			if where == "I": return n.startswith(name)
+			if where == "P": return name in n
+		res = []
+		for tag in self.tags.values():
+			if where == "G":
+				ok = tag.guid == name
+			else:
+				ok = match(tag.name) or (aliases and any(match(al) for al in tag.alias))
+			if ok:
+				res.append(tag)
+		counts = None
+		if search is not None:
+			posts = self._search(search.split())[0]
+			counts = {}
+			for p in posts:
+				for guid, (weak, value) in p.tags.items():
+					c = counts.setdefault(guid, [0, 0])
+					c[weak] += 1
+			res = [t for t in res if t.guid in counts]
+		range = None
+		res.sort(key=lambda t: t.name)
+		for o in a[1:]:
+			if o[:1] == "O":
+				o = o[1:]
+				reverse = o[:1] == "-"
+				if reverse: o = o[1:]
+				if o == "post":
+					if counts:
+						key = lambda t: counts[t.guid][0] + counts[t.guid][1]
+					else:
+						key = lambda t: t.posts + t.weak_posts
+				elif o == "name":
+					key = lambda t: t.name
+				else:
+					raise _Error("bad tag order " + o)
+				res.sort(key=key, reverse=reverse)
+			elif o[:1] == "F":
+				flag = o[1:]
+				negate = flag[:1] == "-"
+				if negate: flag = flag[1:]
+				if flag != "datatag": raise _Error("bad tag flag " + flag)
+				res = [t for t in res if t.datatag != negate]
+			elif o[:1] == "R":
+				first, last = o[1:].split(":")
+				range = (int(first, 16), int(last, 16))
+			else:
+				raise _Error("bad tag option " + o)
+		total = len(res)
+		if range:
+			res = res[range[0]:range[1] + 1]
+		out = ["RR%x" % (total,)]
+		out.extend(self._fmt_tagres(t, counts and counts[t.guid]) for t in res)
+		return out
+
+	def _opts(self, a, allowed):
+		res = {}
+		for o in a:
+			if not o or o[0] not in allowed: raise _Error("bad option " + o)
+			res[o[0]] = o[1:]
+		return res
+
+	def cmd_ATN(self, args):
+		a = args.split(" ")
+		opts = self._opts(a[1:], "TGV")
+		guid = opts.get("G") or self._new_guid()
+		vt = opts.get("V")
+		if vt and vt != "none" and vt not in valuetypes: raise _Error("bad valuetype " + vt)
+		self._add_tag(guid, a[0], opts.get("T", "unspecified"), vt)
+
+	def cmd_AAG(self, args):
+		a = args.split(" ")
+		tag = self._tag(a[0])
+		name = self._opts(a[1:], "N")["N"]
+		if name in self.names: raise _Error("name exists " + name)
+		tag.alias.append(name)
+		self.names[name] = tag
+
+	def cmd_DAN(self, args):
+		tag = self.names.get(args)
+		if not tag or args not in tag.alias: raise _Error("no alias " + args)
+		tag.alias.remove(args)
+		del self.names[args]
+
+	def cmd_MTG(self, args):
+		a = args.split(" ")
+		tag = self._tag(a[0])
+		opts = self._opts(a[1:], "MNTV")
+		if "M" in opts:
+			self._merge(tag, self._tag(opts["M"]))
+		if "N" in opts:
+			if opts["N"] in self.names: raise _Error("name exists " + opts["N"])
+			del self.names[tag.name]
+			tag.name = opts["N"]
+			self.names[tag.name] = tag
+		if "T" in opts:
+			tag.type = opts["T"]
+		if "V" in opts:
+			if tag.posts or tag.weak_posts: raise _Error("tag in use")
+			tag.valuetype = opts["V"]
+
+	def _merge(self, into, other):
+		if into is other or other.datatag: raise _Error("can't merge")
+		for post in self.posts.values():
+			if other.guid in post.tags:
+				weak, value = post.tags.pop(other.guid)
+				self._count(other, weak, -1)
+				if into.guid not in post.tags:
+					post.tags[into.guid] = (weak, value)
+					self._count(into, weak, 1)
+				self._changed(post.md5)
+		del self.tags[other.guid]
+		into.alias.append(other.name)
+		into.alias.extend(other.alias)
+		for name in [other.name] + other.alias:
+			self.names[name] = into
+		self.implications.pop(other.guid, None)
+		for impls in self.implications.values():
+			impls[:] = [i for i in impls if i.guid != other.guid]
+		self.groups.pop(other.guid, None)
+		self._changed()
+
+	# Posts
+
+	def _fields(self, a):
+		fields = {}
+		for f in a:
+			if "=" not in f: raise _Error("bad field " + f)
+			name, value = f.split("=", 1)
+			if name not in _post_fields and name != "MD5": raise _Error("bad field " + name)
+			fields[name] = value
+		return fields
+
+	def cmd_AP(self, args):
+		a = args.split(" ")
+		if a[0] in self.posts: raise _Error("duplicate post " + a[0])
+		fields = self._fields(a[1:])
+		for f in ("width", "height", "ext"):
+			if f not in fields: raise _Error("missing " + f)
+		fields.setdefault("created", _now())
+		self.posts[a[0]] = _Post(a[0], fields)
+		self.post_order.append(a[0])
+
+	def cmd_MP(self, args):
+		a = args.split(" ")
+		post = self._post(a[0])
+		post.fields.update(self._fields(a[1:]))
+		self._changed(post.md5)
+
+	def cmd_DP(self, args):
+		post = self._post(args)
+		for guid, (weak, value) in post.tags.items():
+			self._count(self.tags[guid], weak, -1)
+		for m in post.rels:
+			self.posts[m].rels.discard(post.md5)
+		for l in self.groups.values():
+			if post.md5 in l: l.remove(post.md5)
+		del self.posts[args]
+		self.post_order.remove(args)
+		self._changed(args)
+
+	def _count(self, tag, weak, n):
+		if weak:
+			tag.weak_posts += n
+		else:
+			tag.posts += n
+
+	def cmd_TP(self, args):
+		a = args.split(" ")
+		post = self._post(a[0])
+		for t in a[1:]:
+			if t[:1] == "t":
+				guid = t[1:]
+				if guid in post.tags:
+					weak, value = post.tags.pop(guid)
+					self._count(self.tags[guid], weak, -1)
+				continue
+			if t[:1] != "T": raise _Error("bad tag " + t)
+			t = t[1:]
+			weak = t[:1] == "~"
+			if weak: t = t[1:]
+			guid, value = (t.split("=", 1) + [None])[:2]
+			tag = self._tag(guid)
+			if value is not None:
+				if not tag.valuetype or tag.valuetype == "none": raise _Error("no valuetype " + guid)
+				value = _vtparse(tag.valuetype, value)
+			field = magic_tags.get(guid, (None, None, None))[2]
+			if field:
+				if value is None: raise _Error("no value for " + guid)
+				post.fields[field] = value.format()
+				continue
+			if guid in post.tags:
+				self._count(tag, post.tags[guid][0], -1)
+			post.tags[guid] = (weak, value)
+			self._count(tag, weak, 1)
+		self._changed(post.md5)
+
+	# Relations
+
+	def _cmd_rels(self, args, add):
+		a = args.split(" ")
+		post = self._post(a[0])
+		for m in a[1:]:
+			other = self._post(m)
+			if add:
+				post.rels.add(m)
+				other.rels.add(post.md5)
+			else:
+				post.rels.discard(m)
+				other.rels.discard(post.md5)
+			self._changed(m)
+		self._changed(post.md5)
+
+	def cmd_RR(self, args):
+		self._cmd_rels(args, True)
+
+	def cmd_Rr(self, args):
+		self._cmd_rels(args, False)
+
+	def cmd_RS(self, args):
+		post = self._post(args)
+		if not post.rels: return []
+		return ["R" + " ".join([post.md5] + sorted(post.rels))]
+
+	# Implications
+
+	def _parse_filter(self, spec):
+		guid = spec[:27]
+		tag = self._tag(guid)
+		if len(spec) == 27: return guid, None
+		for comp in _comps:
+			if spec[27:].startswith(comp): break
+		else:
+			raise _Error("bad filter " + spec)
+		return guid, (comp, _vtparse(tag.valuetype, spec[27 + len(comp):]))
+
+	def _cmd_implies(self, args, add):
+		a = args.split(" ")
+		set_guid, filter = self._parse_filter(a[0])
+		opts = self._opts(a[1:], "IiPV")
+		positive = "I" in opts
+		guid = opts["I"] if positive else opts.get("i")
+		if not guid: raise _Error("no implied tag")
+		tag = self._tag(guid)
+		impls = self.implications.setdefault(set_guid, [])
+		impls[:] = [i for i in impls if not (i.guid == guid and i.filter == filter)]
+		if add:
+			value = None
+			if "V" in opts:
+				value = _vtparse(tag.valuetype, opts["V"]) if opts["V"] else "inherit"
+			impls.append(_Implication(guid, positive, int(opts.get("P", 0)), value, filter))
+		if not impls:
+			del self.implications[set_guid]
+		self._changed()
+
+	def cmd_II(self, args):
+		self._cmd_implies(args, True)
+
+	def cmd_Ii(self, args):
+		self._cmd_implies(args, False)
+
+	def _fmt_implications(self, set_guid, impls):
+		lines = {}
+		for impl in impls:
+			key = set_guid
+			if impl.filter:
+				comp, value = impl.filter
+				key += comp + self.tags[set_guid].valuetype + "=" + value.format()
+			part = (" I" if impl.positive else " i") + impl.guid
+			if impl.prio:
+				part += " P%d" % (impl.prio,)
+			if impl.value == "inherit":
+				part += " V"
+			elif impl.value is not None:
+				part += " V%s=%s" % (self.tags[impl.guid].valuetype, impl.value.format())
+			lines.setdefault(key, []).append(part)
+		return ["RI" + key + "".join(parts) for key, parts in sorted(lines.items())]
+
+	def cmd_IS(self, args):
+		self._tag(args)
+		return self._fmt_implications(args, self.implications.get(args, ()))
+
+	def cmd_IR(self, args):
+		self._tag(args)
+		res = []
+		for set_guid, impls in sorted(self.implications.items()):
+			impls = [i for i in impls if i.guid == args]
+			res.extend(self._fmt_implications(set_guid, impls))
+		return res
+
+	# The rest
+
+	def cmd_OG(self, args):
+		a = args.split(" ")
+		self._tag(a[0])
+		md5s = [self._post(p[1:]).md5 for p in a[1:] if p[:1] == "P"]
+		if len(md5s) != len(a) - 1: raise _Error("bad order")
+		order = self.groups.setdefault(a[0], [])
+		# The first post stays where it is, the rest go after it.
+		for m in md5s[1:]:
+			if m in order: order.remove(m)
+		if md5s[0] not in order:
+			order.append(md5s[0])
+		pos = order.index(md5s[0]) + 1
+		order[pos:pos] = md5s[1:]
+
+	def cmd_L(self, args):
+		if args not in self.metalists: raise _Error("no metalist " + args)
+		return ["RN" + n for n in self.metalists[args]]
+
+	_commands = ("SP", "ST", "ATN", "AAG", "DAN", "MTG", "AP", "MP", "DP", "TP",
+	             "RR", "Rr", "RS", "II", "Ii", "IS", "IR", "OG", "L",)
+
+	def handle(self, line):
+		"""Run one command line (without newline), returns response lines."""
+		try:
+			for cmd in self._commands:
+				if line.startswith(cmd):
+					with self.lock:
+						res = getattr(self, "cmd_" + cmd)(line[len(cmd):])
+					return (res or []) + ["OK"]
+			raise _Error("unknown command")
+		except _Error as e:
+			return ["RE" + str(e)]
+		except Exception as e:
+			return ["RE" + repr(e)]
+
+class _Handler(socketserver.StreamRequestHandler):
+	def handle(self):
+		db = self.server.db
+		in_transaction = False
+		try:
+			for line in self.rfile:
+				line = line.rstrip(b"\n").decode("utf-8")
+				if line == "tB":
+					# Transactions just keep everyone else out.
+					if not in_transaction:
+						db.lock.acquire()
+						in_transaction = True
+					res = ["OK"]
+				elif line == "tE":
+					if in_transaction:
+						db.lock.release()
+						in_transaction = False
+						res = ["OK"]
+					else:
+						res = ["REno transaction"]
+				else:
+					res = db.handle(line)
+				self.wfile.write("".join(l + "\n" for l in res).encode("utf-8"))
+				self.wfile.flush()
+		finally:
+			if in_transaction:
+				db.lock.release()
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+	daemon_threads = True
+
+class TestServer:
+	"""Serves a DB on a unix socket (in a background thread).
+	Use as a context manager, or call start() and stop().
+	"""
+
+	def __init__(self, path=None, db=None):
+		self._tmpdir = None
+		if path is None:
+			self._tmpdir = mkdtemp(prefix="wellpapp-test-")
+			path = os.path.join(self._tmpdir, "socket")
+		self.path = path
+		self.db = db or DB()
+		self._server = None
+
+	def start(self):
+		if os.path.exists(self.path):
+			os.unlink(self.path)
+		self._server = _Server(self.path, _Handler)
+		self._server.db = self.db
+		t = Thread(target=self._server.serve_forever, name="wellpapp testserver")
+		t.daemon = True
+		t.start()
+		return self
+
+	def stop(self):
+		if self._server:
+			self._server.shutdown()
+			self._server.server_close()
+			self._server = None
+			os.unlink(self.path)
+		if self._tmpdir:
+			try:
+				os.rmdir(self._tmpdir)
+			except OSError:
+				pass
+
+	def __enter__(self):
+		return self.start()
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.stop()
+
+	def client_config(self, base=None):
+		"""A config for Client (and friends) using this server.
+		Image and thumb paths are under base (default the socket dir).
+		"""
+		if base is None:
+			base = os.path.dirname(self.path)
+		return DotDict(
+			server=self.path,
+			image_base=os.path.join(base, "images"),
+			thumb_base=os.path.join(base, "thumbs"),
+			thumb_sizes="128 200",
+			tags_filename="TAGS",
+			tagwindow_width="840",
+			tagwindow_height="600",
+		)
+
+def make_db(db, posts=1000, tags=200, tags_per_post=8, seed=1):
+	"""Fill db (a DB or TestServer) with random posts and tags.
+	The same arguments always give the same database.
+	About a tenth of the tags have values, some have aliases,
+	implications, relations and group orderings.
+	"""
+	if isinstance(db, TestServer): db = db.db
+	rnd = Random(seed)
+	db._rnd = Random(seed)
+	types = db.metalists["tagtypes"]
+	valued = (("int", lambda: str(rnd.randint(-1000, 1000))),
+	          ("uint", lambda: "%x" % (rnd.randint(0, 5000),)),
+	          ("float", lambda: "%d.%d" % (rnd.randint(0, 100), rnd.randint(0, 9))),
+	          ("word", lambda: "w%d" % (rnd.randint(0, 50),)),
+	          ("datetime", lambda: "20%02d-%02d-%02d" % (rnd.randint(0, 25), rnd.randint(1, 12), rnd.randint(1, 28))),
+	         )
+	tag_guids = []
+	gen = {}
+	with db.lock:
+		for ix in range(tags):
+			vt = None
+			if ix % 10 == 0:
+				vt, gen[ix] = valued[(ix // 10) % len(valued)]
+			name = "tag%d_%s" % (ix, "".join(rnd.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rnd.randint(2, 10))))
+			tag = db._add_tag(db._new_guid(), name, rnd.choice(types), vt)
+			if ix % 7 == 0:
+				alias = "alias%d" % (ix,)
+				tag.alias.append(alias)
+				db.names[alias] = tag
+			tag_guids.append(tag.guid)
+		for ix in range(0, tags - 1, 13):
+			impl = tag_guids[(ix * 7 + 1) % tags]
+			if impl != tag_guids[ix] and db.tags[impl].valuetype is None:
+				db._cmd_implies(tag_guids[ix] + " I" + impl + " P%d" % (rnd.randint(0, 3),), True)
+		md5s = []
+		for ix in range(posts):
+			md5 = "%032x" % (rnd.getrandbits(128),)
+			created = "20%02d-%02d-%02dT%02d:%02d:%02dZ" % (rnd.randint(0, 25), rnd.randint(1, 12), rnd.randint(1, 28), rnd.randint(0, 23), rnd.randint(0, 59), rnd.randint(0, 59))
+			db.cmd_AP("%s width=%x height=%x ext=%s created=%s" % (md5, rnd.randint(100, 6000), rnd.randint(100, 6000), rnd.choice(("jpeg", "png", "gif")), created))
+			tp = [md5]
+			# Skewed, so there are some popular tags.
+			for tix in set(min(int(rnd.expovariate(8.0 / tags)), tags - 1) for _ in range(tags_per_post)):
+				t = "T~" if rnd.random() < 0.2 else "T"
+				t += tag_guids[tix]
+				if tix in gen and rnd.random() < 0.8:
+					t += "=" + gen[tix]()
+				tp.append(t)
+			db.cmd_TP(" ".join(tp))
+			md5s.append(md5)
+			if ix % 50 == 1:
+				db.cmd_RR(md5 + " " + md5s[rnd.randint(0, ix - 1)])
+		for guid in tag_guids[:tags // 20]:
+			members = [p.md5 for p in db.posts.values() if guid in p.tags]
+			if members:
+				db.cmd_OG(guid + "".join(" P" + m for m in members[:50]))
+
+def main(argv):
+	from argparse import ArgumentParser
+	parser = ArgumentParser(prog="python -m wellpapp.testserver", description="Run an in-memory wellpapp server")
+	parser.add_argument("-p", "--posts", type=int, default=1000, help="synthetic posts to start with")
+	parser.add_argument("-t", "--tags", type=int, default=200, help="synthetic tags to start with")
+	parser.add_argument("-s", "--seed", type=int, default=1)
+	parser.add_argument("socket", help="unix socket to listen on")
+	args = parser.parse_args(argv)
+	server = TestServer(args.socket)
+	t0 = time()
+	make_db(server, args.posts, args.tags, seed=args.seed)
+	print("Generated %d posts and %d tags in %.1fs" % (args.posts, args.tags, time() - t0))
+	with server:
+		print("Listening on", args.socket)
+		try:
+			while True:
+				sleep(3600)
+		except KeyboardInterrupt:
+			pass
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
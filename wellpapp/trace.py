@@ -0,0 +1,223 @@
+"""Recording and replaying the protocol traffic of Clients.
+
+Client(cfg, trace=Trace("file")) writes every command it sends and
+every response line it gets to file, with timestamps. Setting
+WELLPAPP_TRACE=file in the environment does the same for all Clients
+that weren't given a Trace, so you can record for example a fusefs
+mount or a tagwindow session without changing anything else.
+
+The trace is text, one protocol line per line:
+	<unix time> <connection> <direction> <protocol line>
+where direction is ">" for commands and "<" for responses. Several
+Clients (and processes) can write to the same file, each connection
+gets a number that is unique within its process, prefixed by the pid.
+
+"wp replay" (see main) sends the commands from a trace to a server
+again and reports throughput and latency.
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+from threading import Lock, Thread
+from time import sleep, time
+
+from wellpapp import stats as _stats
+
+__all__ = ("Trace", "read_trace", "replay", "main",)
+
+class _TraceConnection:
+	"""What a Client writes through, same interface as stats._Tracker."""
+
+	def __init__(self, trace, name):
+		self._write = trace._write
+		self._name = name
+
+	def sent(self, data):
+		for line in data.split(b"\n")[:-1]:
+			self._write(self._name, b">", line)
+
+	def received(self, line):
+		if line:
+			self._write(self._name, b"<", line.rstrip(b"\n"))
+
+	def reset(self):
+		pass
+
+class Trace:
+	"""A trace file that any number of Clients can write to.
+	fh is a filename (appended to) or a binary file object.
+
+	With a filename every record is a single write to an O_APPEND
+	file descriptor, so several processes (including forked ones) can
+	share the file without mixing up lines. A file object is written
+	to under a lock, which only protects against threads.
+	"""
+
+	def __init__(self, fh):
+		self._fd = None
+		if not hasattr(fh, "write"):
+			self._fd = os.open(fh, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+			fh = None
+		self._fh = fh
+		self._lock = Lock()
+		self._count = 0
+
+	def connection(self):
+		with self._lock:
+			self._count += 1
+			count = self._count
+		# The pid now, not when the Trace was made, in case we forked.
+		name = "%d.%d" % (os.getpid(), count,)
+		return _TraceConnection(self, name.encode("ascii"))
+
+	def _write(self, name, direction, line):
+		data = b" ".join((("%.6f" % (time(),)).encode("ascii"), name, direction, line)) + b"\n"
+		if self._fd is not None:
+			os.write(self._fd, data)
+		else:
+			with self._lock:
+				self._fh.write(data)
+
+	def flush(self):
+		if self._fh:
+			with self._lock:
+				self._fh.flush()
+
+	def close(self):
+		if self._fd is not None:
+			os.close(self._fd)
+			self._fd = None
+		else:
+			with self._lock:
+				self._fh.close()
+
+_env_traces = {}
+
+def _from_env():
+	"""The Trace to use for Clients that didn't get one."""
+	fn = os.environ.get("WELLPAPP_TRACE")
+	if not fn: return None
+	if fn not in _env_traces:
+		import atexit
+		trace = _env_traces[fn] = Trace(fn)
+		atexit.register(trace.flush)
+	return _env_traces[fn]
+
+def read_trace(fh):
+	"""Read the commands from a trace.
+	Returns {connection: [(time, command), ...]}, commands as bytes.
+	"""
+	if not hasattr(fh, "read"):
+		with open(fh, "rb") as fh:
+			return read_trace(fh)
+	res = {}
+	for line in fh:
+		a = line.rstrip(b"\n").split(b" ", 3)
+		if len(a) == 4 and a[2] == b">":
+			res.setdefault(a[1].decode("ascii"), []).append((float(a[0]), a[3]))
+	return res
+
+# Commands that don't change anything on the server.
+_read_only = ("SP", "SPM", "ST", "RS", "IS", "IR", "L",)
+
+def _percentile(sorted_values, pct):
+	if not sorted_values: return None
+	ix = min(int(len(sorted_values) * pct / 100.0), len(sorted_values) - 1)
+	return sorted_values[ix]
+
+def replay(cfg, sessions, copies=1, paced=False, speed=1.0, writes=False, collector=None):
+	"""Send the commands in sessions (from read_trace) to the server in
+	cfg. Each session gets its own connection, and copies > 1 runs that
+	many copies of all of them at the same time.
+
+	With paced each command is sent at the same time (relative to the
+	start) as in the trace, divided by speed. Otherwise as fast as the
+	server answers.
+
+	Only commands that don't modify anything are sent unless writes.
+
+	Records per command stats in collector (a new stats.Stats if None),
+	returns (collector, summary) where summary is a dict with commands,
+	seconds, per_second, p50, p90, p99 and max (latencies in seconds).
+	"""
+	from wellpapp.client import Client
+	if collector is None:
+		collector = _stats.Stats()
+	if not writes:
+		sessions = dict((name, [c for c in cmds if _stats._verb(c[1]) in _read_only])
+		                for name, cmds in sessions.items())
+	sessions = [cmds for cmds in sessions.values() if cmds]
+	start_time = min([cmds[0][0] for cmds in sessions] or [0])
+	latencies = []
+	lat_lock = Lock()
+	errors = []
+	def run(cmds):
+		local = []
+		client = Client(cfg, tag_cache=0, stats=collector, trace=False)
+		try:
+			for t, cmd in cmds:
+				if paced:
+					delay = (t - start_time) / speed - (time() - t0)
+					if delay > 0:
+						sleep(delay)
+				sent = time()
+				client._send(cmd + b"\n")
+				while True:
+					line = client._readline_raw()
+					if line in (b"OK", b"") or line[:2] == b"RE":
+						break
+				local.append(time() - sent)
+		except Exception as e:
+			errors.append(e)
+		finally:
+			client.close()
+			with lat_lock:
+				latencies.extend(local)
+	threads = [Thread(target=run, args=(cmds,)) for _ in range(copies) for cmds in sessions]
+	t0 = time()
+	for t in threads:
+		t.start()
+	for t in threads:
+		t.join()
+	elapsed = time() - t0
+	if errors:
+		raise errors[0]
+	latencies.sort()
+	summary = dict(
+		commands=len(latencies),
+		seconds=elapsed,
+		per_second=len(latencies) / max(elapsed, 1e-9),
+		max=latencies[-1] if latencies else None,
+	)
+	for pct in (50, 90, 99):
+		summary["p%d" % (pct,)] = _percentile(latencies, pct)
+	return collector, summary
+
+def main(arg0, argv):
+	from argparse import ArgumentParser
+	import json
+	parser = ArgumentParser(prog=arg0, description="Replay a trace recorded with WELLPAPP_TRACE against the server in your config")
+	parser.add_argument("-c", "--copies", type=int, default=1, help="run this many copies of the trace at once")
+	parser.add_argument("-p", "--paced", action="store_true", help="keep the timing from the trace (default as fast as possible)")
+	parser.add_argument("-s", "--speed", type=float, default=1.0, help="with -p, run this many times faster")
+	parser.add_argument("-w", "--writes", action="store_true", help="also send commands that modify things (careful)")
+	parser.add_argument("-j", "--json", metavar="FILE", help="save results as JSON")
+	parser.add_argument("trace")
+	args = parser.parse_args(argv)
+	sessions = read_trace(args.trace)
+	collector, summary = replay(None, sessions, args.copies, args.paced, args.speed, args.writes)
+	if not summary["commands"]:
+		print("No commands to replay" + ("" if args.writes else " (maybe you want -w?)"), file=sys.stderr)
+		return 1
+	ms = lambda s: "%.2f" % (s * 1000,)
+	print(collector.summary())
+	print()
+	print("%d commands in %.2fs, %.1f/s" % (summary["commands"], summary["seconds"], summary["per_second"]))
+	print("latency ms: p50 %s  p90 %s  p99 %s  max %s" % tuple(ms(summary[k]) for k in ("p50", "p90", "p99", "max")))
+	if args.json:
+		with open(args.json, "w") as fh:
+			json.dump(dict(summary=summary, verbs=collector.as_dict()), fh, indent=1, sort_keys=True)
+			fh.write("\n")
+	return 0
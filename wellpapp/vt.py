@@ -431,9 +431,12 @@ class VTdatetime(ValueType):
 			raise TypeError("Can only compare to a VTdatetime")
 		if self.min > other.max or other.min > self.max:
 			return False
-		return self._cmp_step(self, other)
+		return self._cmp_step(self, other, True)
 
-	def _cmp_step(self, a, b):
+	def _cmp_step(self, a, b, first):
+		# first: a is this side (a VTdatetime), b the other. Otherwise
+		# b is a (min, max) from this side. (Not "a is self", the
+		# same object can be on both sides.)
 		if a.with_steps:
 			if self.fuzz < 0:
 				nsf = self.fuzz
@@ -454,15 +457,15 @@ class VTdatetime(ValueType):
 					value = unixtime + nsf + self.utcoffset
 					a_min = value + min(fuzz, 0)
 					a_max = value + abs(fuzz)
-					if a is self:
-						if self._cmp_step(b, (a_min, a_max)):
+					if first:
+						if self._cmp_step(b, (a_min, a_max), False):
 							return True
 					else:
 						if a_min <= b[1] and b[0] <= a_max:
 							return True
 		else:
-			if a is self:
-				return self._cmp_step(b, (a.min, a.max))
+			if first:
+				return self._cmp_step(b, (a.min, a.max), False)
 			else:
 				return a.min <= b[1] and b[0] <= a.max
 		return False